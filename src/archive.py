@@ -0,0 +1,84 @@
+import zipfile
+from src.storage import STREAM_BLOCK_SIZE
+
+# Formats that are already compressed; deflating them again costs CPU for
+# next to no gain, so they are stored as-is
+STORED_EXTENSIONS = {'pdf', 'docx', 'xlsx', 'pptx', 'png', 'jpg', 'jpeg', 'gif', 'zip'}
+# Bytes gathered before a piece of the archive is handed to the client
+FLUSH_SIZE = 256 * 1024
+
+class _ChunkSink:
+    """Write-only file object that collects archive bytes for a generator.
+
+    It has no tell() or seek(), so zipfile streams: every entry gets a data
+    descriptor instead of a header rewritten after the fact.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+def _date_time(value):
+    # ZIP timestamps cannot predate 1980
+    if value is None or value.year < 1980:
+        return (1980, 1, 1, 0, 0, 0)
+    return value.timetuple()[:6]
+
+def _read_file(path):
+    with open(path, 'rb') as source:
+        yield from iter(lambda: source.read(STREAM_BLOCK_SIZE), b'')
+
+def stream_zip(entries, read=_read_file):
+    """Yield a ZIP archive of entries piece by piece in constant memory.
+
+    entries is an iterable of (name, source, size, modified); read(source)
+    yields the bytes of a file, by default from a local path. Entries with
+    a source of None become directories. Files that turn out to be missing
+    are left out. ZIP64 records are written whenever a size or offset needs
+    them.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', allowZip64=True) as archive:
+        for name, source, size, modified in entries:
+            if source is None:
+                info = zipfile.ZipInfo(name.rstrip('/') + '/', _date_time(modified))
+                info.external_attr = 0o40755 << 16 | 0x10
+                archive.writestr(info, b'')
+                continue
+
+            info = zipfile.ZipInfo(name, _date_time(modified))
+            info.external_attr = 0o644 << 16
+            extension = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+            info.compress_type = zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            # Lets zipfile decide up front whether the entry needs ZIP64
+            info.file_size = size or 0
+            # The first block is read before the entry header is written
+            blocks = read(source)
+            try:
+                first = next(blocks, b'')
+            except FileNotFoundError:
+                continue
+            with archive.open(info, 'w') as target:
+                target.write(first)
+                for block in blocks:
+                    target.write(block)
+                    if sink.size >= FLUSH_SIZE:
+                        yield sink.drain()
+            if sink.size >= FLUSH_SIZE:
+                yield sink.drain()
+    # The central directory is written when the archive closes
+    yield sink.drain()
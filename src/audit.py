@@ -0,0 +1,155 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from flask import request, session
+from sqlalchemy import insert
+from src.models.user import db, AccessEvent
+
+logger = logging.getLogger(__name__)
+
+# Write-behind audit trail of document views and downloads.
+#
+# Requests only put an event on a bounded in-memory queue. A background
+# thread takes them off in batches and writes each batch with multi-row
+# INSERTs once AUDIT_BATCH_SIZE events are waiting or the oldest has waited
+# AUDIT_FLUSH_SECONDS, so peak download traffic adds a few inserts a second
+# instead of one per download. Reports therefore lag by up to that long.
+#
+# When the queue is full AUDIT_OVERFLOW decides: 'block' (the default)
+# makes the request wait up to AUDIT_BLOCK_SECONDS for room, slowing
+# downloads down to what the database can record; 'drop' discards the
+# event at once. Events that still do not fit are counted and logged. The
+# queue is flushed when the process exits normally; a killed process loses
+# what was still queued.
+
+AUDIT_QUEUE_SIZE = int(os.environ.get('AUDIT_QUEUE_SIZE', 10000))
+AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', 500))
+AUDIT_FLUSH_SECONDS = float(os.environ.get('AUDIT_FLUSH_SECONDS', 2))
+AUDIT_OVERFLOW = os.environ.get('AUDIT_OVERFLOW', 'block').lower()
+AUDIT_BLOCK_SECONDS = float(os.environ.get('AUDIT_BLOCK_SECONDS', 5))
+# Six columns per row keeps a statement under SQL Server's 2100 parameters
+ROWS_PER_STATEMENT = 300
+WRITE_ATTEMPTS = 3
+
+if AUDIT_OVERFLOW not in ('block', 'drop'):
+    raise RuntimeError(f'Unknown AUDIT_OVERFLOW {AUDIT_OVERFLOW!r}; use block or drop')
+
+class AuditWriter(threading.Thread):
+    """Drains the event queue into access_event in batches"""
+
+    def __init__(self, app):
+        super().__init__(name='audit-writer', daemon=True)
+        self.app = app
+        self.events = queue.Queue(maxsize=AUDIT_QUEUE_SIZE)
+        self.stopping = threading.Event()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def submit(self, event):
+        try:
+            if AUDIT_OVERFLOW == 'block':
+                self.events.put(event, timeout=AUDIT_BLOCK_SECONDS)
+            else:
+                self.events.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            # Once per power of two keeps a sustained overload from flooding the log
+            if self.dropped & (self.dropped - 1) == 0:
+                logger.error('Audit queue full, %d access events dropped so far', self.dropped)
+
+    def _next_batch(self):
+        """Wait for events and gather a batch until it is full or due"""
+        try:
+            batch = [self.events.get(timeout=AUDIT_FLUSH_SECONDS)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + AUDIT_FLUSH_SECONDS
+        while len(batch) < AUDIT_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.stopping.is_set():
+                break
+            try:
+                batch.append(self.events.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # Whatever else is already waiting goes along without waiting longer
+        while len(batch) < AUDIT_BATCH_SIZE:
+            try:
+                batch.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, batch):
+        for attempt in range(1, WRITE_ATTEMPTS + 1):
+            try:
+                with self.app.app_context(), db.engine.begin() as connection:
+                    for start in range(0, len(batch), ROWS_PER_STATEMENT):
+                        connection.execute(insert(AccessEvent).values(batch[start:start + ROWS_PER_STATEMENT]))
+                self.written += len(batch)
+                return
+            except Exception:
+                logger.exception('Writing %d access events failed (attempt %d)', len(batch), attempt)
+                if attempt < WRITE_ATTEMPTS and not self.stopping.is_set():
+                    time.sleep(attempt)
+        self.failed += len(batch)
+
+    def run(self):
+        while not (self.stopping.is_set() and self.events.empty()):
+            batch = self._next_batch()
+            if batch:
+                self.write(batch)
+
+    def stop(self, timeout=10):
+        """Write what is queued and end the thread"""
+        self.stopping.set()
+        self.join(timeout)
+
+_writer = None
+
+def record_access(document_id, action):
+    """Note that the signed-in user viewed or downloaded a document"""
+    event = {
+        'document_id': document_id,
+        'user_id': session['user_id'],
+        'action': action,
+        'accessed_at': datetime.utcnow(),
+        'ip_address': request.remote_addr
+    }
+    if _writer is not None:
+        _writer.submit(event)
+    else:
+        # Without a writer thread, e.g. in scripts, write right away
+        with db.engine.begin() as connection:
+            connection.execute(insert(AccessEvent).values([event]))
+
+def audit_status():
+    if _writer is None:
+        return {'running': False}
+    return {
+        'running': _writer.is_alive(),
+        'queued': _writer.events.qsize(),
+        'written': _writer.written,
+        'dropped': _writer.dropped,
+        'failed': _writer.failed
+    }
+
+def stop_audit():
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+def init_audit(app):
+    """Start the background audit writer for this process"""
+    global _writer
+    if _writer is None:
+        _writer = AuditWriter(app)
+        _writer.start()
+        atexit.register(stop_audit)
+    return _writer
@@ -0,0 +1,420 @@
+import argparse
+import hashlib
+import http.client
+import json
+import logging
+import math
+import os
+import platform
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Load and latency benchmark for the API blueprints.
+#
+# Seeds a throwaway database with configurable volumes, then drives each
+# scenario through the Flask test client (one request at a time, so the SQL
+# count per request is exact) and through a real threaded WSGI server with
+# concurrent keep-alive clients. Results are written as JSON and can be
+# compared against an earlier run:
+#
+#   python -m src.benchmark --save baseline.json
+#   python -m src.benchmark --baseline baseline.json
+#
+# The second run exits with status 1 when a scenario regressed. Compare
+# runs made on the same machine with the same volumes.
+
+BENCHMARK_PASSWORD = 'benchmark'
+# p95 differences below this are noise on any machine
+MIN_LATENCY_DELTA_MS = 1.0
+INSERT_BATCH = 1000
+
+# (name, method, path, body, share of --requests). Paths are formatted with
+# a sample row per request, so cached listings see varied keys. Reads come
+# first; writes bump cache versions and would turn later reads into misses.
+SCENARIOS = [
+    ('me', 'GET', '/api/me', None, 1.0),
+    ('users', 'GET', '/api/users?limit=50', None, 1.0),
+    ('folders_root', 'GET', '/api/folders', None, 1.0),
+    ('folders_children', 'GET', '/api/folders?parent_id={folder}', None, 1.0),
+    ('folder_detail', 'GET', '/api/folders/{folder}', None, 1.0),
+    ('folder_breadcrumb', 'GET', '/api/folders/{leaf}/breadcrumb', None, 1.0),
+    ('folder_tree', 'GET', '/api/folders/tree?sizes=true', None, 0.25),
+    ('documents_in_folder', 'GET', '/api/documents?folder_id={folder}', None, 1.0),
+    ('document_detail', 'GET', '/api/documents/{document}', None, 1.0),
+    ('document_download', 'GET', '/api/documents/{document}/download', None, 1.0),
+    ('questions', 'GET', '/api/questions', None, 1.0),
+    ('questions_full', 'GET', '/api/questions?view=full&limit=20', None, 1.0),
+    ('question_answers', 'GET', '/api/questions/{question}/answers', None, 1.0),
+    ('document_update', 'PUT', '/api/documents/{document}', {'description': 'Benchmarked'}, 0.5),
+    ('question_create', 'POST', '/api/questions', {'title': 'Benchmark question', 'content': 'Body'}, 0.5),
+    ('answer_create', 'POST', '/api/questions/{question}/answers', {'content': 'Benchmark answer'}, 0.5),
+    # Dominated by password hashing, so only a handful
+    ('login', 'POST', '/api/login', {'username': 'bench0', 'password': BENCHMARK_PASSWORD}, 0.05),
+]
+
+def percentile(sorted_values, share):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(share / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+class StatementCounter:
+    """Counts SQL statements run on the engine, from any thread"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        self.lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self.observe)
+
+    def observe(self, *args):
+        with self.lock:
+            self.count += 1
+
+def _insert(table, rows):
+    from src.models.user import db
+    for start in range(0, len(rows), INSERT_BATCH):
+        db.session.execute(table.insert(), rows[start:start + INSERT_BATCH])
+
+def seed(volumes, uploads_dir):
+    """Fill an empty database and return sample ids for the scenarios.
+
+    volumes has users, depth, children, documents, questions, answers and
+    file_size. Rows are bulk inserted; every document shares one stored
+    file, as identical uploads do in the blob store.
+    """
+    from src.models.user import db, User, Folder, Document, Blob, Question, Answer
+    from src.passwords import hash_password
+
+    now = datetime.utcnow()
+    password_hash = hash_password(BENCHMARK_PASSWORD)
+    _insert(User.__table__, [
+        {'id': index + 1, 'username': f'bench{index}', 'email': f'bench{index}@example.com',
+         'password_hash': password_hash, 'created_at': now, 'is_admin': index == 0}
+        for index in range(volumes['users'])
+    ])
+    user_ids = list(range(1, volumes['users'] + 1))
+
+    # Breadth first, so ids and tree paths can be assigned up front
+    folders = []
+    level = [(None, '/', -1)]
+    for depth in range(volumes['depth']):
+        next_level = []
+        for parent_id, parent_path, _ in level:
+            for child in range(volumes['children']):
+                folder_id = len(folders) + 1
+                path = f'{parent_path}{folder_id}/'
+                folders.append({
+                    'id': folder_id, 'name': f'Folder {depth}.{child}', 'parent_id': parent_id,
+                    'created_by': user_ids[folder_id % len(user_ids)], 'created_at': now,
+                    'description': '', 'tree_path': path, 'depth': depth
+                })
+                next_level.append((folder_id, path, depth))
+        level = next_level
+    _insert(Folder.__table__, folders)
+    folder_ids = [folder['id'] for folder in folders] or [None]
+    leaf_ids = [folder_id for folder_id, _, _ in level if folder_id] or folder_ids
+
+    contents = os.urandom(volumes['file_size'])
+    content_hash = hashlib.sha256(contents).hexdigest()
+    file_path = os.path.join(uploads_dir, 'blobs', content_hash[:2], content_hash[2:4], content_hash)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as stored:
+        stored.write(contents)
+    if volumes['documents']:
+        db.session.execute(Blob.__table__.insert(), [
+            {'sha256': content_hash, 'size': len(contents), 'ref_count': volumes['documents'], 'created_at': now}
+        ])
+    _insert(Document.__table__, [
+        {'id': index + 1, 'filename': f'{content_hash}.pdf', 'original_filename': f'document-{index}.pdf',
+         'file_path': file_path, 'file_size': len(contents), 'mime_type': 'application/pdf',
+         'uploaded_by': user_ids[index % len(user_ids)], 'uploaded_at': now - timedelta(seconds=index),
+         'description': f'Benchmark document {index}', 'folder_id': folder_ids[index % len(folder_ids)],
+         'content_hash': content_hash, 'processing_status': 'ready'}
+        for index in range(volumes['documents'])
+    ])
+
+    questions, answers = [], []
+    for index in range(volumes['questions']):
+        asked_at = now - timedelta(minutes=index)
+        questions.append({
+            'id': index + 1, 'title': f'Question {index}', 'content': 'What does clause 4.2 cover?',
+            'asked_by': user_ids[index % len(user_ids)], 'asked_at': asked_at,
+            'is_answered': volumes['answers'] > 0, 'answer_count': volumes['answers'],
+            'last_activity_at': asked_at + timedelta(seconds=volumes['answers'])
+        })
+        for reply in range(volumes['answers']):
+            answers.append({
+                'id': len(answers) + 1, 'content': f'Answer {reply}', 'question_id': index + 1,
+                'answered_by': user_ids[(index + reply + 1) % len(user_ids)],
+                'answered_at': asked_at + timedelta(seconds=reply + 1)
+            })
+    _insert(Question.__table__, questions)
+    _insert(Answer.__table__, answers)
+    db.session.commit()
+
+    return {
+        'folder': folder_ids,
+        'leaf': leaf_ids,
+        'document': list(range(1, volumes['documents'] + 1)) or [0],
+        'question': list(range(1, volumes['questions'] + 1)) or [0]
+    }
+
+def _sample(samples, index):
+    return {name: ids[(index * 7919) % len(ids)] for name, ids in samples.items()}
+
+def _summarize(latencies, errors, elapsed, statements):
+    latencies.sort()
+    requests = len(latencies)
+    return {
+        'requests': requests,
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50), 3) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95), 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99), 3) if latencies else None,
+        'throughput_rps': round(requests / elapsed, 1) if elapsed else None,
+        'sql_per_request': round(statements / requests, 2) if requests else None,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def run_test_client(app, counter, samples, requests, warmup):
+    """Each scenario in turn through the Flask test client, one request at a time"""
+    client = app.test_client()
+    client.post('/api/login', json={'username': 'bench0', 'password': BENCHMARK_PASSWORD})
+    results = {}
+    for name, method, path, body, share in SCENARIOS:
+        total = max(1, int(requests * share))
+        latencies, errors, statements = [], 0, 0
+        started = time.perf_counter()
+        for index in range(-min(warmup, total), total):
+            url = path.format(**_sample(samples, index))
+            before = counter.count
+            request_started = time.perf_counter()
+            response = client.open(url, method=method, json=body)
+            response.get_data()
+            duration = (time.perf_counter() - request_started) * 1000
+            if index < 0:
+                started = time.perf_counter()
+                continue
+            latencies.append(duration)
+            statements += counter.count - before
+            errors += response.status_code >= 400
+        results[name] = _summarize(latencies, errors, time.perf_counter() - started, statements)
+    return results
+
+def _login_cookie(port):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    payload = json.dumps({'username': 'bench0', 'password': BENCHMARK_PASSWORD})
+    connection.request('POST', '/api/login', payload, {'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response.getheader('Set-Cookie').split(';', 1)[0]
+
+def run_wsgi_server(app, counter, samples, requests, warmup, concurrency):
+    """Each scenario through a threaded WSGI server with concurrent clients"""
+    from werkzeug.serving import make_server
+    # One access log line per request would dominate the measurement
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    port = server.server_port
+    try:
+        cookie = _login_cookie(port)
+        results = {}
+        for name, method, path, body, share in SCENARIOS:
+            total = max(concurrency, int(requests * share))
+            payload = json.dumps(body) if body is not None else None
+            headers = {'Cookie': cookie, 'Content-Type': 'application/json'}
+            latencies, failures = [], []
+            lock = threading.Lock()
+            barrier = threading.Barrier(concurrency + 1)
+
+            def client(worker):
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                mine, errors = [], 0
+                try:
+                    for index in range(-warmup, total):
+                        if index == 0:
+                            barrier.wait()
+                        if index >= 0 and index % concurrency != worker:
+                            continue
+                        url = path.format(**_sample(samples, index))
+                        request_started = time.perf_counter()
+                        connection.request(method, url, payload, headers)
+                        response = connection.getresponse()
+                        response.read()
+                        if index >= 0:
+                            mine.append((time.perf_counter() - request_started) * 1000)
+                            errors += response.status >= 400
+                        if response.getheader('Connection', '').lower() == 'close':
+                            connection.close()
+                except (OSError, http.client.HTTPException):
+                    # Release the other clients; the run is reported as failed
+                    barrier.abort()
+                    raise
+                finally:
+                    connection.close()
+                with lock:
+                    latencies.extend(mine)
+                    failures.append(errors)
+
+            threads = [threading.Thread(target=client, args=(worker,)) for worker in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            # Timing starts once every client has finished warming up
+            barrier.wait()
+            before = counter.count
+            started = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            results[name] = _summarize(latencies, sum(failures), elapsed, counter.count - before)
+        return results
+    finally:
+        server.shutdown()
+
+def compare(results, baseline, tolerance):
+    """Return a message for every scenario that regressed against baseline.
+
+    A scenario regresses when p95 latency or throughput is worse by more
+    than tolerance (a fraction), when it runs more SQL statements per
+    request, or when it starts failing.
+    """
+    # Cached listings make statement counts depend on the request mix
+    for key in ('database', 'volumes', 'requests', 'concurrency', 'cold_cache'):
+        if results['meta'].get(key) != baseline.get('meta', {}).get(key):
+            return [f'{key} differs from the baseline run; rerun with the same settings']
+    regressions = []
+    for mode, scenarios in results['results'].items():
+        for name, current in scenarios.items():
+            previous = baseline.get('results', {}).get(mode, {}).get(name)
+            if not previous:
+                continue
+            label = f'{mode}/{name}'
+            if current['errors'] and not previous['errors']:
+                regressions.append(f"{label}: {current['errors']} errors, none in baseline")
+            if current['p95_ms'] is not None and previous['p95_ms'] is not None:
+                limit = previous['p95_ms'] * (1 + tolerance)
+                if current['p95_ms'] > limit and current['p95_ms'] - previous['p95_ms'] > MIN_LATENCY_DELTA_MS:
+                    regressions.append(f"{label}: p95 {current['p95_ms']}ms, baseline {previous['p95_ms']}ms")
+            if current['throughput_rps'] and previous['throughput_rps']:
+                if current['throughput_rps'] < previous['throughput_rps'] * (1 - tolerance):
+                    regressions.append(
+                        f"{label}: {current['throughput_rps']} req/s, baseline {previous['throughput_rps']} req/s"
+                    )
+            # Statement counts are deterministic in the test client; the server
+            # mode shares them, so allow for rounding only
+            if mode == 'test_client' and current['sql_per_request'] is not None and previous['sql_per_request'] is not None:
+                if current['sql_per_request'] > previous['sql_per_request'] + 0.01:
+                    regressions.append(
+                        f"{label}: {current['sql_per_request']} SQL/request, baseline {previous['sql_per_request']}"
+                    )
+    return regressions
+
+def print_report(results):
+    columns = ('requests', 'errors', 'p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'sql_per_request')
+    print(f"{'scenario':<30}" + ''.join(f'{column:>16}' for column in columns))
+    for mode, scenarios in results['results'].items():
+        for name, row in scenarios.items():
+            cells = ''.join(f"{'-' if row[column] is None else row[column]:>16}" for column in columns)
+            print(f'{mode + "/" + name:<30}{cells}')
+    print(f"peak RSS {results['peak_rss_mb']} MB")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Seed a database and benchmark the API')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--depth', type=int, default=3, help='levels in the folder tree')
+    parser.add_argument('--children', type=int, default=5, help='subfolders per folder')
+    parser.add_argument('--documents', type=int, default=2000)
+    parser.add_argument('--questions', type=int, default=500)
+    parser.add_argument('--answers', type=int, default=3, help='answers per question')
+    parser.add_argument('--file-size', type=int, default=64 * 1024, help='bytes per document file')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per scenario')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=8, help='clients against the WSGI server')
+    parser.add_argument('--mode', choices=('test_client', 'wsgi', 'both'), default='both')
+    parser.add_argument('--cold-cache', action='store_true', help='disable the listing response cache')
+    parser.add_argument('--database-url', help='an empty database to seed; defaults to a temporary SQLite file')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='fail when results regress against this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown, as a fraction')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='vdr-benchmark-')
+    # The app reads these while it is imported
+    os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(workdir, 'benchmark.db')}"
+    os.environ['UPLOADS_DIR'] = os.path.join(workdir, 'uploads')
+    os.environ.setdefault('PROCESSING_WORKERS', '0')
+    if args.cold_cache:
+        os.environ['RESPONSE_CACHE_BYTES'] = '0'
+    # Only the seeded database, with nothing shared with a live deployment
+    for name in ('SQL_SERVER', 'SQL_READ_SERVER', 'DATABASE_READ_URL', 'CACHE_REDIS_URL'):
+        os.environ.pop(name, None)
+
+    from src.main import app
+    from src.models.user import db
+
+    volumes = {
+        'users': max(1, args.users), 'depth': args.depth, 'children': args.children,
+        'documents': args.documents, 'questions': args.questions, 'answers': args.answers,
+        'file_size': args.file_size
+    }
+    with app.app_context():
+        seed_started = time.perf_counter()
+        samples = seed(volumes, os.environ['UPLOADS_DIR'])
+        seed_seconds = time.perf_counter() - seed_started
+        counter = StatementCounter(db.engine)
+        backend = db.engine.dialect.name
+
+    results = {
+        'meta': {
+            'created_at': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'database': backend,
+            'volumes': volumes,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'cold_cache': args.cold_cache,
+            'seed_seconds': round(seed_seconds, 2)
+        },
+        'results': {}
+    }
+    if args.mode in ('test_client', 'both'):
+        results['results']['test_client'] = run_test_client(app, counter, samples, args.requests, args.warmup)
+    if args.mode in ('wsgi', 'both'):
+        results['results']['wsgi'] = run_wsgi_server(
+            app, counter, samples, args.requests, args.warmup, max(1, args.concurrency)
+        )
+    results['peak_rss_mb'] = peak_rss_mb()
+
+    print_report(results)
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as source:
+            regressions = compare(results, json.load(source), args.tolerance)
+        for message in regressions:
+            print(f'REGRESSION {message}')
+        if regressions:
+            return 1
+        print('No regressions against baseline')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, make_response, request, session
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from src.models.user import db, Folder, IN_CLAUSE_CHUNK
+
+# Versioned response cache for folder and document listings.
+#
+# Every listing belongs to a folder scope ("folder:<id>", or "folder:root"
+# for top level). Each scope has a version counter, and cached bodies are
+# keyed by the versions they were built from, so a cached body never goes
+# stale: writes bump the counters and later reads simply miss. Bumps are
+# collected on the session and applied after the transaction commits.
+#
+# By default counters and bodies live in this process. Deployments running
+# several worker processes must configure a shared backend so a write in
+# one process is seen by the others.
+
+RESPONSE_CACHE_BYTES = int(os.environ.get('RESPONSE_CACHE_BYTES', 64 * 1024 * 1024))
+# Bodies larger than this share of the cache are not kept
+MAX_ENTRY_SHARE = 8
+# Lifetime of bodies in a shared backend; versions make them immutable anyway
+SHARED_TTL = 3600
+# Bumped to drop every cached listing at once, e.g. when a username changes
+EPOCH = 'epoch'
+ROOT_SCOPE = 'folder:root'
+# Changes with every folder scope; for responses built from the whole tree
+TREE_SCOPE = 'tree'
+
+class LRUCache:
+    """Thread-safe LRU of bytes values bounded by their total size"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes // MAX_ENTRY_SHARE:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+class CacheBackend:
+    """Interface of a cache shared between processes, e.g. Redis or memcached.
+
+    Counters must be atomic across processes; values are opaque bytes.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def get_versions(self, names):
+        """Current counter of each name, 0 for names never bumped"""
+        raise NotImplementedError
+
+    def bump_versions(self, names):
+        raise NotImplementedError
+
+class RedisBackend(CacheBackend):
+    """Shared backend on Redis; needs the optional redis package"""
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self.client.get(f'body:{key}')
+
+    def set(self, key, value, ttl):
+        self.client.set(f'body:{key}', value, ex=ttl)
+
+    def get_versions(self, names):
+        return [int(value or 0) for value in self.client.mget([f'version:{name}' for name in names])]
+
+    def bump_versions(self, names):
+        pipeline = self.client.pipeline(transaction=False)
+        for name in names:
+            pipeline.incr(f'version:{name}')
+        pipeline.execute()
+
+_local = LRUCache(RESPONSE_CACHE_BYTES)
+_versions = {}
+_versions_lock = threading.Lock()
+_shared = RedisBackend(os.environ['CACHE_REDIS_URL']) if os.environ.get('CACHE_REDIS_URL') else None
+
+def configure_shared_backend(backend):
+    """Use backend for counters and as a second level behind the local LRU"""
+    global _shared
+    _shared = backend
+    _local.clear()
+
+def get_versions(names):
+    if _shared is not None:
+        return _shared.get_versions(names)
+    with _versions_lock:
+        return [_versions.get(name, 0) for name in names]
+
+def bump_versions(names):
+    if _shared is not None:
+        _shared.bump_versions(names)
+        return
+    with _versions_lock:
+        for name in names:
+            _versions[name] = _versions.get(name, 0) + 1
+
+def folder_scope(folder_id):
+    return f'folder:{folder_id}' if folder_id else ROOT_SCOPE
+
+def mark_folders_changed(folder_ids):
+    """Record folders whose contents or own data change in this transaction.
+
+    Their parents are marked as well, since a parent's listing shows each
+    child's name and counts. The versions are bumped on commit.
+    """
+    folder_ids = set(folder_ids)
+    scopes = {folder_scope(folder_id) for folder_id in folder_ids} | {TREE_SCOPE}
+    real_ids = [folder_id for folder_id in folder_ids if folder_id]
+    for start in range(0, len(real_ids), IN_CLAUSE_CHUNK):
+        parents = db.session.execute(
+            select(Folder.parent_id).where(Folder.id.in_(real_ids[start:start + IN_CLAUSE_CHUNK])).distinct()
+        ).scalars()
+        scopes.update(folder_scope(parent_id) for parent_id in parents)
+    db.session.info.setdefault('cache_scopes', set()).update(scopes)
+
+def invalidate_all():
+    """Drop every cached listing once the current transaction commits"""
+    db.session.info.setdefault('cache_scopes', set()).add(EPOCH)
+
+@event.listens_for(Session, 'after_commit')
+def _bump_after_commit(session):
+    scopes = session.info.pop('cache_scopes', None)
+    if scopes:
+        bump_versions(sorted(scopes))
+
+@event.listens_for(Session, 'after_transaction_end')
+def _forget_after_rollback(session, transaction):
+    # Committed scopes are gone by now; anything left was rolled back
+    if transaction.parent is None:
+        session.info.pop('cache_scopes', None)
+
+def _cached_body(key):
+    body = _local.get(key)
+    if body is None and _shared is not None:
+        body = _shared.get(key)
+        if body is not None:
+            _local.set(key, body)
+    return body
+
+def _store_body(key, body):
+    _local.set(key, body)
+    if _shared is not None:
+        _shared.set(key, body, SHARED_TTL)
+
+def cached_listing(scope_for=None):
+    """Cache a JSON listing view under the version of its folder scope.
+
+    scope_for receives the view arguments and returns the folder id the
+    response depends on (None for top level). Without scope_for the
+    response depends on the whole folder tree. Responses carry an ETag, and
+    a matching If-None-Match is answered with 304 before the view or the
+    database is touched.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Imported here; the user routes depend on this module
+            from src.routes.user import current_principal
+            if 'user_id' not in session or current_principal() is None:
+                return view(*args, **kwargs)
+
+            scope = folder_scope(scope_for(*args, **kwargs)) if scope_for else TREE_SCOPE
+            scope_version, epoch = get_versions([scope, EPOCH])
+            query = '&'.join(f'{name}={value}' for name, value in sorted(request.args.items(multi=True)))
+            key = f'{request.path}?{query}|{scope}:{scope_version}|{epoch}'
+            etag = hashlib.sha1(key.encode()).hexdigest()
+
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                body = _cached_body(etag)
+                if body is None:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    _store_body(etag, response.get_data())
+                else:
+                    response = Response(body, mimetype='application/json')
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,196 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select, delete, insert, update, func, true
+from sqlalchemy.exc import IntegrityError
+from src.models.user import (
+    db, ChangeLogEntry, ChangeFeedState, Document, Folder, Question, Answer,
+    serialize_documents, serialize_folders, serialize_questions, serialize_answers, IN_CLAUSE_CHUNK
+)
+
+# Change log behind GET /api/changes, for clients that keep a copy of the
+# room's metadata and only want what changed since their last sync.
+#
+# Write routes call record_changes() in the transaction that makes the
+# change. Each entity keeps only its latest entry, so a client that syncs
+# after a day of activity receives every changed row once, however often
+# it changed. Deletes leave tombstones, which are dropped after
+# CHANGE_TOMBSTONE_DAYS; a client whose cursor predates that must resync
+# from the start.
+#
+# Ids are taken when a row is inserted, not when its transaction commits,
+# so a slow transaction can commit an id below one a client has already
+# read. The feed therefore pages by commit_seq instead, which
+# sequence_committed_changes() hands out to entries only once they are
+# committed, one numbering at a time: whatever commits later is numbered
+# after everything a client may have seen.
+
+CHANGE_TOMBSTONE_DAYS = int(os.environ.get('CHANGE_TOMBSTONE_DAYS', 30))
+COMPACT_INTERVAL = 3600
+
+def _document_rows(documents):
+    # Renaming or moving a folder changes the path of every document below
+    # it without logging them, so documents only carry folder_id and clients
+    # take names and paths from the folder entries
+    rows = serialize_documents(documents, fields={'uploader_name'})
+    for row in rows:
+        del row['folder_name'], row['folder_path']
+    return rows
+
+def _question_rows(questions):
+    # Answers are entities of their own in the feed
+    rows = serialize_questions(questions, fields={
+        'asker_name', 'asked_at', 'is_answered', 'answer_count', 'last_activity_at'
+    })
+    for row in rows:
+        del row['answers']
+    return rows
+
+ENTITIES = {
+    'folder': (Folder, serialize_folders),
+    'document': (Document, _document_rows),
+    'question': (Question, _question_rows),
+    'answer': (Answer, serialize_answers)
+}
+
+def record_changes(entity, ids, deleted=False):
+    """Log that rows of entity were created, updated or (deleted=True) deleted.
+
+    Runs in the caller's transaction; an entity's earlier entry is removed
+    because the new one supersedes it.
+    """
+    ids = sorted({entity_id for entity_id in ids if entity_id is not None})
+    now = datetime.utcnow()
+    for start in range(0, len(ids), IN_CLAUSE_CHUNK):
+        chunk = ids[start:start + IN_CLAUSE_CHUNK]
+        db.session.execute(
+            delete(ChangeLogEntry)
+            .where(ChangeLogEntry.entity == entity, ChangeLogEntry.entity_id.in_(chunk))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.execute(insert(ChangeLogEntry), [
+            {'entity': entity, 'entity_id': entity_id, 'deleted': deleted, 'changed_at': now}
+            for entity_id in chunk
+        ])
+
+def pruned_through():
+    state = db.session.get(ChangeFeedState, 1)
+    return state.pruned_through if state else 0
+
+def compact_change_log():
+    """Drop tombstones older than CHANGE_TOMBSTONE_DAYS and move the horizon past them"""
+    cutoff = datetime.utcnow() - timedelta(days=CHANGE_TOMBSTONE_DAYS)
+    expired = select(func.max(ChangeLogEntry.commit_seq)).where(
+        ChangeLogEntry.deleted == true(), ChangeLogEntry.changed_at < cutoff
+    )
+    horizon = db.session.execute(expired).scalar()
+    if horizon is None:
+        return 0
+    removed = db.session.execute(
+        delete(ChangeLogEntry)
+        .where(ChangeLogEntry.deleted == true(), ChangeLogEntry.commit_seq <= horizon)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    state = db.session.get(ChangeFeedState, 1)
+    if state is None:
+        db.session.add(ChangeFeedState(id=1, pruned_through=horizon))
+    else:
+        state.pruned_through = max(state.pruned_through, horizon)
+    db.session.commit()
+    return removed
+
+_last_compaction = 0.0
+_compaction_lock = threading.Lock()
+
+def compact_periodically():
+    """Compact at most once per COMPACT_INTERVAL in this process"""
+    global _last_compaction
+    with _compaction_lock:
+        if time.monotonic() - _last_compaction < COMPACT_INTERVAL:
+            return
+        _last_compaction = time.monotonic()
+    compact_change_log()
+
+def _lock_feed_state(connection):
+    """Take the row lock that serializes numbering, creating the row on first use"""
+    lock = update(ChangeFeedState).where(ChangeFeedState.id == 1).values(
+        last_commit_seq=ChangeFeedState.last_commit_seq
+    )
+    if connection.execute(lock).rowcount:
+        return
+    try:
+        with connection.begin_nested():
+            connection.execute(insert(ChangeFeedState).values(id=1, pruned_through=0, last_commit_seq=0))
+    except IntegrityError:
+        # Another process created it first
+        connection.execute(lock)
+
+def sequence_committed_changes():
+    """Give committed entries without a commit_seq the next numbers, in id order"""
+    waiting = select(ChangeLogEntry.id).where(ChangeLogEntry.commit_seq.is_(None)).limit(1)
+    if db.session.execute(waiting).first() is None:
+        return
+    # A transaction of its own on the primary, so the lock is held only
+    # for the numbering and the request's reads are unaffected
+    with db.engine.begin() as connection:
+        _lock_feed_state(connection)
+        # Only committed entries are visible here; later ones wait for the
+        # next numbering, which comes after this one releases the lock
+        low, high = connection.execute(
+            select(func.min(ChangeLogEntry.id), func.max(ChangeLogEntry.id))
+            .where(ChangeLogEntry.commit_seq.is_(None))
+        ).one()
+        if low is None:
+            return
+        last = connection.execute(
+            select(ChangeFeedState.last_commit_seq).where(ChangeFeedState.id == 1)
+        ).scalar()
+        # Offsetting ids numbers the whole batch in one statement; entries
+        # that commit in the meantime outside [low, high] are left for later
+        connection.execute(
+            update(ChangeLogEntry)
+            .where(ChangeLogEntry.commit_seq.is_(None), ChangeLogEntry.id.between(low, high))
+            .values(commit_seq=ChangeLogEntry.id - low + last + 1)
+        )
+        connection.execute(
+            update(ChangeFeedState).where(ChangeFeedState.id == 1).values(last_commit_seq=last + high - low + 1)
+        )
+
+def changes_since(cursor, limit):
+    """Entries after cursor in commit order, with the current row of each upsert.
+
+    Returns (changes, next_cursor, has_more).
+    """
+    sequence_committed_changes()
+    entries = db.session.execute(
+        select(ChangeLogEntry)
+        .where(ChangeLogEntry.commit_seq > cursor)
+        .order_by(ChangeLogEntry.commit_seq)
+        .limit(limit + 1)
+    ).scalars().all()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    current = {}
+    for entity, (model, serialize) in ENTITIES.items():
+        ids = [entry.entity_id for entry in entries if entry.entity == entity and not entry.deleted]
+        for start in range(0, len(ids), IN_CLAUSE_CHUNK):
+            rows = model.query.filter(model.id.in_(ids[start:start + IN_CLAUSE_CHUNK])).all()
+            current.update(((entity, row['id']), row) for row in serialize(rows))
+
+    changes = []
+    for entry in entries:
+        data = None if entry.deleted else current.get((entry.entity, entry.entity_id))
+        changes.append({
+            'cursor': entry.commit_seq,
+            'entity': entry.entity,
+            'id': entry.entity_id,
+            # A row can be gone without a tombstone yet, e.g. from a
+            # transaction that is about to record one
+            'action': 'upsert' if data is not None else 'delete',
+            'changed_at': entry.changed_at.isoformat(),
+            'data': data
+        })
+    next_cursor = entries[-1].commit_seq if entries else cursor
+    return changes, next_cursor, has_more
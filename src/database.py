@@ -0,0 +1,265 @@
+import logging
+import os
+import random
+import threading
+import time
+from functools import wraps
+from urllib.parse import quote_plus
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool, StaticPool
+
+logger = logging.getLogger(__name__)
+
+# Engine setup for the three supported deployments: Azure SQL through
+# pymssql, file SQLite and in-memory SQLite. Pools are sized per backend,
+# transient faults are retried, and reads can optionally go to a replica.
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+# Azure SQL drops connections idle for about 30 minutes; recycle well before
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1200))
+# How long SQLite waits on a locked database before giving up
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 15))
+DB_RETRY_ATTEMPTS = int(os.environ.get('DB_RETRY_ATTEMPTS', 3))
+DB_RETRY_BASE_DELAY = float(os.environ.get('DB_RETRY_BASE_DELAY', 0.1))
+DB_RETRY_MAX_DELAY = 2.0
+REPLICA_BIND = 'replica'
+
+# SQL Server error numbers worth retrying: throttling, failover, resource
+# limits, deadlocks and dropped connections
+TRANSIENT_MSSQL_ERRORS = {
+    233, 64, 1205, 4060, 4221, 10053, 10054, 10060, 10928, 10929, 20003, 20006, 20009, 20047,
+    40143, 40197, 40501, 40540, 40613, 49918, 49919, 49920
+}
+TRANSIENT_SQLITE_MESSAGES = ('database is locked', 'database is busy')
+
+def get_database_uri():
+    """Individual SQL variables first, then DATABASE_URL, then in-memory SQLite"""
+    server = os.environ.get('SQL_SERVER')
+    database = os.environ.get('SQL_DATABASE')
+    if server and database:
+        username = quote_plus(os.environ.get('SQL_USER', ''))
+        password = quote_plus(os.environ.get('SQL_PASSWORD', ''))
+        port = os.environ.get('SQL_PORT', '1433')
+        return f"mssql+pymssql://{username}:{password}@{server}:{port}/{database}?charset=utf8"
+    return os.environ.get('DATABASE_URL', 'sqlite:///:memory:')
+
+def get_replica_uri():
+    """Optional read-only secondary, e.g. an Azure SQL geo-replica"""
+    server = os.environ.get('SQL_READ_SERVER')
+    database = os.environ.get('SQL_DATABASE')
+    if server and database:
+        username = quote_plus(os.environ.get('SQL_USER', ''))
+        password = quote_plus(os.environ.get('SQL_PASSWORD', ''))
+        port = os.environ.get('SQL_PORT', '1433')
+        return f"mssql+pymssql://{username}:{password}@{server}:{port}/{database}?charset=utf8"
+    return os.environ.get('DATABASE_READ_URL')
+
+class PoolMetrics:
+    """Checkout wait times of the connection pools, in seconds"""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.timeouts = 0
+        self.buckets = [0] * len(self.BUCKETS)
+
+    def observe(self, seconds, timed_out=False):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self.timeouts += bool(timed_out)
+            for index, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    self.buckets[index] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'checkouts': self.count,
+                'wait_seconds_total': round(self.total, 6),
+                'wait_seconds_max': round(self.max, 6),
+                'timeouts': self.timeouts,
+                'wait_buckets': dict(zip(self.BUCKETS, self.buckets))
+            }
+
+pool_metrics = PoolMetrics()
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            pool_metrics.observe(time.perf_counter() - started, timed_out)
+
+class RoutingSession(Session):
+    """Session that sends reads to the replica inside use_replica views.
+
+    Anything that flushes or runs in a transaction that already wrote goes
+    to the primary, so a view can never write to the secondary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get('use_replica') and not self._flushing and not self.new and not self.dirty:
+            replica = self._db.engines.get(REPLICA_BIND)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def engine_options(uri):
+    """Pool and driver settings for the backend behind uri"""
+    if uri.startswith('sqlite'):
+        if ':memory:' in uri or uri in ('sqlite://', 'sqlite:///'):
+            # One shared connection, or each thread would see its own empty database
+            return {'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}}
+        return {
+            'poolclass': InstrumentedQueuePool,
+            'pool_size': 5,
+            'max_overflow': 10,
+            'pool_timeout': DB_POOL_TIMEOUT,
+            'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT, 'check_same_thread': False}
+        }
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': True
+    }
+    if uri.startswith('mssql+pymssql'):
+        options['connect_args'] = {'login_timeout': 15, 'timeout': 60}
+    return options
+
+def _configure_sqlite(engine):
+    """WAL lets readers proceed during a write; busy_timeout waits out locks"""
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(connection, _):
+        cursor = connection.cursor()
+        cursor.execute(f'PRAGMA busy_timeout = {int(SQLITE_BUSY_TIMEOUT * 1000)}')
+        if engine.url.database and engine.url.database != ':memory:':
+            cursor.execute('PRAGMA journal_mode = WAL')
+            cursor.execute('PRAGMA synchronous = NORMAL')
+        cursor.close()
+
+def is_transient(error):
+    """Classify a database error as worth retrying"""
+    if not isinstance(error, DBAPIError):
+        return False
+    if error.connection_invalidated:
+        return True
+    original = error.orig
+    code = original.args[0] if original is not None and original.args else None
+    if isinstance(code, int) and code in TRANSIENT_MSSQL_ERRORS:
+        return True
+    message = str(original).lower()
+    return any(text in message for text in TRANSIENT_SQLITE_MESSAGES)
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff for the given retry number"""
+    return random.uniform(0, min(DB_RETRY_MAX_DELAY, DB_RETRY_BASE_DELAY * 2 ** attempt))
+
+def retry_transient(view):
+    """Rerun a view when it fails on a transient database error.
+
+    Only for views that are safe to repeat: reads, or writes whose whole
+    effect is the database transaction they commit.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        from src.models.user import db
+        attempt = 0
+        while True:
+            try:
+                return view(*args, **kwargs)
+            except DBAPIError as e:
+                db.session.rollback()
+                if attempt + 1 >= DB_RETRY_ATTEMPTS or not is_transient(e):
+                    raise
+                delay = backoff_delay(attempt)
+                logger.warning('Transient database error in %s, retrying in %.2fs: %s', view.__name__, delay, e.orig)
+                time.sleep(delay)
+                attempt += 1
+    return wrapper
+
+def no_retry(view):
+    """Keep a GET view out of the automatic retries.
+
+    For views that commit as they read or stream for a long time, where
+    running the view again is not a plain repeat of the read.
+    """
+    view._no_retry = True
+    return view
+
+def use_replica(view):
+    """Serve a read-only view from the replica when one is configured.
+
+    Only for views that tolerate replication lag; cached listings must stay
+    on the primary or a stale body could be stored under a new version.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        from src.models.user import db
+        db.session.info['use_replica'] = True
+        try:
+            return view(*args, **kwargs)
+        finally:
+            db.session.info.pop('use_replica', None)
+    return wrapper
+
+def init_database(app):
+    """Configure engines for app, bind db, and make read views retry"""
+    from src.models.user import db
+    uri = app.config.setdefault('SQLALCHEMY_DATABASE_URI', get_database_uri())
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(uri))
+    replica_uri = get_replica_uri()
+    if replica_uri:
+        binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+        binds[REPLICA_BIND] = dict(engine_options(replica_uri), url=replica_uri)
+    db.init_app(app)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                _configure_sqlite(engine)
+
+    # GET and HEAD views read, so they may be retried unless marked no_retry
+    for rule in app.url_map.iter_rules():
+        if rule.methods - {'GET', 'HEAD', 'OPTIONS'}:
+            continue
+        view = app.view_functions[rule.endpoint]
+        if getattr(view, '_no_retry', False):
+            continue
+        if not getattr(view, '_retries_transient', False):
+            wrapped = retry_transient(view)
+            wrapped._retries_transient = True
+            app.view_functions[rule.endpoint] = wrapped
+
+def pool_status():
+    """Pool sizes per engine plus checkout wait metrics"""
+    from src.models.user import db
+    engines = {}
+    for key, engine in db.engines.items():
+        pool = engine.pool
+        engines[key or 'default'] = {
+            'pool': type(pool).__name__,
+            'size': pool.size() if hasattr(pool, 'size') else None,
+            'checked_out': pool.checkedout() if hasattr(pool, 'checkedout') else None,
+            'overflow': pool.overflow() if hasattr(pool, 'overflow') else None
+        }
+    return {'engines': engines, 'checkout': pool_metrics.snapshot()}
@@ -0,0 +1,134 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque, namedtuple
+from itertools import islice
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from src.models.user import db
+
+# Change notifications for the server-sent event stream at GET /api/events.
+#
+# Write routes call publish() while they work; the events are held on the
+# session and only reach subscribers once the transaction commits, so a
+# rolled back or retried request never announces anything. Published
+# events go into a bounded ring buffer that connected streams wait on and
+# that reconnecting clients resume from with Last-Event-ID.
+#
+# Events are kept in this process. With several worker processes a client
+# only hears about writes served by the worker it is connected to, so run
+# a single (threaded) worker for the event stream or route /api/events to
+# one.
+
+EVENT_BUFFER_SIZE = int(os.environ.get('EVENT_BUFFER_SIZE', 1000))
+# Idle streams send a comment this often so proxies keep them open
+EVENT_HEARTBEAT = float(os.environ.get('EVENT_HEARTBEAT', 15))
+# Streams end after this long; the browser reconnects with Last-Event-ID
+EVENT_STREAM_SECONDS = float(os.environ.get('EVENT_STREAM_SECONDS', 1800))
+# Tells the client to reload what it shows, e.g. after missing events
+RESET_EVENT = 'reset'
+QUESTIONS_TOPIC = 'questions'
+
+Event = namedtuple('Event', ['sequence', 'type', 'topics', 'message'])
+
+def folder_topic(folder_id):
+    return f'folder:{folder_id}' if folder_id else 'folder:root'
+
+def question_topic(question_id):
+    return f'question:{question_id}'
+
+def encode_event(event_id, event_type, data):
+    return f'id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'.encode()
+
+class EventBroker:
+    """Ring buffer of recent events that streams block on while idle"""
+
+    def __init__(self, size):
+        # Ids from an earlier process cannot be resumed from
+        self.stream_id = uuid.uuid4().hex[:8]
+        self.events = deque(maxlen=size)
+        self.sequence = 0
+        self.condition = threading.Condition()
+
+    def event_id(self, sequence):
+        return f'{self.stream_id}-{sequence}'
+
+    def publish(self, pending):
+        """Append (type, data, topics) items and wake every waiting stream"""
+        with self.condition:
+            for event_type, data, topics in pending:
+                self.sequence += 1
+                message = encode_event(self.event_id(self.sequence), event_type, data)
+                self.events.append(Event(self.sequence, event_type, frozenset(topics), message))
+            self.condition.notify_all()
+
+    def resume_point(self, last_event_id):
+        """Sequence to continue after, and whether events were missed"""
+        with self.condition:
+            current = self.sequence
+        if not last_event_id:
+            return current, False
+        stream_id, _, sequence = last_event_id.rpartition('-')
+        if stream_id != self.stream_id or not sequence.isdigit() or int(sequence) > current:
+            return current, True
+        return int(sequence), False
+
+    def wait(self, after, timeout):
+        """Events newer than sequence after, blocking up to timeout for one.
+
+        Returns (events, missed); missed is True when events after it have
+        already left the buffer.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence > after, timeout)
+            if self.sequence <= after:
+                return [], False
+            if not self.events:
+                return [], True
+            # Sequences are contiguous, so the first new event's position is known
+            first = self.events[0].sequence
+            return list(islice(self.events, max(after + 1 - first, 0), None)), first > after + 1
+
+broker = EventBroker(EVENT_BUFFER_SIZE)
+
+def publish(event_type, data, topics):
+    """Announce a change to subscribers of topics once the transaction commits"""
+    db.session.info.setdefault('pending_events', []).append((event_type, data, tuple(topics)))
+
+@event.listens_for(Session, 'after_commit')
+def _publish_after_commit(session):
+    pending = session.info.pop('pending_events', None)
+    if pending:
+        broker.publish(pending)
+
+@event.listens_for(Session, 'after_transaction_end')
+def _forget_after_rollback(session, transaction):
+    # Committed events are gone by now; anything left was rolled back
+    if transaction.parent is None:
+        session.info.pop('pending_events', None)
+
+def event_stream(topics, after, missed):
+    """Yield the text/event-stream body for a subscriber.
+
+    topics is the set of topics to deliver, or None for everything. Runs
+    outside the request context and never touches the database.
+    """
+    yield b'retry: 3000\n\n'
+    if missed:
+        yield encode_event(broker.event_id(after), RESET_EVENT, {})
+    deadline = time.monotonic() + EVENT_STREAM_SECONDS
+    while time.monotonic() < deadline:
+        events, missed = broker.wait(after, EVENT_HEARTBEAT)
+        if not events:
+            yield b': keepalive\n\n'
+            continue
+        after = events[-1].sequence
+        if missed:
+            # The client reloads anyway, so the events themselves are moot
+            yield encode_event(broker.event_id(after), RESET_EVENT, {})
+            continue
+        for item in events:
+            if topics is None or item.topics & topics:
+                yield item.message
@@ -0,0 +1,163 @@
+import os
+import re
+import signal
+import time
+import zipfile
+from xml.etree import ElementTree
+
+# Post-upload processing stages. Everything here runs in worker processes,
+# so it only takes plain paths and returns plain dicts; it must not touch
+# the database or the Flask app.
+
+# Extracted text is cut off here; it only feeds the search index
+MAX_TEXT_CHARS = 200000
+PREVIEW_SIZE = (320, 320)
+
+class StageSkipped(Exception):
+    """A stage that cannot run in this installation, e.g. without its library"""
+
+class StageTimeout(Exception):
+    """A stage that ran past its time limit and was stopped"""
+
+STAGES_BY_EXTENSION = {
+    'pdf': ['extract', 'preview'],
+    'docx': ['extract'],
+    'xlsx': ['extract'],
+    'pptx': ['extract'],
+    'txt': ['extract'],
+    'png': ['preview'],
+    'jpg': ['preview'],
+    'jpeg': ['preview'],
+    'gif': ['preview'],
+}
+
+def stages_for(filename):
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return STAGES_BY_EXTENSION.get(extension, [])
+
+def _xml_text(data):
+    """Concatenate the text nodes of an Office Open XML part"""
+    root = ElementTree.fromstring(data)
+    return ' '.join(node.text.strip() for node in root.iter() if node.text and node.text.strip())
+
+def _natural_key(name):
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+def extract_docx(path):
+    with zipfile.ZipFile(path) as archive:
+        text = _xml_text(archive.read('word/document.xml'))
+        pages = None
+        if 'docProps/app.xml' in archive.namelist():
+            match = re.search(rb'<Pages>(\d+)</Pages>', archive.read('docProps/app.xml'))
+            pages = int(match.group(1)) if match else None
+    return {'text': text, 'page_count': pages}
+
+def extract_xlsx(path):
+    with zipfile.ZipFile(path) as archive:
+        names = archive.namelist()
+        workbook = archive.read('xl/workbook.xml')
+        sheet_count = len(re.findall(rb'<(?:\w+:)?sheet\b', workbook))
+        parts = []
+        if 'xl/sharedStrings.xml' in names:
+            parts.append(_xml_text(archive.read('xl/sharedStrings.xml')))
+        for name in sorted((n for n in names if n.startswith('xl/worksheets/sheet')), key=_natural_key):
+            parts.append(_xml_text(archive.read(name)))
+            if sum(len(part) for part in parts) > MAX_TEXT_CHARS:
+                break
+    return {'text': ' '.join(parts), 'sheet_count': sheet_count}
+
+def extract_pptx(path):
+    with zipfile.ZipFile(path) as archive:
+        slides = sorted(
+            (n for n in archive.namelist() if re.match(r'ppt/slides/slide\d+\.xml$', n)),
+            key=_natural_key
+        )
+        text = ' '.join(_xml_text(archive.read(name)) for name in slides)
+    return {'text': text, 'page_count': len(slides)}
+
+def extract_pdf(path):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise StageSkipped('pypdf is not installed')
+
+    reader = PdfReader(path)
+    parts = []
+    for page in reader.pages:
+        parts.append(page.extract_text() or '')
+        if sum(len(part) for part in parts) > MAX_TEXT_CHARS:
+            break
+    return {'text': '\n'.join(parts), 'page_count': len(reader.pages)}
+
+def extract_txt(path):
+    with open(path, 'rb') as source:
+        data = source.read(MAX_TEXT_CHARS * 4)
+    return {'text': data.decode('utf-8', errors='replace')}
+
+EXTRACTORS = {
+    'pdf': extract_pdf,
+    'docx': extract_docx,
+    'xlsx': extract_xlsx,
+    'pptx': extract_pptx,
+    'txt': extract_txt,
+}
+
+def _pdf_first_page(path):
+    try:
+        import pypdfium2
+    except ImportError:
+        raise StageSkipped('pypdfium2 is not installed')
+
+    pdf = pypdfium2.PdfDocument(path)
+    try:
+        page = pdf[0]
+        # Render at about the preview size instead of full resolution
+        scale = max(PREVIEW_SIZE) / max(page.get_size())
+        return page.render(scale=min(scale, 1.0)).to_pil()
+    finally:
+        pdf.close()
+
+def make_preview(path, destination, extension):
+    try:
+        from PIL import Image
+    except ImportError:
+        raise StageSkipped('Pillow is not installed')
+
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    image = _pdf_first_page(path) if extension == 'pdf' else Image.open(path)
+    with image:
+        image.thumbnail(PREVIEW_SIZE)
+        image.convert('RGB').save(destination, 'PNG')
+    return {'preview_path': destination}
+
+def _time_limit_exceeded(signum, frame):
+    raise StageTimeout('Processing took too long and was stopped')
+
+def run_stage(stage, path, filename, preview_destination=None, timeout=None):
+    """Run one processing stage for a stored file and return its results.
+
+    A stage still running after timeout seconds is interrupted with
+    StageTimeout. duration_ms in the result is the time spent inside the
+    worker.
+    """
+    # Pool workers run stages on their main thread, where an alarm can
+    # interrupt them; platforms without SIGALRM rely on the dispatcher
+    limited = timeout and hasattr(signal, 'SIGALRM')
+    if limited:
+        signal.signal(signal.SIGALRM, _time_limit_exceeded)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        started = time.perf_counter()
+        extension = filename.rsplit('.', 1)[-1].lower()
+        if stage == 'extract':
+            result = EXTRACTORS[extension](path)
+            result['text'] = result.get('text', '')[:MAX_TEXT_CHARS]
+        elif stage == 'preview':
+            result = make_preview(path, preview_destination, extension)
+        else:
+            raise ValueError(f'Unknown processing stage {stage}')
+        result['duration_ms'] = int((time.perf_counter() - started) * 1000)
+        return result
+    finally:
+        if limited:
+            signal.setitimer(signal.ITIMER_REAL, 0)
@@ -1 +1,105 @@
-{"status":500,"name":"Error","message":"Input buffer contains unsupported image format"}
\ No newline at end of file
+import os
+import sys
+# DON'T CHANGE THIS !!!
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from flask import Flask, Request, send_from_directory
+from flask_cors import CORS
+from src.models.user import db, rebuild_tree_paths, rebuild_question_stats
+from src.migrations import run_migrations
+from src.database import get_database_uri, init_database
+from src.metrics import init_metrics
+from src.routes.user import user_bp
+from src.routes.documents import documents_bp
+from src.routes.folders import folders_bp
+from src.routes.qa import qa_bp
+from src.routes.search import search_bp
+from src.routes.admin import admin_bp
+from src.routes.events import events_bp
+from src.routes.changes import changes_bp
+from src.routes.audit import audit_bp
+from src.search import ensure_search_index
+from src.processing import init_processing
+from src.audit import init_audit
+from src.static_assets import init_static_assets, has_asset, asset_response
+from src.storage import HashingSpool
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Uploaded files go straight to the partial folder, hashed as they
+        # arrive, instead of a temp file that would be copied again
+        return HashingSpool()
+
+app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
+app.request_class = UploadRequest
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'asdf#FGSgvasgf$5$WGT')
+
+CORS(app, supports_credentials=True)
+
+app.register_blueprint(user_bp, url_prefix='/api')
+app.register_blueprint(documents_bp, url_prefix='/api')
+app.register_blueprint(folders_bp, url_prefix='/api')
+app.register_blueprint(qa_bp, url_prefix='/api')
+app.register_blueprint(search_bp, url_prefix='/api')
+app.register_blueprint(admin_bp, url_prefix='/api')
+app.register_blueprint(events_bp, url_prefix='/api')
+app.register_blueprint(changes_bp, url_prefix='/api')
+app.register_blueprint(audit_bp, url_prefix='/api')
+
+app.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri()
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Pools, SQLite pragmas, the optional read replica and retries for read views
+init_database(app)
+# Route latency, SQL per request and Server-Timing headers
+init_metrics(app)
+
+def start_services(app):
+    """Prepare the database and start the background threads of this process"""
+    uploads_dir = os.environ.get('UPLOADS_DIR', '/tmp/vdr_uploads')
+    os.makedirs(uploads_dir, exist_ok=True)
+    
+    with app.app_context():
+        db.create_all()
+        # Bring databases created by earlier versions up to the current schema
+        run_migrations()
+        # Backfill derived columns for rows created before they existed
+        rebuild_tree_paths()
+        rebuild_question_stats()
+        ensure_search_index()
+    
+    init_processing(app)
+    # Batched, write-behind recording of document views and downloads
+    init_audit(app)
+    # Precompressed, cache-friendly serving of the built frontend
+    init_static_assets(app.static_folder)
+
+# The processing pool spawns its workers, and each one imports this file
+# again as __mp_main__ when the app runs as `python src/main.py`. Workers
+# only run extractors, so they skip startup and never open the database.
+if __name__ != '__mp_main__':
+    start_services(app)
+
+@app.route('/', defaults={'path': ''})
+@app.route('/<path:path>')
+def serve(path):
+    static_folder_path = app.static_folder
+    if static_folder_path is None:
+        return "Static folder not configured", 404
+
+    if path != "" and has_asset(path):
+        return asset_response(path)
+    elif path != "" and os.path.exists(os.path.join(static_folder_path, path)):
+        # Added after startup, so not indexed
+        return send_from_directory(static_folder_path, path)
+    elif has_asset('index.html'):
+        return asset_response('index.html')
+    else:
+        index_path = os.path.join(static_folder_path, 'index.html')
+        if os.path.exists(index_path):
+            return send_from_directory(static_folder_path, 'index.html')
+        else:
+            return "index.html not found", 404
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5002)), debug=False)
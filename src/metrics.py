@@ -0,0 +1,266 @@
+import logging
+import os
+import re
+import threading
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Per-request instrumentation: latency per route, SQL statements and time
+# spent in the database per request, bytes in and out, and a log of slow
+# statements. Collected in process and rendered in the Prometheus text
+# format by GET /api/metrics; each response also gets a Server-Timing
+# header. Statement timing is two clock reads per statement and a request
+# takes the metrics lock once, so this stays on in production.
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+# Distinct slow statements tracked; later ones are counted as OTHER_STATEMENT
+MAX_SLOW_STATEMENTS = 100
+MAX_STATEMENT_LENGTH = 500
+OTHER_STATEMENT = '<other>'
+UNMATCHED_ROUTE = '<unmatched>'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+ROUTE_KEY = 'vdr.metrics_route'
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PARAMETER_LIST = re.compile(r'\(\s*(?:\?|%\(\w+\)s|%s|:\w+)(?:\s*,\s*(?:\?|%\(\w+\)s|%s|:\w+))*\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+class Histogram:
+    """Cumulative-bucket histogram per label set, in Prometheus form"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        counts = self.series.get(labels)
+        if counts is None:
+            # One slot per bucket, then +Inf, sum
+            counts = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+        counts[-2] += 1
+        counts[-1] += value
+
+    def render(self, name, label_names):
+        lines = []
+        for labels, counts in sorted(self.series.items()):
+            base = _labels(label_names, labels)
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{name}_bucket{{{base},le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{base},le="+Inf"}} {counts[-2]}')
+            lines.append(f'{name}_sum{{{base}}} {round(counts[-1], 6)}')
+            lines.append(f'{name}_count{{{base}}} {counts[-2]}')
+        return lines
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+_lock = threading.Lock()
+_latency = Histogram(LATENCY_BUCKETS)
+_statements = Histogram(STATEMENT_BUCKETS)
+_requests = {}
+_db_seconds = {}
+_bytes_in = {}
+_bytes_out = {}
+# normalized statement -> [count, total seconds, max seconds]
+_slow = {}
+
+def _add(counter, labels, value):
+    counter[labels] = counter.get(labels, 0) + value
+
+def normalize_statement(statement):
+    """Statement text with literals and parameter lists folded, for grouping"""
+    text = _STRING_LITERAL.sub('?', statement)
+    text = _NUMBER_LITERAL.sub('?', text)
+    text = _PARAMETER_LIST.sub('(?)', text)
+    return _WHITESPACE.sub(' ', text).strip()[:MAX_STATEMENT_LENGTH]
+
+def _record_slow(statement, seconds):
+    normalized = normalize_statement(statement)
+    route = getattr(g, 'metrics_route', None) if has_request_context() else None
+    logger.warning('Slow query (%.1f ms) on %s: %s', seconds * 1000, route or 'background', normalized)
+    with _lock:
+        if normalized not in _slow and len(_slow) >= MAX_SLOW_STATEMENTS:
+            normalized = OTHER_STATEMENT
+        stats = _slow.setdefault(normalized, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _statement_started(connection, cursor, statement, parameters, context, executemany):
+    # Kept on the statement's own context: threads can share one connection,
+    # as with the StaticPool of an in-memory SQLite database
+    if context is not None:
+        context._metrics_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _statement_finished(connection, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_metrics_started', None)
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    if has_request_context() and 'metrics_started' in g:
+        g.metrics_statements += 1
+        g.metrics_db_seconds += seconds
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        _record_slow(statement, seconds)
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else UNMATCHED_ROUTE
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+    g.metrics_statements = 0
+    g.metrics_db_seconds = 0.0
+    g.metrics_route = _route()
+    request.environ[ROUTE_KEY] = g.metrics_route
+
+def _server_timing(response):
+    if 'metrics_started' not in g:
+        return response
+    g.metrics_status = response.status_code
+    elapsed = (time.perf_counter() - g.metrics_started) * 1000
+    response.headers.add(
+        'Server-Timing',
+        f'db;dur={g.metrics_db_seconds * 1000:.1f};desc="{g.metrics_statements} queries", app;dur={elapsed:.1f}'
+    )
+    return response
+
+def _finish_request(error=None):
+    if 'metrics_started' not in g:
+        return
+    seconds = time.perf_counter() - g.metrics_started
+    route, method = g.metrics_route, request.method
+    status = g.get('metrics_status', 500)
+    with _lock:
+        _latency.observe((route, method), seconds)
+        _statements.observe((route, method), g.metrics_statements)
+        _add(_requests, (route, method, str(status)), 1)
+        _add(_db_seconds, (route, method), g.metrics_db_seconds)
+        _add(_bytes_in, (route, method), request.content_length or 0)
+
+class ByteCountingMiddleware:
+    """Count response bytes per route, including streamed bodies.
+
+    Responses with a Content-Length are counted from the header, so file
+    responses keep any wsgi.file_wrapper the server offers; only bodies of
+    unknown length are wrapped and counted as they are sent.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        length = []
+
+        def counting_start_response(status, headers, exc_info=None):
+            for name, value in headers:
+                if name.lower() == 'content-length':
+                    length.append(int(value))
+            return start_response(status, headers, exc_info)
+
+        body = self.wsgi_app(environ, counting_start_response)
+        route = environ.get(ROUTE_KEY)
+        if route is None:
+            return body
+        if length:
+            _count_bytes_out(route, environ['REQUEST_METHOD'], length[0])
+            return body
+        return _CountingBody(body, route, environ['REQUEST_METHOD'])
+
+class _CountingBody:
+    def __init__(self, body, route, method):
+        self.body = body
+        self.route = route
+        self.method = method
+        self.sent = 0
+
+    def __iter__(self):
+        for block in self.body:
+            self.sent += len(block)
+            yield block
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            _count_bytes_out(self.route, self.method, self.sent)
+
+def _count_bytes_out(route, method, size):
+    with _lock:
+        _add(_bytes_out, (route, method), size)
+
+def render_metrics():
+    """Everything collected so far in the Prometheus text exposition format"""
+    from src.database import pool_metrics
+    from src.audit import audit_status
+    route_labels = ('route', 'method')
+    lines = []
+
+    def block(name, kind, help_text, body):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(body)
+
+    def counter(name, values, label_names):
+        return [f'{name}{{{_labels(label_names, labels)}}} {round(value, 6)}' for labels, value in sorted(values.items())]
+
+    with _lock:
+        block('vdr_http_request_duration_seconds', 'histogram', 'Time to produce a response, per route.',
+              _latency.render('vdr_http_request_duration_seconds', route_labels))
+        block('vdr_http_requests_total', 'counter', 'Requests by route and status.',
+              counter('vdr_http_requests_total', _requests, ('route', 'method', 'status')))
+        block('vdr_db_statements_per_request', 'histogram', 'SQL statements run by one request.',
+              _statements.render('vdr_db_statements_per_request', route_labels))
+        block('vdr_db_seconds_total', 'counter', 'Time spent executing SQL, per route.',
+              counter('vdr_db_seconds_total', _db_seconds, route_labels))
+        block('vdr_http_request_bytes_total', 'counter', 'Request body bytes received, e.g. uploads.',
+              counter('vdr_http_request_bytes_total', _bytes_in, route_labels))
+        block('vdr_http_response_bytes_total', 'counter', 'Response body bytes sent, e.g. downloads and archives.',
+              counter('vdr_http_response_bytes_total', _bytes_out, route_labels))
+        slow = sorted(_slow.items())
+        block('vdr_db_slow_statements_total', 'counter', f'Statements slower than {SLOW_QUERY_MS:g} ms.',
+              [f'vdr_db_slow_statements_total{{statement="{_escape(text)}"}} {stats[0]}' for text, stats in slow])
+        block('vdr_db_slow_statement_seconds_max', 'gauge', 'Slowest run of each slow statement.',
+              [f'vdr_db_slow_statement_seconds_max{{statement="{_escape(text)}"}} {round(stats[2], 6)}' for text, stats in slow])
+
+    pool = pool_metrics.snapshot()
+    # PoolMetrics buckets are already cumulative
+    buckets = [f'vdr_db_pool_checkout_seconds_bucket{{le="{bound}"}} {count}' for bound, count in pool['wait_buckets'].items()]
+    block('vdr_db_pool_checkout_seconds', 'histogram', 'Wait for a pooled connection.', buckets + [
+        f'vdr_db_pool_checkout_seconds_bucket{{le="+Inf"}} {pool["checkouts"]}',
+        f'vdr_db_pool_checkout_seconds_sum {pool["wait_seconds_total"]}',
+        f'vdr_db_pool_checkout_seconds_count {pool["checkouts"]}'
+    ])
+    block('vdr_db_pool_timeouts_total', 'counter', 'Checkouts that gave up waiting.',
+          [f'vdr_db_pool_timeouts_total {pool["timeouts"]}'])
+
+    audit = audit_status()
+    if audit['running']:
+        block('vdr_audit_queued_events', 'gauge', 'Access events waiting to be written.',
+              [f'vdr_audit_queued_events {audit["queued"]}'])
+        block('vdr_audit_events_total', 'counter', 'Access events by outcome.', [
+            f'vdr_audit_events_total{{outcome="{outcome}"}} {audit[outcome]}'
+            for outcome in ('written', 'dropped', 'failed')
+        ])
+    return '\n'.join(lines) + '\n'
+
+def init_metrics(app):
+    """Time every request of app and count its SQL and bytes"""
+    app.before_request(_start_request)
+    app.after_request(_server_timing)
+    app.teardown_request(_finish_request)
+    app.wsgi_app = ByteCountingMiddleware(app.wsgi_app)
@@ -0,0 +1,258 @@
+import argparse
+import logging
+import sys
+from datetime import datetime
+from sqlalchemy import BigInteger, func, insert, inspect, literal, select, text, update
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.exc import IntegrityError
+from src.models.user import (
+    db, Folder, Document, Question, Answer, SchemaMigration, ChangeLogEntry, ChangeFeedState, UploadSession,
+    add_missing_columns
+)
+
+logger = logging.getLogger(__name__)
+
+# Versioned, forward-only schema migrations.
+#
+# db.create_all() builds a fresh database straight from the models, so every
+# migration must also be a harmless no-op on one. Deployed databases run each
+# migration once, in version order and in a transaction of its own, and the
+# version is recorded in schema_migration. A shipped migration is never
+# edited or removed: a schema change means changing the model and appending
+# a new migration that brings existing databases in line with it.
+
+MIGRATIONS = []
+
+def migration(version, name):
+    """Register fn as the migration with the given version"""
+    def decorator(fn):
+        if MIGRATIONS and version <= MIGRATIONS[-1][0]:
+            raise ValueError(f'Migration {version} must come after {MIGRATIONS[-1][0]}')
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return decorator
+
+def declared_index(name):
+    """The Index or UniqueConstraint called name in the model metadata"""
+    for table in db.metadata.tables.values():
+        for item in list(table.indexes) + list(table.constraints):
+            if item.name == name:
+                return item
+    raise KeyError(name)
+
+def create_indexes(connection, *names):
+    """Create declared indexes that the database does not have yet"""
+    for name in names:
+        declared_index(name).create(connection, checkfirst=True)
+
+def create_unique_index(connection, name):
+    """Enforce a declared UniqueConstraint on an existing table.
+
+    SQLite cannot add constraints to a table in place, so a unique index
+    with the constraint's name stands in for it on every backend.
+    """
+    constraint = declared_index(name)
+    table = constraint.table
+    inspector = inspect(connection)
+    existing = {index['name'] for index in inspector.get_indexes(table.name)}
+    existing.update(unique['name'] for unique in inspector.get_unique_constraints(table.name))
+    if name in existing:
+        return
+    preparer = connection.dialect.identifier_preparer
+    columns = ', '.join(preparer.quote(column.name) for column in constraint.columns)
+    connection.execute(text(
+        f'CREATE UNIQUE INDEX {preparer.quote(name)} ON {preparer.format_table(table)} ({columns})'
+    ))
+
+@migration(1, 'columns_and_indexes_before_versioning')
+def _baseline(connection):
+    # Everything the unversioned startup used to add in place
+    add_missing_columns(connection)
+
+@migration(2, 'hot_filter_indexes')
+def _hot_filter_indexes(connection):
+    create_indexes(
+        connection,
+        'ix_document_folder_listing',
+        'ix_answer_question_id_answered_at',
+        'ix_question_asked_at'
+    )
+
+@migration(3, 'unique_folder_names_per_parent')
+def _unique_folder_names(connection):
+    # Sibling folders may share a name from before the constraint existed.
+    # The oldest keeps it and the others get a numbered suffix.
+    duplicates = connection.execute(
+        select(Folder.parent_id, Folder.name)
+        .group_by(Folder.parent_id, Folder.name)
+        .having(func.count(Folder.id) > 1)
+    ).all()
+    for parent_id, name in duplicates:
+        siblings = connection.execute(
+            select(Folder.id, Folder.name).where(Folder.parent_id.is_(None) if parent_id is None else Folder.parent_id == parent_id)
+        ).all()
+        taken = {sibling_name for _, sibling_name in siblings}
+        clashing = sorted(folder_id for folder_id, sibling_name in siblings if sibling_name == name)
+        suffix = 2
+        for folder_id in clashing[1:]:
+            while f'{name} ({suffix})' in taken:
+                suffix += 1
+            renamed = f'{name} ({suffix})'
+            taken.add(renamed)
+            connection.execute(update(Folder).where(Folder.id == folder_id).values(name=renamed))
+            logger.warning('Renamed duplicate folder %s from %r to %r', folder_id, name, renamed)
+    create_unique_index(connection, 'uq_folder_parent_name')
+
+@migration(4, 'change_log_backfill')
+def _change_log_backfill(connection):
+    # Rows from before the change log get an entry so a full sync from
+    # since=0 returns them; a fresh database has no rows to add
+    now = datetime.utcnow()
+    for entity, model in (('folder', Folder), ('document', Document), ('question', Question), ('answer', Answer)):
+        logged = select(ChangeLogEntry.entity_id).where(ChangeLogEntry.entity == entity)
+        connection.execute(insert(ChangeLogEntry).from_select(
+            ['entity', 'entity_id', 'deleted', 'changed_at'],
+            select(literal(entity), model.id, literal(False), literal(now))
+            .where(model.id.not_in(logged))
+            .order_by(model.id)
+        ))
+
+def add_columns(connection, table, *names):
+    """Add declared columns that an existing table does not have yet"""
+    existing = {column['name'] for column in inspect(connection).get_columns(table.name)}
+    preparer = connection.dialect.identifier_preparer
+    for name in names:
+        if name not in existing:
+            ddl = CreateColumn(table.c[name]).compile(dialect=connection.dialect)
+            connection.execute(text(f'ALTER TABLE {preparer.format_table(table)} ADD {ddl}'))
+
+@migration(5, 'change_log_commit_order')
+def _change_log_commit_order(connection):
+    add_columns(connection, ChangeLogEntry.__table__, 'commit_seq')
+    add_columns(connection, ChangeFeedState.__table__, 'last_commit_seq')
+    if connection.dialect.name == 'mssql':
+        connection.execute(text('ALTER TABLE change_feed_state ALTER COLUMN pruned_through BIGINT NOT NULL'))
+    create_indexes(connection, 'ix_change_log_entry_commit_seq')
+    # Entries logged so far keep their id as cursor, so clients carry on
+    # from the cursor they hold
+    connection.execute(
+        update(ChangeLogEntry).where(ChangeLogEntry.commit_seq.is_(None)).values(commit_seq=ChangeLogEntry.id)
+    )
+    highest = connection.execute(select(func.max(ChangeLogEntry.commit_seq))).scalar() or 0
+    state = connection.execute(select(ChangeFeedState.pruned_through).where(ChangeFeedState.id == 1)).first()
+    if state is None:
+        connection.execute(insert(ChangeFeedState).values(id=1, pruned_through=0, last_commit_seq=highest))
+    else:
+        highest = max(highest, state.pruned_through)
+        connection.execute(update(ChangeFeedState).where(ChangeFeedState.id == 1).values(last_commit_seq=highest))
+
+@migration(6, 'document_file_size_bigint')
+def _document_file_size_bigint(connection):
+    # file_size used to be INT, which overflows for files over 2 GB. SQLite
+    # stores any integer in an INTEGER column, so only SQL Server changes.
+    if connection.dialect.name != 'mssql':
+        return
+    column = next(c for c in inspect(connection).get_columns('document') if c['name'] == 'file_size')
+    if isinstance(column['type'], BigInteger):
+        return
+    # SQL Server cannot change a column that an index covers
+    listing = declared_index('ix_document_folder_listing')
+    listing.drop(connection, checkfirst=True)
+    connection.execute(text('ALTER TABLE document ALTER COLUMN file_size BIGINT NOT NULL'))
+    listing.create(connection)
+
+@migration(7, 'upload_session_write_lease')
+def _upload_session_write_lease(connection):
+    add_columns(connection, UploadSession.__table__, 'writer_token', 'writing_until')
+
+def applied_versions():
+    return set(db.session.execute(select(SchemaMigration.version)).scalars())
+
+def run_migrations():
+    """Apply pending migrations in order; needs an app context and create_all first"""
+    applied = applied_versions()
+    db.session.commit()
+    for version, name, fn in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info('Applying migration %s %s', version, name)
+        try:
+            with db.engine.begin() as connection:
+                fn(connection)
+                connection.execute(insert(SchemaMigration).values(
+                    version=version, name=name, applied_at=datetime.utcnow()
+                ))
+        except IntegrityError:
+            # Another worker starting at the same time recorded it first
+            if version not in applied_versions():
+                raise
+            db.session.commit()
+
+# Query-plan checks. Each hot query must be answered by an index seek:
+# SQLite reports a SEARCH on the index, never a SCAN of the table or a
+# temporary B-tree to sort. Run against a fresh SQLite database with
+#   python -m src.migrations --check-plans
+
+HOT_QUERIES = [
+    ('documents in a folder', 'ix_document_folder_listing',
+     lambda: select(Document.id).where(Document.folder_id == 1, Document.id > 10).order_by(Document.id).limit(100)),
+    ('document counts and sizes per folder', 'ix_document_folder_listing',
+     lambda: select(Document.folder_id, func.count(Document.id), func.sum(Document.file_size))
+     .where(Document.folder_id.in_([1, 2, 3])).group_by(Document.folder_id)),
+    ('subfolders of a folder', 'uq_folder_parent_name',
+     lambda: select(Folder.id).where(Folder.parent_id == 1).order_by(Folder.name, Folder.id).limit(100)),
+    ('folder name in use', 'uq_folder_parent_name',
+     lambda: select(Folder.id).where(Folder.parent_id == 1, Folder.name == 'Reports')),
+    ('answers to a question', 'ix_answer_question_id_answered_at',
+     lambda: select(Answer.id).where(Answer.question_id == 1).order_by(Answer.answered_at, Answer.id)),
+    ('questions by date asked', 'ix_question_asked_at',
+     lambda: select(Question.id).order_by(Question.asked_at.desc(), Question.id.desc()).limit(100))
+]
+
+def query_plan(statement):
+    """EXPLAIN QUERY PLAN detail lines of a statement, SQLite only"""
+    sql = statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+    return [row[-1] for row in db.session.execute(text(f'EXPLAIN QUERY PLAN {sql}'))]
+
+def check_query_plans():
+    """Return (label, plan) for every hot query not served by its index"""
+    if db.engine.dialect.name != 'sqlite':
+        raise RuntimeError('Query plans can only be checked on SQLite')
+    failures = []
+    for label, index_name, build in HOT_QUERIES:
+        plan = query_plan(build())
+        uses_index = any(index_name in line for line in plan)
+        # Aliases of the sqlite_autoindex created for an inline UNIQUE constraint
+        uses_index = uses_index or (index_name.startswith('uq_') and any('sqlite_autoindex' in line for line in plan))
+        scans = any(line.startswith('SCAN') and 'INDEX' not in line for line in plan)
+        sorts = any('TEMP B-TREE' in line for line in plan)
+        if not uses_index or scans or sorts:
+            failures.append((label, plan))
+    return failures
+
+def main(argv=None):
+    from flask import Flask
+    from src.database import init_database
+
+    parser = argparse.ArgumentParser(description='Apply pending schema migrations')
+    parser.add_argument('--check-plans', action='store_true', help='also verify the hot queries use their indexes')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    app = Flask(__name__)
+    init_database(app)
+    with app.app_context():
+        db.create_all()
+        run_migrations()
+        if not args.check_plans:
+            return 0
+        failures = check_query_plans()
+        for label, plan in failures:
+            print(f'{label}: not served by its index')
+            for line in plan:
+                print(f'    {line}')
+        print(f'{len(HOT_QUERIES) - len(failures)}/{len(HOT_QUERIES)} hot queries use their index')
+        return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,13 @@
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import select, func, union_all, literal, literal_column, update, delete, case, inspect, text, String
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from sqlalchemy.schema import CreateColumn
+from src.passwords import hash_password, verify_password
+from src.database import RoutingSession
 from datetime import datetime
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -13,10 +18,10 @@ class User(db.Model):
     is_admin = db.Column(db.Boolean, default=False)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
 
     def __repr__(self):
         return f'<User {self.username}>'
@@ -37,60 +42,187 @@ class Folder(db.Model):
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     description = db.Column(db.Text)
+    # Materialized path of ids from the root down to this folder, e.g. "/1/5/9/"
+    tree_path = db.Column(db.String(450), index=True)
+    depth = db.Column(db.Integer, default=0)
 
     parent = db.relationship('Folder', remote_side=[id], backref='subfolders')
     creator = db.relationship('User', backref='created_folders')
 
+    __table_args__ = (
+        # Also serves listings by parent, which order by name
+        db.UniqueConstraint('parent_id', 'name', name='uq_folder_parent_name'),
+    )
+
     def get_path(self):
         """Get the full path of the folder"""
-        if self.parent:
-            return f"{self.parent.get_path()}/{self.name}"
-        return self.name
+        return '/'.join(folder.name for folder in self.ancestors(include_self=True)) or self.name
+
+    def ancestor_ids(self, include_self=False):
+        """Ids from the root down to this folder, read from tree_path"""
+        ids = [int(part) for part in (self.tree_path or '').strip('/').split('/') if part]
+        return ids if include_self else ids[:-1]
+
+    def ancestors(self, include_self=False):
+        """Load the ancestors of this folder, root first, in one query"""
+        ids = self.ancestor_ids(include_self)
+        if not ids:
+            return []
+        return Folder.query.filter(Folder.id.in_(ids)).order_by(Folder.depth).all()
+
+    def descendants(self, include_self=False):
+        """Query every folder below this one with one range scan on tree_path"""
+        lower, upper = subtree_bounds(self.tree_path)
+        lower_bound = Folder.tree_path >= lower if include_self else Folder.tree_path > lower
+        return Folder.query.filter(lower_bound, Folder.tree_path < upper)
+
+    def is_within(self, other):
+        """Check whether this folder is other or lies somewhere below it"""
+        return bool(self.tree_path and other.tree_path) and self.tree_path.startswith(other.tree_path)
+
+    def place_under(self, parent):
+        """Set parent and tree_path for a new folder; the folder must be flushed first"""
+        self.parent_id = parent.id if parent else None
+        self.tree_path = f"{parent.tree_path if parent else '/'}{self.id}/"
+        self.depth = parent.depth + 1 if parent else 0
+
+    def move_to(self, parent):
+        """Re-parent the folder and rewrite the tree_path of its subtree in one UPDATE"""
+        old_path, old_depth = self.tree_path, self.depth
+        self.place_under(parent)
+        lower, upper = subtree_bounds(old_path)
+        db.session.execute(
+            update(Folder)
+            .where(Folder.tree_path > lower, Folder.tree_path < upper)
+            .values(
+                tree_path=literal(self.tree_path, String) + func.substring(
+                    Folder.tree_path, len(old_path) + 1, func.char_length(Folder.tree_path)
+                ),
+                depth=Folder.depth + (self.depth - old_depth)
+            )
+            .execution_options(synchronize_session=False)
+        )
 
     def to_dict(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'parent_id': self.parent_id,
-            'parent_name': self.parent.name if self.parent else None,
-            'path': self.get_path(),
-            'created_by': self.created_by,
-            'creator_name': self.creator.username if self.creator else None,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'description': self.description,
-            'subfolder_count': len(self.subfolders),
-            'document_count': len(self.documents)
-        }
+        return serialize_folders([self])[0]
 
 class Document(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     original_filename = db.Column(db.String(255), nullable=False)
     file_path = db.Column(db.String(500), nullable=False)
-    file_size = db.Column(db.Integer, nullable=False)
+    file_size = db.Column(db.BigInteger, nullable=False)
     mime_type = db.Column(db.String(100), nullable=False)
     uploaded_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
     description = db.Column(db.Text)
     folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=True)
+    # Hex SHA-256 of the file contents, computed while the upload streams in
+    content_hash = db.Column(db.String(64), index=True)
+    # Background processing: pending, processing, ready or failed
+    processing_status = db.Column(db.String(20))
+    page_count = db.Column(db.Integer)
+    sheet_count = db.Column(db.Integer)
+    preview_path = db.Column(db.String(500))
 
     uploader = db.relationship('User', backref='uploaded_documents')
     folder = db.relationship('Folder', backref='documents')
 
+    __table_args__ = (
+        # Listings page through a folder by id; file_size makes the
+        # per-folder counts and sizes answerable from the index alone
+        db.Index('ix_document_folder_listing', 'folder_id', 'id', 'file_size'),
+    )
+
+    def to_dict(self):
+        return serialize_documents([self])[0]
+
+class ProcessingJob(db.Model):
+    """One post-upload processing stage for a document, queued in the database"""
+    id = db.Column(db.Integer, primary_key=True)
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), nullable=False, index=True)
+    stage = db.Column(db.String(20), nullable=False)
+    # queued, running, done, skipped or failed
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    available_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(64))
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    duration_ms = db.Column(db.Integer)
+
+    __table_args__ = (
+        db.Index('ix_processing_job_claim', 'status', 'available_at'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'document_id': self.document_id,
+            'stage': self.stage,
+            'status': self.status,
+            'attempts': self.attempts,
+            'last_error': self.last_error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'duration_ms': self.duration_ms
+        }
+
+class Blob(db.Model):
+    """A stored file, shared by every document with the same contents"""
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UploadSession(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    original_filename = db.Column(db.String(255), nullable=False)
+    mime_type = db.Column(db.String(100), nullable=False)
+    description = db.Column(db.Text)
+    folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=True)
+    uploaded_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    total_size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    received_size = db.Column(db.BigInteger, default=0, nullable=False)
+    next_chunk = db.Column(db.Integer, default=0, nullable=False)
+    # Set when the client announced contents that are already stored
+    content_hash = db.Column(db.String(64))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Lease of the request, in any process, that is writing a chunk or
+    # completing the upload
+    writer_token = db.Column(db.String(32))
+    writing_until = db.Column(db.DateTime)
+
+    @property
+    def chunk_count(self):
+        return max(1, -(-self.total_size // self.chunk_size))
+
+    def chunk_length(self, index):
+        """Expected byte length of chunk number index"""
+        return min(self.chunk_size, self.total_size - index * self.chunk_size)
+
     def to_dict(self):
         return {
             'id': self.id,
-            'filename': self.filename,
             'original_filename': self.original_filename,
-            'file_size': self.file_size,
             'mime_type': self.mime_type,
-            'uploaded_by': self.uploaded_by,
-            'uploader_name': self.uploader.username if self.uploader else None,
-            'uploaded_at': self.uploaded_at.isoformat() if self.uploaded_at else None,
-            'description': self.description,
             'folder_id': self.folder_id,
-            'folder_name': self.folder.name if self.folder else None,
-            'folder_path': self.folder.get_path() if self.folder else None
+            'total_size': self.total_size,
+            'chunk_size': self.chunk_size,
+            'chunk_count': self.chunk_count,
+            'received_size': self.received_size,
+            'next_chunk': self.next_chunk,
+            'complete': self.received_size == self.total_size,
+            'duplicate': self.content_hash is not None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
 
 class Question(db.Model):
@@ -100,20 +232,20 @@ class Question(db.Model):
     asked_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     asked_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_answered = db.Column(db.Boolean, default=False)
+    # Denormalized from the answer table so listings never have to touch it
+    answer_count = db.Column(db.Integer, default=0)
+    last_activity_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     asker = db.relationship('User', backref='questions')
 
+    __table_args__ = (
+        db.Index('ix_question_activity', 'is_answered', 'last_activity_at'),
+        db.Index('ix_question_last_activity_at', 'last_activity_at'),
+        db.Index('ix_question_asked_at', 'asked_at'),
+    )
+
     def to_dict(self):
-        return {
-            'id': self.id,
-            'title': self.title,
-            'content': self.content,
-            'asked_by': self.asked_by,
-            'asker_name': self.asker.username if self.asker else None,
-            'asked_at': self.asked_at.isoformat() if self.asked_at else None,
-            'is_answered': self.is_answered,
-            'answers': [answer.to_dict() for answer in self.answers]
-        }
+        return serialize_questions([self])[0]
 
 class Answer(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -125,12 +257,516 @@ class Answer(db.Model):
     question = db.relationship('Question', backref='answers')
     answerer = db.relationship('User', backref='answers')
 
+    __table_args__ = (
+        db.Index('ix_answer_question_id_answered_at', 'question_id', 'answered_at'),
+    )
+
     def to_dict(self):
-        return {
-            'id': self.id,
-            'content': self.content,
-            'question_id': self.question_id,
-            'answered_by': self.answered_by,
-            'answerer_name': self.answerer.username if self.answerer else None,
-            'answered_at': self.answered_at.isoformat() if self.answered_at else None
+        return serialize_answers([self])[0]
+
+class SearchEntry(db.Model):
+    """Text indexed for search, one row per document, question or answer"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    ref_id = db.Column(db.Integer, nullable=False)
+    title = db.Column(db.String(255), nullable=False, default='')
+    body = db.Column(db.Text, nullable=False, default='')
+    # Text extracted from the file contents of a document
+    extracted = db.Column(db.Text, nullable=False, default='')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'ref_id', name='uq_search_entry_kind_ref'),
+    )
+
+class SearchTerm(db.Model):
+    """Inverted index postings, used where SQLite FTS5 is not available"""
+    term = db.Column(db.String(64), primary_key=True)
+    entry_id = db.Column(db.Integer, db.ForeignKey('search_entry.id'), primary_key=True, index=True)
+    weight = db.Column(db.Float, nullable=False)
+
+class SchemaMigration(db.Model):
+    """A migration from src.migrations that has been applied to this database"""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ChangeLogEntry(db.Model):
+    """The latest change to one document, folder, question or answer.
+
+    commit_seq is the cursor of the change feed, numbered in commit order
+    once the entry is committed; it is NULL until then. Recording a change
+    deletes the entity's earlier entry, so the log holds one row per entity;
+    deletes stay as tombstones until compacted.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    commit_seq = db.Column(db.BigInteger)
+
+    __table_args__ = (
+        db.Index('ix_change_log_entry_entity', 'entity', 'entity_id'),
+        db.Index('ix_change_log_entry_tombstones', 'deleted', 'changed_at'),
+        db.Index('ix_change_log_entry_commit_seq', 'commit_seq'),
+    )
+
+class ChangeFeedState(db.Model):
+    """Single row; cursors at or below pruned_through may have lost tombstones.
+
+    last_commit_seq is the highest commit_seq handed out so far.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    pruned_through = db.Column(db.BigInteger, nullable=False, default=0)
+    last_commit_seq = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+
+class AccessEvent(db.Model):
+    """One view or download of a document, written in batches by src.audit.
+
+    No foreign keys: the trail outlives deleted documents and users.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    document_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(20), nullable=False)
+    accessed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    ip_address = db.Column(db.String(45))
+
+    __table_args__ = (
+        # Newest-first reports page through these without sorting
+        db.Index('ix_access_event_document', 'document_id', 'accessed_at', 'id'),
+        db.Index('ix_access_event_user', 'user_id', 'accessed_at', 'id'),
+    )
+
+def add_missing_columns(connection):
+    """Add columns and indexes declared on the models but missing from existing tables.
+
+    db.create_all() only creates whole tables, so databases deployed before
+    a column was introduced need it added in place. Runs once, as the first
+    versioned migration; later schema changes get migrations of their own.
+    """
+    inspector = inspect(connection)
+    preparer = connection.dialect.identifier_preparer
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=connection.dialect)
+                connection.execute(text(f"ALTER TABLE {preparer.format_table(table)} ADD {ddl}"))
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+# Blob reference counting. A blob row and its file go away together
+# once no document points at the contents any more.
+
+def acquire_blob(content_hash, size):
+    """Add a document reference to a blob, registering the blob on first use"""
+    increment = update(Blob).where(Blob.sha256 == content_hash).values(ref_count=Blob.ref_count + 1)
+    if db.session.execute(increment).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(Blob(sha256=content_hash, size=size, ref_count=1))
+    except IntegrityError:
+        # Another request registered the same contents first
+        db.session.execute(increment)
+
+def release_blob(content_hash):
+    """Drop a document reference; returns True when the blob became unreferenced"""
+    return content_hash in release_blobs({content_hash: 1})
+
+def release_blobs(counts):
+    """Drop several references at once given {sha256: references}.
+
+    Returns the hashes whose blobs became unreferenced; their files can be
+    removed once the transaction commits.
+    """
+    released = set()
+    # The CASE takes two parameters per hash on top of the IN list
+    for chunk in _chunks(counts, IN_CLAUSE_CHUNK // 2):
+        decrement = case({content_hash: counts[content_hash] for content_hash in chunk}, value=Blob.sha256, else_=0)
+        db.session.execute(
+            update(Blob).where(Blob.sha256.in_(chunk)).values(ref_count=Blob.ref_count - decrement)
+            .execution_options(synchronize_session=False)
+        )
+        unreferenced = select(Blob.sha256).where(Blob.sha256.in_(chunk), Blob.ref_count <= 0)
+        released.update(db.session.execute(unreferenced).scalars())
+        db.session.execute(
+            delete(Blob).where(Blob.sha256.in_(chunk), Blob.ref_count <= 0)
+            .execution_options(synchronize_session=False)
+        )
+    return released
+
+# Question statistics. answer_count, is_answered and last_activity_at are
+# changed with single UPDATE statements in the same transaction as the
+# answer itself, so concurrent answers cannot lose increments.
+
+def record_answer_added(question_id):
+    db.session.execute(
+        update(Question).where(Question.id == question_id).values(
+            answer_count=Question.answer_count + 1,
+            is_answered=True,
+            last_activity_at=datetime.utcnow()
+        ).execution_options(synchronize_session=False)
+    )
+
+def record_answer_removed(question_id):
+    db.session.execute(
+        update(Question).where(Question.id == question_id).values(
+            answer_count=Question.answer_count - 1,
+            is_answered=case((Question.answer_count > 1, True), else_=False)
+        ).execution_options(synchronize_session=False)
+    )
+
+def touch_question(question_id):
+    db.session.execute(
+        update(Question).where(Question.id == question_id).values(
+            last_activity_at=datetime.utcnow()
+        ).execution_options(synchronize_session=False)
+    )
+
+def rebuild_question_stats():
+    """Fill answer_count and last_activity_at for questions created before they existed"""
+    answers = select(func.count(Answer.id)).where(Answer.question_id == Question.id).scalar_subquery()
+    latest = select(func.max(Answer.answered_at)).where(Answer.question_id == Question.id).scalar_subquery()
+    result = db.session.execute(
+        update(Question).where(Question.answer_count.is_(None)).values(
+            answer_count=answers,
+            last_activity_at=func.coalesce(latest, Question.asked_at)
+        ).execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount
+
+# Folder hierarchy index helpers
+
+def subtree_bounds(tree_path):
+    """Return the [lower, upper) tree_path range holding a folder and its subtree.
+
+    Paths only contain digits and '/', and '0' sorts right after '/', so
+    every descendant of "/1/5/" falls between "/1/5/" and "/1/50".
+    """
+    return tree_path, tree_path[:-1] + '0'
+
+def rebuild_tree_paths():
+    """Recompute tree_path and depth for every folder from parent_id.
+
+    Used to backfill databases created before the hierarchy index existed.
+    Returns the number of folders that were corrected.
+    """
+    parents = dict(db.session.execute(select(Folder.id, Folder.parent_id)).all())
+    current = {
+        row.id: (row.tree_path, row.depth)
+        for row in db.session.execute(select(Folder.id, Folder.tree_path, Folder.depth))
+    }
+
+    paths = {}
+    for folder_id in parents:
+        chain = []
+        node = folder_id
+        while node is not None and node not in paths and len(chain) <= len(parents):
+            chain.append(node)
+            node = parents.get(node)
+        prefix, depth = paths.get(node, ('/', -1))
+        for chain_id in reversed(chain):
+            prefix, depth = f"{prefix}{chain_id}/", depth + 1
+            paths[chain_id] = (prefix, depth)
+
+    changes = [
+        {'id': folder_id, 'tree_path': path, 'depth': depth}
+        for folder_id, (path, depth) in paths.items()
+        if current.get(folder_id) != (path, depth)
+    ]
+    if changes:
+        db.session.execute(update(Folder), changes)
+        db.session.commit()
+    return len(changes)
+
+def folder_tree(root=None, max_depth=None, with_sizes=False):
+    """Build the nested folder hierarchy with two queries.
+
+    One query loads the folder rows of the tree (or of root's subtree), the
+    other groups documents per folder. Nodes are linked by id in a single
+    pass. max_depth limits how many levels below the top are returned;
+    counts and byte totals still cover the whole subtree. With with_sizes
+    every node also gets total_documents and total_size for its subtree.
+    """
+    folder_query = select(Folder.id, Folder.parent_id, Folder.name, Folder.depth)
+    document_query = select(Document.folder_id, func.count(Document.id).label('documents'))
+    if with_sizes:
+        document_query = document_query.add_columns(func.coalesce(func.sum(Document.file_size), 0).label('size'))
+    if root is not None:
+        lower, upper = subtree_bounds(root.tree_path)
+        in_subtree = (Folder.tree_path >= lower, Folder.tree_path < upper)
+        folder_query = folder_query.where(*in_subtree)
+        document_query = document_query.join(Folder, Folder.id == Document.folder_id).where(*in_subtree)
+    else:
+        document_query = document_query.where(Document.folder_id.is_not(None))
+    document_query = document_query.group_by(Document.folder_id)
+
+    # Rows are unpacked as plain tuples; named Row access costs more than
+    # the assembly itself at a few thousand folders
+    documents = {row[0]: row[1:] for row in db.session.execute(document_query).tuples()}
+    rows = db.session.execute(folder_query.order_by(Folder.depth, Folder.name, Folder.id)).tuples().all()
+
+    top_depth = root.depth if root is not None else 0
+    no_documents = (0, 0)
+    nodes = {}
+    top = []
+    for folder_id, parent_id, name, depth in rows:
+        counts = documents.get(folder_id, no_documents)
+        node = {
+            'id': folder_id,
+            'name': name,
+            'parent_id': parent_id,
+            'document_count': counts[0],
+            'subfolder_count': 0,
+            'children': []
         }
+        if with_sizes:
+            node['total_documents'] = counts[0]
+            node['total_size'] = int(counts[1])
+        nodes[folder_id] = node
+        parent = nodes.get(parent_id)
+        if parent is None:
+            top.append(node)
+        else:
+            parent['subfolder_count'] += 1
+            parent['children'].append(node)
+
+    # Rows are ordered by depth, so walking them backwards rolls totals up
+    # from the leaves
+    if with_sizes:
+        for folder_id, parent_id, _, _ in reversed(rows):
+            parent = nodes.get(parent_id)
+            if parent is not None:
+                parent['total_documents'] += nodes[folder_id]['total_documents']
+                parent['total_size'] += nodes[folder_id]['total_size']
+
+    if max_depth is not None:
+        for folder_id, _, _, depth in rows:
+            if (depth or 0) - top_depth >= max_depth:
+                nodes[folder_id]['children'] = []
+    return top
+
+# Bulk serialization helpers. Listings serialize many rows at once, so
+# related data (usernames, folder paths, child counts) is fetched with a
+# fixed number of set-based queries instead of lazy loads per row.
+
+# SQL Server caps a statement at 2100 parameters
+IN_CLAUSE_CHUNK = 1000
+
+def _chunks(values, size=IN_CLAUSE_CHUNK):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def usernames_for(user_ids):
+    """Map user ids to usernames with one IN-list lookup"""
+    names = {}
+    for chunk in _chunks({uid for uid in user_ids if uid is not None}):
+        rows = db.session.execute(
+            select(User.id, User.username).where(User.id.in_(chunk))
+        )
+        names.update(rows.all())
+    return names
+
+def folder_lineage(folder_ids):
+    """Fetch the given folders and all their ancestors in one recursive query.
+
+    Returns {folder_id: (parent_id, name)}.
+    """
+    lineage = {}
+    for chunk in _chunks({fid for fid in folder_ids if fid is not None}):
+        ancestors = select(Folder.id, Folder.parent_id, Folder.name).where(
+            Folder.id.in_(chunk)
+        ).cte('ancestors', recursive=True)
+        parent = aliased(Folder)
+        ancestors = ancestors.union_all(
+            select(parent.id, parent.parent_id, parent.name)
+            .join(ancestors, parent.id == ancestors.c.parent_id)
+        )
+        for row in db.session.execute(select(ancestors)):
+            lineage[row.id] = (row.parent_id, row.name)
+    return lineage
+
+def lineage_paths(lineage):
+    """Build {folder_id: path} for every folder in a lineage mapping"""
+    paths = {}
+    for folder_id in lineage:
+        chain = []
+        current = folder_id
+        while current in lineage and current not in paths and len(chain) <= len(lineage):
+            chain.append(current)
+            current = lineage[current][0]
+        prefix = paths.get(current)
+        for chain_id in reversed(chain):
+            name = lineage[chain_id][1]
+            prefix = f"{prefix}/{name}" if prefix else name
+            paths[chain_id] = prefix
+    return paths
+
+def child_counts(folder_ids):
+    """Count subfolders and documents per folder with one grouped query.
+
+    Returns {folder_id: (subfolder_count, document_count)}.
+    """
+    counts = {}
+    for chunk in _chunks({fid for fid in folder_ids if fid is not None}):
+        subfolders = select(
+            Folder.parent_id.label('folder_id'),
+            func.count(Folder.id).label('subfolders'),
+            literal_column('0').label('documents')
+        ).where(Folder.parent_id.in_(chunk)).group_by(Folder.parent_id)
+        documents = select(
+            Document.folder_id.label('folder_id'),
+            literal_column('0').label('subfolders'),
+            func.count(Document.id).label('documents')
+        ).where(Document.folder_id.in_(chunk)).group_by(Document.folder_id)
+        for row in db.session.execute(union_all(subfolders, documents)):
+            subfolder_count, document_count = counts.get(row.folder_id, (0, 0))
+            counts[row.folder_id] = (subfolder_count + row.subfolders, document_count + row.documents)
+    return counts
+
+def wants(fields, *names):
+    """Whether any of names is requested; fields=None means every field"""
+    return fields is None or any(name in fields for name in names)
+
+def serialize_folders(folders, fields=None):
+    """Serialize folders in bulk; the query count does not grow with the row count.
+
+    Lookups behind fields that are not requested are skipped.
+    """
+    folders = list(folders)
+    if not folders:
+        return []
+
+    lineage = {}
+    if wants(fields, 'path', 'parent_name'):
+        ancestor_ids = {fid for folder in folders for fid in folder.ancestor_ids()}
+        for chunk in _chunks(ancestor_ids):
+            rows = db.session.execute(
+                select(Folder.id, Folder.parent_id, Folder.name).where(Folder.id.in_(chunk))
+            )
+            lineage.update((row.id, (row.parent_id, row.name)) for row in rows)
+    paths = lineage_paths(lineage)
+    counts = child_counts(folder.id for folder in folders) if wants(fields, 'subfolder_count', 'document_count') else {}
+    creators = usernames_for(folder.created_by for folder in folders) if wants(fields, 'creator_name') else {}
+
+    result = []
+    for folder in folders:
+        parent_path = paths.get(folder.parent_id)
+        subfolder_count, document_count = counts.get(folder.id, (0, 0))
+        result.append({
+            'id': folder.id,
+            'name': folder.name,
+            'parent_id': folder.parent_id,
+            'parent_name': lineage[folder.parent_id][1] if folder.parent_id in lineage else None,
+            'path': f"{parent_path}/{folder.name}" if parent_path else folder.name,
+            'created_by': folder.created_by,
+            'creator_name': creators.get(folder.created_by),
+            'created_at': folder.created_at.isoformat() if folder.created_at else None,
+            'description': folder.description,
+            'subfolder_count': subfolder_count,
+            'document_count': document_count
+        })
+    return result
+
+def serialize_documents(documents, fields=None):
+    """Serialize documents in bulk; the query count does not grow with the row count.
+
+    Lookups behind fields that are not requested are skipped.
+    """
+    documents = list(documents)
+    if not documents:
+        return []
+
+    lineage = folder_lineage(document.folder_id for document in documents) if wants(fields, 'folder_name', 'folder_path') else {}
+    paths = lineage_paths(lineage)
+    uploaders = usernames_for(document.uploaded_by for document in documents) if wants(fields, 'uploader_name') else {}
+
+    return [{
+        'id': document.id,
+        'filename': document.filename,
+        'original_filename': document.original_filename,
+        'file_size': document.file_size,
+        'mime_type': document.mime_type,
+        'uploaded_by': document.uploaded_by,
+        'uploader_name': uploaders.get(document.uploaded_by),
+        'uploaded_at': document.uploaded_at.isoformat() if document.uploaded_at else None,
+        'description': document.description,
+        'folder_id': document.folder_id,
+        'folder_name': lineage[document.folder_id][1] if document.folder_id in lineage else None,
+        'folder_path': paths.get(document.folder_id),
+        'content_hash': document.content_hash,
+        'processing_status': document.processing_status,
+        'page_count': document.page_count,
+        'sheet_count': document.sheet_count,
+        'has_preview': document.preview_path is not None
+    } for document in documents]
+
+def serialize_answers(answers, fields=None):
+    """Serialize answers in bulk with one username lookup"""
+    answers = list(answers)
+    answerers = usernames_for(answer.answered_by for answer in answers) if wants(fields, 'answerer_name') else {}
+    return [{
+        'id': answer.id,
+        'content': answer.content,
+        'question_id': answer.question_id,
+        'answered_by': answer.answered_by,
+        'answerer_name': answerers.get(answer.answered_by),
+        'answered_at': answer.answered_at.isoformat() if answer.answered_at else None
+    } for answer in answers]
+
+def serialize_questions(questions, fields=None):
+    """Serialize questions with their answers using a fixed number of queries"""
+    questions = list(questions)
+    if not questions:
+        return []
+
+    askers = usernames_for(question.asked_by for question in questions) if wants(fields, 'asker_name') else {}
+
+    answers = {}
+    if wants(fields, 'answers'):
+        for chunk in _chunks(question.id for question in questions):
+            rows = Answer.query.filter(Answer.question_id.in_(chunk)).order_by(Answer.answered_at, Answer.id).all()
+            for answer in serialize_answers(rows):
+                answers.setdefault(answer['question_id'], []).append(answer)
+
+    return [{
+        'id': question.id,
+        'title': question.title,
+        'content': question.content,
+        'asked_by': question.asked_by,
+        'asker_name': askers.get(question.asked_by),
+        'asked_at': question.asked_at.isoformat() if question.asked_at else None,
+        'is_answered': question.is_answered,
+        'answer_count': question.answer_count,
+        'last_activity_at': question.last_activity_at.isoformat() if question.last_activity_at else None,
+        'answers': answers.get(question.id, [])
+    } for question in questions]
+
+def serialize_access_events(events, fields=None):
+    """Serialize access events with one username and one filename lookup"""
+    events = list(events)
+    users = usernames_for(event.user_id for event in events) if wants(fields, 'username') else {}
+    filenames = {}
+    if wants(fields, 'document_name'):
+        for chunk in _chunks({event.document_id for event in events}):
+            rows = db.session.execute(
+                select(Document.id, Document.original_filename).where(Document.id.in_(chunk))
+            )
+            filenames.update(rows.all())
+    return [{
+        'id': event.id,
+        'document_id': event.document_id,
+        'document_name': filenames.get(event.document_id),
+        'user_id': event.user_id,
+        'username': users.get(event.user_id),
+        'action': event.action,
+        'accessed_at': event.accessed_at.isoformat(),
+        'ip_address': event.ip_address
+    } for event in events]
@@ -0,0 +1,112 @@
+import base64
+import json
+from datetime import datetime
+from flask import jsonify, request
+from sqlalchemy import and_, or_
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+class PaginationError(ValueError):
+    """Raised for malformed limit, cursor or fields parameters"""
+
+def requested_fields():
+    """Parse ?fields=a,b,c into a set, or None when every field is wanted"""
+    raw = request.args.get('fields')
+    if not raw:
+        return None
+    return {field.strip() for field in raw.split(',') if field.strip()}
+
+def project(rows, fields):
+    """Keep only the requested keys of serialized rows"""
+    if fields is None:
+        return rows
+    return [{key: value for key, value in row.items() if key in fields} for row in rows]
+
+def encode_cursor(values):
+    payload = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, order_by):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list) or len(values) != len(order_by):
+            raise ValueError
+        return [
+            datetime.fromisoformat(value) if value is not None and column.type.python_type is datetime else value
+            for (column, _), value in zip(order_by, values)
+        ]
+    except (ValueError, TypeError):
+        raise PaginationError('Invalid cursor')
+
+def keyset_after(order_by, values):
+    """Filter for rows strictly after values in the given (column, descending) order"""
+    clauses = []
+    for position, (column, descending) in enumerate(order_by):
+        equal_prefix = [
+            prefix_column == value
+            for (prefix_column, _), value in zip(order_by[:position], values[:position])
+        ]
+        beyond = column < values[position] if descending else column > values[position]
+        clauses.append(and_(*equal_prefix, beyond))
+    return or_(*clauses)
+
+def parse_count(name, value, default):
+    """A non-negative integer query parameter; the default only when it is absent"""
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise PaginationError(f'{name} must be a non-negative integer')
+    if number < 0:
+        raise PaginationError(f'{name} must be a non-negative integer')
+    return number
+
+def parse_limit(value, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    """Page size from the raw limit parameter; the default only when it is absent"""
+    return min(parse_count('limit', value, default), maximum)
+
+def paginated_response(query, order_by, serialize, always_paginate=False):
+    """Serialize a listing query, honouring limit, cursor, count and fields.
+
+    order_by is a list of (column, descending) pairs that must end with a
+    unique column so the order is stable. serialize(rows, fields) turns
+    model rows into dicts and may skip lookups for fields nobody asked for.
+
+    Without limit, cursor or count the whole listing is returned as a plain
+    list, as before, unless always_paginate is set for listings too large
+    to return whole. Otherwise the response is
+    {'items': [...], 'next_cursor': ..., 'total': ...} where total is only
+    computed when count=true; limit=0 with count=true loads no rows at all.
+    """
+    fields = requested_fields()
+    ordering = [column.desc() if descending else column.asc() for column, descending in order_by]
+
+    if not always_paginate and not any(key in request.args for key in ('limit', 'cursor', 'count')):
+        rows = query.order_by(*ordering).all()
+        return jsonify(project(serialize(rows, fields), fields))
+
+    try:
+        limit = parse_limit(request.args.get('limit'))
+
+        result = {}
+        if request.args.get('count', 'false').lower() == 'true':
+            result['total'] = query.order_by(None).count()
+
+        cursor = request.args.get('cursor')
+        if cursor:
+            query = query.filter(keyset_after(order_by, decode_cursor(cursor, order_by)))
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+
+    rows = query.order_by(*ordering).limit(limit + 1).all() if limit else []
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    result['items'] = project(serialize(rows, fields), fields)
+    result['next_cursor'] = encode_cursor(
+        [getattr(rows[-1], column.key) for column, _ in order_by]
+    ) if has_more else None
+    return jsonify(result)
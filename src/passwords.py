@@ -0,0 +1,95 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Password hashing is deliberately expensive, so it runs on a small
+# dedicated pool instead of the request threads. hashlib releases the GIL
+# while hashing, so threads are enough to use several cores. When the pool
+# and its queue are full, callers fail fast instead of piling up behind it.
+
+# Werkzeug method string, e.g. 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'.
+# Changing it makes logins rehash stored passwords with the new parameters.
+HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', min(os.cpu_count() or 1, 4)))
+# Hashes allowed to wait for a worker; beyond this new requests are refused
+HASH_QUEUE_LIMIT = int(os.environ.get('PASSWORD_HASH_QUEUE', HASH_WORKERS * 8))
+# Longest a request waits for its hash before giving up
+HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+
+# Failed logins per username within LOGIN_WINDOW before further attempts
+# are refused without hashing
+MAX_LOGIN_FAILURES = int(os.environ.get('MAX_LOGIN_FAILURES', 5))
+LOGIN_WINDOW = float(os.environ.get('LOGIN_WINDOW', 300))
+# Tracked usernames; past this the oldest counters are dropped
+MAX_TRACKED_USERNAMES = 100000
+
+class HashingOverloaded(Exception):
+    """Raised when the hashing pool cannot take more work"""
+
+_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='password-hash')
+_slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_LIMIT)
+_method_prefix = None
+
+# Ordered by window start, so the oldest counters come first
+_failures = OrderedDict()
+_failures_lock = threading.Lock()
+
+def _run(fn, *args, **kwargs):
+    if not _slots.acquire(blocking=False):
+        raise HashingOverloaded('Too many password operations in progress')
+    try:
+        future = _executor.submit(fn, *args, **kwargs)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    try:
+        return future.result(timeout=HASH_TIMEOUT)
+    except TimeoutError:
+        future.cancel()
+        raise HashingOverloaded('Password operation timed out')
+
+def hash_password(password):
+    return _run(generate_password_hash, password, method=HASH_METHOD)
+
+def verify_password(password_hash, password):
+    return _run(check_password_hash, password_hash, password)
+
+def needs_rehash(password_hash):
+    """Whether a stored hash was made with other parameters than HASH_METHOD"""
+    global _method_prefix
+    if _method_prefix is None:
+        # Let Werkzeug expand defaults such as 'scrypt' -> 'scrypt:32768:8:1'
+        _method_prefix = hash_password('').split('$', 1)[0]
+    return password_hash.split('$', 1)[0] != _method_prefix
+
+def login_retry_after(username):
+    """Seconds until username may try again, or 0 if it is not throttled"""
+    with _failures_lock:
+        entry = _failures.get(username)
+    if not entry:
+        return 0
+    count, window_start = entry
+    remaining = window_start + LOGIN_WINDOW - time.monotonic()
+    if remaining <= 0 or count < MAX_LOGIN_FAILURES:
+        return 0
+    return int(remaining) + 1
+
+def record_login_failure(username):
+    now = time.monotonic()
+    with _failures_lock:
+        count, window_start = _failures.get(username, (0, now))
+        if window_start + LOGIN_WINDOW <= now:
+            count, window_start = 0, now
+        if username in _failures and count == 0:
+            _failures.move_to_end(username)
+        while len(_failures) >= MAX_TRACKED_USERNAMES and username not in _failures:
+            _failures.popitem(last=False)
+        _failures[username] = (count + 1, window_start)
+
+def clear_login_failures(username):
+    with _failures_lock:
+        _failures.pop(username, None)
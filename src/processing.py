@@ -0,0 +1,311 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from multiprocessing import get_context
+from sqlalchemy import select, update
+from src.extractors import stages_for, run_stage, StageSkipped
+from src.models.user import db, Document, ProcessingJob, SearchEntry
+from src.search import index_document
+from src.cache import mark_folders_changed
+from src.changes import record_changes
+from src.storage import UPLOAD_FOLDER, document_key, storage_backend
+
+logger = logging.getLogger(__name__)
+
+# Worker processes for post-upload processing; 0 disables the pipeline
+PROCESSING_WORKERS = int(os.environ.get('PROCESSING_WORKERS', 2))
+# Jobs handed to the pool at once; the rest wait in the table
+MAX_IN_FLIGHT = PROCESSING_WORKERS * 2
+POLL_INTERVAL = 5.0
+# Seconds a stage may run before its worker stops it
+JOB_TIMEOUT = int(os.environ.get('PROCESSING_JOB_TIMEOUT', 600))
+# A job handed to the pool can wait behind the others in flight, so the
+# dispatcher gives up on it only after they could all have timed out
+ABANDON_AFTER = JOB_TIMEOUT * 3 + 30
+# The dispatcher renews the lease of its running jobs; a job whose lease
+# ran out belongs to a dispatcher that is gone and is queued again
+LEASE_SECONDS = 60
+RETRY_BACKOFF_SECONDS = 10
+PREVIEW_FOLDER = os.path.join(UPLOAD_FOLDER, 'previews')
+
+_dispatcher = None
+
+def enqueue_processing(document):
+    """Queue the processing stages of a new document in the current transaction.
+
+    When the same contents were already processed for another document, the
+    results are copied over instead of running the stages again.
+    """
+    stages = stages_for(document.original_filename)
+    if not stages:
+        document.processing_status = 'ready'
+        return
+
+    if document.content_hash:
+        processed = Document.query.filter(
+            Document.content_hash == document.content_hash,
+            Document.processing_status == 'ready',
+            Document.id != document.id
+        ).first()
+        if processed:
+            document.page_count = processed.page_count
+            document.sheet_count = processed.sheet_count
+            document.preview_path = processed.preview_path
+            document.processing_status = 'ready'
+            source = SearchEntry.query.filter_by(kind='document', ref_id=processed.id).first()
+            if source and source.extracted:
+                index_document(document, source.extracted)
+            return
+
+    document.processing_status = 'pending'
+    for stage in stages:
+        db.session.add(ProcessingJob(document_id=document.id, stage=stage))
+
+def notify_new_jobs():
+    """Wake the dispatcher after committing new jobs instead of waiting for its next poll"""
+    if _dispatcher:
+        _dispatcher.wake.set()
+
+def _claim_jobs(limit, worker_id):
+    """Atomically take up to limit due jobs; each claim is a conditional UPDATE"""
+    now = datetime.utcnow()
+    candidates = db.session.execute(
+        select(ProcessingJob.id)
+        .where(ProcessingJob.status == 'queued', ProcessingJob.available_at <= now)
+        .order_by(ProcessingJob.id)
+        .limit(limit)
+    ).scalars().all()
+
+    claimed = []
+    for job_id in candidates:
+        result = db.session.execute(
+            update(ProcessingJob)
+            .where(ProcessingJob.id == job_id, ProcessingJob.status == 'queued')
+            .values(
+                status='running',
+                locked_by=worker_id,
+                locked_at=now,
+                started_at=now,
+                attempts=ProcessingJob.attempts + 1
+            )
+        )
+        if result.rowcount:
+            claimed.append(job_id)
+    if claimed:
+        claimed_documents = select(ProcessingJob.document_id).where(ProcessingJob.id.in_(claimed))
+        mark_folders_changed(db.session.execute(
+            select(Document.folder_id).where(Document.id.in_(claimed_documents)).distinct()
+        ).scalars())
+        db.session.execute(
+            update(Document)
+            .where(Document.id.in_(claimed_documents))
+            .values(processing_status='processing')
+        )
+        record_changes('document', db.session.execute(claimed_documents).scalars())
+    db.session.commit()
+    return ProcessingJob.query.filter(ProcessingJob.id.in_(claimed)).all() if claimed else []
+
+def _requeue_stale_jobs():
+    cutoff = datetime.utcnow() - timedelta(seconds=LEASE_SECONDS)
+    db.session.execute(
+        update(ProcessingJob)
+        .where(ProcessingJob.status == 'running', ProcessingJob.locked_at < cutoff)
+        .values(status='queued', locked_by=None, locked_at=None, last_error='Lease expired')
+    )
+    db.session.commit()
+
+def _holds_lease(job, worker_id):
+    if job is None:
+        # Deleted along with its document while it ran
+        return False
+    if job.status == 'running' and job.locked_by == worker_id:
+        return True
+    # The lease ran out and the job was requeued; its current owner reports
+    logger.warning('Dropping result of %s for document %s, lease lost', job.stage, job.document_id)
+    return False
+
+def _refresh_document_status(document):
+    statuses = set(db.session.execute(
+        select(ProcessingJob.status).where(ProcessingJob.document_id == document.id)
+    ).scalars())
+    if 'failed' in statuses:
+        document.processing_status = 'failed'
+    elif statuses <= {'done', 'skipped'}:
+        document.processing_status = 'ready'
+
+def _finish_job(job_id, worker_id, result, duration_ms):
+    job = db.session.get(ProcessingJob, job_id)
+    if not _holds_lease(job, worker_id):
+        return
+    document = db.session.get(Document, job.document_id)
+    job.status = 'done'
+    job.finished_at = datetime.utcnow()
+    job.duration_ms = duration_ms
+    job.locked_by = None
+
+    if document:
+        if 'page_count' in result:
+            document.page_count = result['page_count']
+        if 'sheet_count' in result:
+            document.sheet_count = result['sheet_count']
+        if result.get('preview_path'):
+            document.preview_path = result['preview_path']
+        if job.stage == 'extract':
+            index_document(document, result.get('text', ''))
+        _refresh_document_status(document)
+        mark_folders_changed([document.folder_id])
+        record_changes('document', [document.id])
+    db.session.commit()
+    logger.info('Processed %s for document %s in %d ms', job.stage, job.document_id, duration_ms)
+
+def _end_job(job, status):
+    job.status = status
+    job.finished_at = datetime.utcnow()
+    document = db.session.get(Document, job.document_id)
+    if document:
+        _refresh_document_status(document)
+        mark_folders_changed([document.folder_id])
+        record_changes('document', [document.id])
+
+def _skip_job(job_id, worker_id, reason, duration_ms):
+    """Close a stage that cannot run here; the reason shows in the job's last_error"""
+    job = db.session.get(ProcessingJob, job_id)
+    if not _holds_lease(job, worker_id):
+        return
+    job.last_error = str(reason)
+    job.duration_ms = duration_ms
+    job.locked_by = None
+    _end_job(job, 'skipped')
+    db.session.commit()
+    logger.warning('Skipped %s for document %s: %s', job.stage, job.document_id, reason)
+
+def _fail_job(job_id, worker_id, error, duration_ms, retry=True):
+    job = db.session.get(ProcessingJob, job_id)
+    if not _holds_lease(job, worker_id):
+        return
+    job.last_error = str(error)[:2000]
+    job.duration_ms = duration_ms
+    job.locked_by = None
+    if job.attempts >= job.max_attempts or not retry:
+        _end_job(job, 'failed')
+    else:
+        job.status = 'queued'
+        job.available_at = datetime.utcnow() + timedelta(seconds=RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1))
+    db.session.commit()
+    logger.warning('Processing %s for document %s failed (attempt %d): %s',
+                   job.stage, job.document_id, job.attempts, error)
+
+class Dispatcher(threading.Thread):
+    """Feeds queued jobs from the database to a process pool.
+
+    Only this thread writes job results, so workers stay free of database
+    connections. At most MAX_IN_FLIGHT jobs are handed to the pool at a
+    time; the table itself is the backlog.
+    """
+
+    def __init__(self, app, workers):
+        super().__init__(name='processing-dispatcher', daemon=True)
+        self.app = app
+        self.workers = workers
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.in_flight = {}
+        self.renewed = 0.0
+
+    def run(self):
+        # spawn keeps worker processes clear of the web server's threads and sockets
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('spawn')) as pool:
+            while not self.stopping.is_set():
+                try:
+                    with self.app.app_context():
+                        self._collect()
+                        self._renew_leases()
+                        _requeue_stale_jobs()
+                        self._submit(pool)
+                except Exception:
+                    logger.exception('Processing dispatcher error')
+                    with self.app.app_context():
+                        db.session.rollback()
+                self.wake.wait(0.5 if self.in_flight else POLL_INTERVAL)
+                self.wake.clear()
+
+    def _submit(self, pool):
+        free = MAX_IN_FLIGHT - len(self.in_flight)
+        if free <= 0:
+            return
+        backend = storage_backend()
+        for job in _claim_jobs(free, self.worker_id):
+            document = db.session.get(Document, job.document_id)
+            path = None
+            if document:
+                # Workers read a local copy, kept in the cache until they are done
+                key = document_key(document)
+                backend.pin(key)
+                path = backend.fetch(key)
+                if not path:
+                    backend.unpin(key)
+            if not path:
+                _fail_job(job.id, self.worker_id, 'File not found on disk', 0)
+                continue
+            preview = os.path.join(PREVIEW_FOLDER, f"{document.content_hash or document.id}.png")
+            future = pool.submit(run_stage, job.stage, path, document.original_filename, preview, JOB_TIMEOUT)
+            future.add_done_callback(lambda _: self.wake.set())
+            self.in_flight[future] = (job.id, time.monotonic(), key)
+
+    def _collect(self):
+        now = time.monotonic()
+        for future, (job_id, started, key) in list(self.in_flight.items()):
+            duration_ms = int((now - started) * 1000)
+            if not future.done():
+                if now - started > ABANDON_AFTER:
+                    # The worker did not stop it, e.g. stuck inside a C
+                    # library; fail it for good so it never runs twice
+                    del self.in_flight[future]
+                    storage_backend().unpin(key)
+                    _fail_job(job_id, self.worker_id, 'Timed out', duration_ms, retry=False)
+                continue
+            del self.in_flight[future]
+            storage_backend().unpin(key)
+            try:
+                result = future.result()
+            except StageSkipped as e:
+                _skip_job(job_id, self.worker_id, e, duration_ms)
+            except Exception as e:
+                _fail_job(job_id, self.worker_id, e, duration_ms)
+            else:
+                _finish_job(job_id, self.worker_id, result, result.pop('duration_ms', duration_ms))
+
+    def _renew_leases(self):
+        """Extend the lease of the jobs this dispatcher still has in the pool"""
+        if not self.in_flight or time.monotonic() - self.renewed < LEASE_SECONDS / 3:
+            return
+        db.session.execute(
+            update(ProcessingJob)
+            .where(
+                ProcessingJob.id.in_([job_id for job_id, _, _ in self.in_flight.values()]),
+                ProcessingJob.status == 'running',
+                ProcessingJob.locked_by == self.worker_id
+            )
+            .values(locked_at=datetime.utcnow())
+        )
+        db.session.commit()
+        self.renewed = time.monotonic()
+
+    def stop(self):
+        self.stopping.set()
+        self.wake.set()
+
+def init_processing(app):
+    """Start the background dispatcher for this process"""
+    global _dispatcher
+    if PROCESSING_WORKERS <= 0 or _dispatcher is not None:
+        return _dispatcher
+    _dispatcher = Dispatcher(app, PROCESSING_WORKERS)
+    _dispatcher.start()
+    return _dispatcher
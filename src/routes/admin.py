@@ -0,0 +1,18 @@
+from flask import Blueprint, Response, jsonify
+from src.routes.user import admin_required
+from src.database import pool_status
+from src.metrics import render_metrics
+
+admin_bp = Blueprint('admin', __name__)
+
+@admin_bp.route('/admin/database', methods=['GET'])
+@admin_required
+def get_database_status():
+    """Connection pool sizes and checkout wait metrics"""
+    return jsonify(pool_status())
+
+@admin_bp.route('/metrics', methods=['GET'])
+@admin_required
+def get_metrics():
+    """Request, SQL and pool metrics in the Prometheus text format"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,101 @@
+from datetime import datetime
+from flask import Blueprint, jsonify, request
+from sqlalchemy import case, func, select
+from src.models.user import db, AccessEvent, Document, serialize_access_events, usernames_for, IN_CLAUSE_CHUNK
+from src.routes.user import admin_required
+from src.pagination import paginated_response
+
+audit_bp = Blueprint('audit', __name__)
+
+ACCESS_ACTIONS = ('view', 'download')
+NEWEST_FIRST = [(AccessEvent.accessed_at, True), (AccessEvent.id, True)]
+
+def access_filters():
+    """Conditions from ?action=, ?since= and ?until= (ISO dates)"""
+    conditions = []
+    action = request.args.get('action')
+    if action:
+        if action not in ACCESS_ACTIONS:
+            raise ValueError(f"action must be one of {', '.join(ACCESS_ACTIONS)}")
+        conditions.append(AccessEvent.action == action)
+    for name, compare in (('since', AccessEvent.accessed_at.__ge__), ('until', AccessEvent.accessed_at.__lt__)):
+        value = request.args.get(name)
+        if value:
+            try:
+                conditions.append(compare(datetime.fromisoformat(value)))
+            except ValueError:
+                raise ValueError(f'{name} must be an ISO date or date and time')
+    return conditions
+
+def access_log(column, value):
+    try:
+        conditions = access_filters()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # The (column, accessed_at, id) index serves the filter, order and cursor
+    query = AccessEvent.query.filter(column == value, *conditions)
+    return paginated_response(query, NEWEST_FIRST, serialize_access_events, always_paginate=True)
+
+def access_summary(column, value, group_column, conditions):
+    """Views, downloads and last access per group_column value, latest first"""
+    rows = db.session.execute(
+        select(
+            group_column.label('group_id'),
+            func.sum(case((AccessEvent.action == 'view', 1), else_=0)).label('views'),
+            func.sum(case((AccessEvent.action == 'download', 1), else_=0)).label('downloads'),
+            func.max(AccessEvent.accessed_at).label('last_accessed_at')
+        )
+        .where(column == value, *conditions)
+        .group_by(group_column)
+        .order_by(func.max(AccessEvent.accessed_at).desc())
+    ).all()
+    return [{
+        'id': row.group_id,
+        'views': row.views,
+        'downloads': row.downloads,
+        'last_accessed_at': row.last_accessed_at.isoformat()
+    } for row in rows]
+
+@audit_bp.route('/documents/<int:doc_id>/access-log', methods=['GET'])
+@admin_required
+def get_document_access_log(doc_id):
+    """Views and downloads of a document, newest first, paginated"""
+    return access_log(AccessEvent.document_id, doc_id)
+
+@audit_bp.route('/users/<int:user_id>/access-log', methods=['GET'])
+@admin_required
+def get_user_access_log(user_id):
+    """Documents a user viewed or downloaded, newest first, paginated"""
+    return access_log(AccessEvent.user_id, user_id)
+
+@audit_bp.route('/documents/<int:doc_id>/access-summary', methods=['GET'])
+@admin_required
+def get_document_access_summary(doc_id):
+    """Who accessed a document, with view and download counts per user"""
+    try:
+        conditions = access_filters()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    summary = access_summary(AccessEvent.document_id, doc_id, AccessEvent.user_id, conditions)
+    names = usernames_for(row['id'] for row in summary)
+    return jsonify([dict(row, username=names.get(row['id'])) for row in summary])
+
+@audit_bp.route('/users/<int:user_id>/access-summary', methods=['GET'])
+@admin_required
+def get_user_access_summary(user_id):
+    """What a user accessed, with view and download counts per document"""
+    try:
+        conditions = access_filters()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    summary = access_summary(AccessEvent.user_id, user_id, AccessEvent.document_id, conditions)
+    ids = [row['id'] for row in summary]
+    filenames = {}
+    for start in range(0, len(ids), IN_CLAUSE_CHUNK):
+        filenames.update(db.session.execute(
+            select(Document.id, Document.original_filename).where(Document.id.in_(ids[start:start + IN_CLAUSE_CHUNK]))
+        ).all())
+    return jsonify([dict(row, document_name=filenames.get(row['id'])) for row in summary])
@@ -0,0 +1,39 @@
+from flask import Blueprint, jsonify, request
+from src.routes.user import login_required
+from src.database import no_retry
+from src.changes import changes_since, compact_periodically, pruned_through
+
+changes_bp = Blueprint('changes', __name__)
+
+DEFAULT_CHANGE_LIMIT = 500
+MAX_CHANGE_LIMIT = 5000
+
+@changes_bp.route('/changes', methods=['GET'])
+@login_required
+@no_retry
+def get_changes():
+    """Folders, documents, questions and answers changed after a cursor.
+
+    Start with since=0 and pass next_cursor back while has_more is true.
+    Each entity appears once with its current data ("upsert") or as a
+    "delete". Documents carry folder_id but no folder name or path, since
+    renaming a folder does not log the documents below it; clients take
+    those from the folder entries. A 410 means tombstones after the cursor
+    were compacted away and the client must resync from since=0.
+    """
+    try:
+        since = int(request.args.get('since', 0))
+        limit = int(request.args.get('limit', DEFAULT_CHANGE_LIMIT))
+    except ValueError:
+        return jsonify({'error': 'since and limit must be integers'}), 400
+    if since < 0:
+        return jsonify({'error': 'since must be a cursor from an earlier response'}), 400
+    if limit < 1 or limit > MAX_CHANGE_LIMIT:
+        return jsonify({'error': f'limit must be between 1 and {MAX_CHANGE_LIMIT}'}), 400
+    
+    compact_periodically()
+    if 0 < since < pruned_through():
+        return jsonify({'error': 'Cursor has expired, resync from since=0', 'since': 0}), 410
+    
+    changes, next_cursor, has_more = changes_since(since, limit)
+    return jsonify({'changes': changes, 'next_cursor': next_cursor, 'has_more': has_more})
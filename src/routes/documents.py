@@ -1,18 +1,60 @@
 import os
+import threading
+import time
 import uuid
-from flask import Blueprint, jsonify, request, session, send_file
+from datetime import datetime, timedelta
+from flask import Blueprint, Response, jsonify, request, session, send_file
+from sqlalchemy import select, update, delete, insert, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
+from werkzeug.http import http_date, is_resource_modified
 from werkzeug.utils import secure_filename
-from src.models.user import Document, User, Folder, db
-from src.routes.user import login_required
+from src.models.user import (
+    Document, Folder, UploadSession, Blob, ProcessingJob, db,
+    serialize_documents, acquire_blob, release_blobs, IN_CLAUSE_CHUNK
+)
+from src.routes.user import login_required, can_modify
+from src.database import retry_transient
+from src.pagination import paginated_response
+from src.search import index_document, remove_from_index
+from src.processing import enqueue_processing, notify_new_jobs
+from src.cache import cached_listing, mark_folders_changed
+from src.events import publish, folder_topic
+from src.changes import record_changes
+from src.audit import record_access
+from src.storage import (
+    UPLOAD_FOLDER, ChunkError, PartialMissing, write_chunk, finish_partial, discard_partial, remove_stale_partials,
+    spool_upload, place_blob, remove_blob, blob_path, blob_exists, document_key, storage_backend, STORAGE_BACKEND
+)
 
 documents_bp = Blueprint('documents', __name__)
 
-UPLOAD_FOLDER = os.environ.get('UPLOADS_DIR', '/tmp/vdr_uploads')
-# Enable file uploads when using Azure SQL, disable only for Railway + SQLite
+# Enable file uploads when using Azure SQL or object storage, disable only
+# for Railway + SQLite with files on its ephemeral disk
 # Check for individual SQL variables (preferred) or DATABASE_URL fallback
 AZURE_SQL_MODE = (os.environ.get('SQL_SERVER') and os.environ.get('SQL_DATABASE')) or 'mssql' in os.environ.get('DATABASE_URL', '')
-RAILWAY_MODE = os.environ.get('RAILWAY_STATIC_URL') is not None and not AZURE_SQL_MODE
+RAILWAY_MODE = os.environ.get('RAILWAY_STATIC_URL') is not None and not AZURE_SQL_MODE and STORAGE_BACKEND == 'local'
+# Hand file transfers to a front proxy: 'x-accel-redirect' (nginx) or
+# 'x-sendfile' (Apache, lighttpd). SENDFILE_PREFIX is the internal location
+# the proxy maps onto UPLOAD_FOLDER. With a remote backend only files in
+# the local cache are offloaded, so keep STORAGE_CACHE_DIR below it.
+SENDFILE_MODE = os.environ.get('SENDFILE_MODE', '').lower()
+SENDFILE_PREFIX = os.environ.get('SENDFILE_PREFIX', '/protected-uploads/')
+# Larger multi-range requests are answered with the whole file
+MAX_BYTE_RANGES = 16
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx'}
+# Chunked upload sessions: chunk size bounds, default and the largest file accepted
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_SIZE', 10 * 1024 ** 3))
+# Longest a request may take to write one chunk or complete an upload
+UPLOAD_LEASE_SECONDS = 600
+# Sessions and partial files untouched this long are removed
+UPLOAD_SESSION_TTL = int(os.environ.get('UPLOAD_SESSION_TTL_HOURS', 24)) * 3600
+UPLOAD_SWEEP_INTERVAL = 3600
+MAX_BATCH_OPERATIONS = 5000
+BATCH_OPERATIONS = {'move', 'update', 'delete'}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -23,23 +65,24 @@ def ensure_upload_folder():
 
 @documents_bp.route('/documents', methods=['GET'])
 @login_required
+@cached_listing(lambda: request.args.get('folder_id', type=int))
 def get_documents():
     folder_id = request.args.get('folder_id', type=int)
     
     if folder_id:
-        documents = Document.query.filter_by(folder_id=folder_id).all()
+        documents = Document.query.filter_by(folder_id=folder_id)
     else:
         # Get documents in root (no folder)
-        documents = Document.query.filter_by(folder_id=None).all()
+        documents = Document.query.filter_by(folder_id=None)
     
-    return jsonify([doc.to_dict() for doc in documents])
+    return paginated_response(documents, [(Document.id, False)], serialize_documents)
 
 @documents_bp.route('/documents', methods=['POST'])
 @login_required
 def upload_document():
     # Check if running on Railway - disable file uploads
     if RAILWAY_MODE:
-        return jsonify({'error': 'File uploads are disabled on Railway due to read-only filesystem. Use local deployment or Azure for file uploads.'}), 400
+        return jsonify({'error': 'File uploads are disabled on Railway due to read-only filesystem. Use local deployment, Azure or STORAGE_BACKEND=s3 for file uploads.'}), 400
     
     if 'file' not in request.files:
         return jsonify({'error': 'No file provided'}), 400
@@ -51,18 +94,6 @@ def upload_document():
     if not allowed_file(file.filename):
         return jsonify({'error': 'File type not allowed'}), 400
     
-    ensure_upload_folder()
-    
-    # Generate unique filename
-    original_filename = secure_filename(file.filename)
-    file_extension = original_filename.rsplit('.', 1)[1].lower()
-    unique_filename = f"{uuid.uuid4().hex}.{file_extension}"
-    file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-    
-    # Save file
-    file.save(file_path)
-    file_size = os.path.getsize(file_path)
-    
     # Get folder_id from form data
     folder_id = request.form.get('folder_id', type=int)
     
@@ -70,23 +101,40 @@ def upload_document():
     if folder_id:
         folder = Folder.query.get(folder_id)
         if not folder:
-            os.remove(file_path)  # Clean up uploaded file
             return jsonify({'error': 'Folder not found'}), 404
     
+    ensure_upload_folder()
+    
+    # Hashed while it was received; identical contents are stored only once
+    original_filename = secure_filename(file.filename)
+    temp_path, content_hash, file_size = spool_upload(file)
+    acquire_blob(content_hash, file_size)
+    file_path = place_blob(temp_path, content_hash)
+    
     # Save to database
     document = Document(
-        filename=unique_filename,
+        filename=content_hash,
         original_filename=original_filename,
         file_path=file_path,
         file_size=file_size,
         mime_type=file.content_type or 'application/octet-stream',
         uploaded_by=session['user_id'],
         description=request.form.get('description', ''),
-        folder_id=folder_id
+        folder_id=folder_id,
+        content_hash=content_hash
     )
     
     db.session.add(document)
+    db.session.flush()
+    index_document(document)
+    # Extraction and previews run in the background; respond right away
+    enqueue_processing(document)
+    mark_folders_changed([folder_id])
+    record_changes('document', [document.id])
+    record_changes('folder', [folder_id])
+    publish('document.created', {'id': document.id, 'folder_id': folder_id}, [folder_topic(folder_id)])
     db.session.commit()
+    notify_new_jobs()
     
     return jsonify({'message': 'File uploaded successfully', 'document': document.to_dict()}), 201
 
@@ -94,31 +142,178 @@ def upload_document():
 @login_required
 def get_document(doc_id):
     document = Document.query.get_or_404(doc_id)
-    return jsonify(document.to_dict())
+    result = document.to_dict()
+    record_access(doc_id, 'view')
+    return jsonify(result)
+
+def resolve_byte_ranges(byte_ranges, length):
+    """Turn a parsed Range header into (start, stop) offsets within length"""
+    resolved = []
+    for start, stop in byte_ranges.ranges:
+        if start < 0:
+            start, stop = max(length + start, 0), length
+        else:
+            stop = min(stop or length, length)
+        if start < stop:
+            resolved.append((start, stop))
+    return resolved
+
+def requested_ranges(document, etag, min_ranges=2):
+    """Return the ranges of a request that should be honoured.
+
+    Werkzeug serves single ranges of local files itself, so by default only
+    multi-range requests are resolved here. Ranges are answered only while
+    If-Range (if sent) still matches; otherwise the Range header is dropped
+    so the whole file is sent.
+    """
+    byte_ranges = request.range
+    if not byte_ranges or len(byte_ranges.ranges) < min_ranges:
+        return None
+    if_range = request.if_range
+    stale = (if_range.etag or if_range.date) and not (etag and if_range.etag == etag)
+    ranges = resolve_byte_ranges(byte_ranges, document.file_size)
+    if stale or len(ranges) > MAX_BYTE_RANGES:
+        request.environ.pop('HTTP_RANGE', None)
+        return None
+    return ranges
+
+def multipart_range_response(document, key, ranges):
+    """Stream a 206 multipart/byteranges body, as PDF viewers request for linearized files"""
+    boundary = uuid.uuid4().hex
+    parts = [(
+        f"\r\n--{boundary}\r\n"
+        f"Content-Type: {document.mime_type}\r\n"
+        f"Content-Range: bytes {start}-{stop - 1}/{document.file_size}\r\n\r\n"
+    ).encode('latin-1') for start, stop in ranges]
+    closing = f"\r\n--{boundary}--\r\n".encode('latin-1')
+    content_length = sum(len(head) for head in parts) + sum(stop - start for start, stop in ranges) + len(closing)
+
+    def generate():
+        for head, (start, stop) in zip(parts, ranges):
+            yield head
+            yield from storage_backend().open_blocks(key, start, stop)
+        yield closing
+
+    response = Response(generate(), 206, mimetype=f'multipart/byteranges; boundary={boundary}', direct_passthrough=True)
+    response.content_length = content_length
+    return response
+
+def streamed_response(document, key, byte_range=None):
+    """Send a file that is not on local disk, block by block from storage"""
+    if byte_range:
+        start, stop = byte_range
+        response = Response(storage_backend().open_blocks(key, start, stop), 206, mimetype=document.mime_type, direct_passthrough=True)
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{document.file_size}'
+        response.content_length = stop - start
+    else:
+        response = Response(storage_backend().open_blocks(key), mimetype=document.mime_type, direct_passthrough=True)
+        response.content_length = document.file_size
+    response.headers.set('Content-Disposition', 'attachment', filename=document.original_filename)
+    return response
+
+def offloaded_response(document, path):
+    """Let the front proxy send the file; Python only sets the headers"""
+    response = Response(mimetype=document.mime_type)
+    if SENDFILE_MODE == 'x-accel-redirect':
+        relative_path = os.path.relpath(path, UPLOAD_FOLDER).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = SENDFILE_PREFIX.rstrip('/') + '/' + relative_path
+    else:
+        response.headers['X-Sendfile'] = path
+    response.headers.set('Content-Disposition', 'attachment', filename=document.original_filename)
+    return response
 
 @documents_bp.route('/documents/<int:doc_id>/download', methods=['GET'])
 @login_required
 def download_document(doc_id):
+    """Download a document with ETag, conditional GET and byte range support.
+
+    Files on local disk (or in the cache of a remote backend) are sent from
+    there; others are streamed from storage as they arrive.
+    """
     document = Document.query.get_or_404(doc_id)
+    backend = storage_backend()
+    key = document_key(document)
+    path = backend.local_path(key)
     
-    if not os.path.exists(document.file_path):
+    if path is None and not backend.exists(key):
         return jsonify({'error': 'File not found on disk'}), 404
     
-    return send_file(
-        document.file_path,
-        as_attachment=True,
-        download_name=document.original_filename,
-        mimetype=document.mime_type
-    )
+    # Stored contents never change, so their hash is a strong validator.
+    # Files uploaded before hashing get an ETag generated by Werkzeug.
+    etag = document.content_hash
+    last_modified = document.uploaded_at
+    
+    if etag and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    elif path and SENDFILE_MODE in ('x-accel-redirect', 'x-sendfile'):
+        response = offloaded_response(document, path)
+    else:
+        ranges = requested_ranges(document, etag, 2 if path else 1)
+        if ranges == []:
+            return Response(status=416, headers={'Content-Range': f'bytes */{document.file_size}'})
+        if ranges and len(ranges) > 1:
+            response = multipart_range_response(document, key, ranges)
+        elif ranges:
+            response = streamed_response(document, key, ranges[0])
+        elif path is None:
+            response = streamed_response(document, key)
+        else:
+            response = send_file(
+                path,
+                as_attachment=True,
+                download_name=document.original_filename,
+                mimetype=document.mime_type,
+                conditional=True,
+                etag=etag or True,
+                last_modified=last_modified
+            )
+    
+    if etag:
+        response.set_etag(etag)
+    if last_modified:
+        response.headers['Last-Modified'] = http_date(last_modified)
+    response.headers['Accept-Ranges'] = 'bytes'
+    # Documents need a session, so shared caches must not keep them
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    # Viewers fetch a file in many ranges; only the start of one counts
+    if response.status_code == 200 or (response.status_code == 206 and request.range.ranges[0][0] == 0):
+        record_access(doc_id, 'download')
+    return response
+
+@documents_bp.route('/documents/<int:doc_id>/processing', methods=['GET'])
+@login_required
+def get_document_processing(doc_id):
+    """Processing status of a document with per-stage timings, for polling"""
+    document = Document.query.get_or_404(doc_id)
+    jobs = ProcessingJob.query.filter_by(document_id=doc_id).order_by(ProcessingJob.id).all()
+    return jsonify({
+        'document_id': doc_id,
+        'processing_status': document.processing_status,
+        'page_count': document.page_count,
+        'sheet_count': document.sheet_count,
+        'has_preview': document.preview_path is not None,
+        'jobs': [job.to_dict() for job in jobs]
+    })
+
+@documents_bp.route('/documents/<int:doc_id>/preview', methods=['GET'])
+@login_required
+def get_document_preview(doc_id):
+    document = Document.query.get_or_404(doc_id)
+    
+    if not document.preview_path or not os.path.exists(document.preview_path):
+        return jsonify({'error': 'No preview available'}), 404
+    
+    return send_file(document.preview_path, mimetype='image/png', conditional=True)
 
 @documents_bp.route('/documents/<int:doc_id>', methods=['PUT'])
 @login_required
+@retry_transient
 def update_document(doc_id):
     document = Document.query.get_or_404(doc_id)
     
     # Only allow the uploader or admin to update
-    user = User.query.get(session['user_id'])
-    if document.uploaded_by != session['user_id'] and not user.is_admin:
+    if not can_modify(document.uploaded_by):
         return jsonify({'error': 'Permission denied'}), 403
     
     data = request.json
@@ -126,8 +321,10 @@ def update_document(doc_id):
     # Update description
     if 'description' in data:
         document.description = data['description']
+        index_document(document)
     
     # Update folder
+    changed_folders = [document.folder_id]
     if 'folder_id' in data:
         folder_id = data['folder_id']
         if folder_id:
@@ -135,39 +332,46 @@ def update_document(doc_id):
             if not folder:
                 return jsonify({'error': 'Folder not found'}), 404
         document.folder_id = folder_id
+        changed_folders.append(folder_id)
     
+    mark_folders_changed(changed_folders)
+    record_changes('document', [document.id])
+    if 'folder_id' in data:
+        # Document counts of both folders changed
+        record_changes('folder', changed_folders)
+    publish('document.updated', {'id': document.id, 'folder_id': document.folder_id}, map(folder_topic, changed_folders))
     db.session.commit()
     return jsonify(document.to_dict())
 
 @documents_bp.route('/documents/<int:doc_id>', methods=['DELETE'])
 @login_required
+@retry_transient
 def delete_document(doc_id):
     document = Document.query.get_or_404(doc_id)
     
     # Only allow the uploader or admin to delete
-    user = User.query.get(session['user_id'])
-    if document.uploaded_by != session['user_id'] and not user.is_admin:
+    if not can_modify(document.uploaded_by):
         return jsonify({'error': 'Permission denied'}), 403
     
-    # Delete file from disk
-    if os.path.exists(document.file_path):
-        os.remove(document.file_path)
-    
     # Delete from database
-    db.session.delete(document)
+    removed_files = delete_documents([document])
+    publish('document.deleted', {'id': doc_id, 'folder_id': document.folder_id}, [folder_topic(document.folder_id)])
     db.session.commit()
     
+    # Delete files from disk once nothing references them any more
+    remove_files(removed_files)
+    
     return jsonify({'message': 'Document deleted successfully'}), 200
 
 @documents_bp.route('/documents/<int:doc_id>/move', methods=['POST'])
 @login_required
+@retry_transient
 def move_document(doc_id):
     """Move document to a different folder"""
     document = Document.query.get_or_404(doc_id)
     
     # Only allow the uploader or admin to move
-    user = User.query.get(session['user_id'])
-    if document.uploaded_by != session['user_id'] and not user.is_admin:
+    if not can_modify(document.uploaded_by):
         return jsonify({'error': 'Permission denied'}), 403
     
     data = request.json
@@ -182,8 +386,485 @@ def move_document(doc_id):
         if not folder:
             return jsonify({'error': 'Folder not found'}), 404
     
+    mark_folders_changed([document.folder_id, folder_id])
+    record_changes('document', [document.id])
+    record_changes('folder', [document.folder_id, folder_id])
+    publish(
+        'document.moved',
+        {'id': document.id, 'folder_id': folder_id, 'previous_folder_id': document.folder_id},
+        [folder_topic(document.folder_id), folder_topic(folder_id)]
+    )
     document.folder_id = folder_id
     db.session.commit()
     
     return jsonify({'message': 'Document moved successfully', 'document': document.to_dict()})
 
+def _load_in_chunks(query_for, ids):
+    """Run query_for(chunk) over ids in IN-list sized chunks and concatenate"""
+    ids = list(ids)
+    rows = []
+    for start in range(0, len(ids), IN_CLAUSE_CHUNK):
+        rows.extend(query_for(ids[start:start + IN_CLAUSE_CHUNK]))
+    return rows
+
+def delete_documents(documents):
+    """Delete documents in the current transaction with set-based statements.
+
+    Returns the released blobs, other stored files and previews to remove
+    once the transaction commits.
+    """
+    ids = [document.id for document in documents]
+    mark_folders_changed({document.folder_id for document in documents})
+    record_changes('document', ids, deleted=True)
+    record_changes('folder', {document.folder_id for document in documents})
+    references = {}
+    for document in documents:
+        if document.content_hash:
+            references[document.content_hash] = references.get(document.content_hash, 0) + 1
+    
+    for start in range(0, len(ids), IN_CLAUSE_CHUNK):
+        chunk = ids[start:start + IN_CLAUSE_CHUNK]
+        db.session.execute(delete(ProcessingJob).where(ProcessingJob.document_id.in_(chunk)))
+        remove_from_index('document', chunk)
+        db.session.execute(
+            delete(Document).where(Document.id.in_(chunk)).execution_options(synchronize_session=False)
+        )
+    released = release_blobs(references) if references else set()
+    
+    keys, previews = set(), set()
+    for document in documents:
+        if not document.content_hash:
+            keys.add(document_key(document))
+        if not document.content_hash or document.content_hash in released:
+            if document.preview_path:
+                previews.add(document.preview_path)
+    return released, keys, previews
+
+def remove_released_blob(content_hash):
+    """Delete the file of a released blob unless the contents were uploaded again.
+
+    A marker row without references claims the hash while the file goes.
+    An upload of the same contents that got there first makes the insert
+    fail and the file stays; one that comes later waits for the marker,
+    finds no file and stores its own copy.
+    """
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(insert(Blob).values(sha256=content_hash, size=0, ref_count=0))
+            remove_blob(content_hash)
+            connection.execute(delete(Blob).where(Blob.sha256 == content_hash, Blob.ref_count == 0))
+    except IntegrityError:
+        pass
+
+def remove_files(removed):
+    blobs, keys, previews = removed
+    for content_hash in blobs:
+        remove_released_blob(content_hash)
+    for key in keys:
+        storage_backend().delete(key)
+    # Previews are generated on local disk whatever the backend
+    for path in previews:
+        if os.path.exists(path):
+            os.remove(path)
+
+@documents_bp.route('/documents/batch', methods=['POST'])
+@login_required
+@retry_transient
+def batch_documents():
+    """Apply many move, update and delete operations in one transaction.
+
+    Takes {"operations": [{"op": "move", "id": 1, "folder_id": 2},
+    {"op": "update", "id": 3, "description": "..."}, {"op": "delete", "id": 4}]}.
+    Every operation is validated up front; the valid ones are applied
+    together and each gets a result with its own status code.
+    """
+    data = request.json or {}
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'error': 'operations must be a non-empty list'}), 400
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return jsonify({'error': f'At most {MAX_BATCH_OPERATIONS} operations per batch'}), 400
+    
+    results = [None] * len(operations)
+    
+    def reject(index, status, error):
+        results[index] = {'index': index, 'status': status, 'error': error}
+    
+    # Shape checks; a document may only appear once per batch
+    seen = set()
+    candidates = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in BATCH_OPERATIONS:
+            reject(index, 400, f"op must be one of {', '.join(sorted(BATCH_OPERATIONS))}")
+        elif not isinstance(operation.get('id'), int):
+            reject(index, 400, 'id must be an integer')
+        elif operation['op'] == 'move' and 'folder_id' not in operation:
+            reject(index, 400, 'folder_id is required')
+        elif operation['op'] == 'move' and operation['folder_id'] is not None and not isinstance(operation['folder_id'], int):
+            reject(index, 400, 'folder_id must be an integer or null')
+        elif operation['op'] == 'update' and 'description' not in operation:
+            reject(index, 400, 'description is required')
+        elif operation['id'] in seen:
+            reject(index, 409, 'Document appears more than once in this batch')
+        else:
+            seen.add(operation['id'])
+            candidates.append(index)
+    
+    # Documents and target folders are looked up with IN lists, not per item
+    documents = {
+        document.id: document for document in _load_in_chunks(
+            lambda chunk: Document.query.filter(Document.id.in_(chunk)).all(),
+            {operations[index]['id'] for index in candidates}
+        )
+    }
+    target_folders = {operations[index]['folder_id'] for index in candidates if operations[index]['op'] == 'move'} - {None}
+    existing_folders = set(_load_in_chunks(
+        lambda chunk: db.session.execute(select(Folder.id).where(Folder.id.in_(chunk))).scalars().all(),
+        target_folders
+    ))
+    
+    moves, updates, deletions = {}, [], []
+    changed_folders = set()
+    for index in candidates:
+        operation = operations[index]
+        document = documents.get(operation['id'])
+        if document is None:
+            reject(index, 404, 'Document not found')
+        elif not can_modify(document.uploaded_by):
+            reject(index, 403, 'Permission denied')
+        elif operation['op'] == 'move' and operation['folder_id'] is not None and operation['folder_id'] not in existing_folders:
+            reject(index, 404, 'Folder not found')
+        else:
+            changed_folders.add(document.folder_id)
+            if operation['op'] == 'move':
+                moves.setdefault(operation['folder_id'], []).append(document.id)
+                changed_folders.add(operation['folder_id'])
+            elif operation['op'] == 'update':
+                updates.append((document, operation['description']))
+            else:
+                deletions.append(document)
+            results[index] = {'index': index, 'id': document.id, 'op': operation['op'], 'status': 200}
+    
+    for folder_id, ids in moves.items():
+        for start in range(0, len(ids), IN_CLAUSE_CHUNK):
+            db.session.execute(
+                update(Document).where(Document.id.in_(ids[start:start + IN_CLAUSE_CHUNK]))
+                .values(folder_id=folder_id)
+            )
+    if updates:
+        db.session.execute(update(Document), [
+            {'id': document.id, 'description': description} for document, description in updates
+        ])
+        for document, description in updates:
+            set_committed_value(document, 'description', description)
+            index_document(document)
+    removed_files = delete_documents(deletions) if deletions else (set(), set(), set())
+    if changed_folders:
+        mark_folders_changed(changed_folders)
+        record_changes('document', [document_id for ids in moves.values() for document_id in ids])
+        record_changes('document', [document.id for document, _ in updates])
+        if moves:
+            record_changes('folder', changed_folders)
+        # One event for the whole batch rather than one per document
+        publish('documents.batch', {
+            'moved': [document_id for ids in moves.values() for document_id in ids],
+            'updated': [document.id for document, _ in updates],
+            'deleted': [document.id for document in deletions]
+        }, map(folder_topic, changed_folders))
+    db.session.commit()
+    
+    # Files go only after the rows are gone for good
+    remove_files(removed_files)
+    
+    succeeded = sum(1 for result in results if result['status'] == 200)
+    return jsonify({
+        'results': results,
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded
+    })
+
+
+@documents_bp.route('/documents/uploads', methods=['POST'])
+@login_required
+def create_upload_session():
+    """Start a chunked upload; the document is created when it is completed"""
+    if RAILWAY_MODE:
+        return jsonify({'error': 'File uploads are disabled on Railway due to read-only filesystem. Use local deployment, Azure or STORAGE_BACKEND=s3 for file uploads.'}), 400
+    
+    data = request.json or {}
+    filename = secure_filename(data.get('filename') or '')
+    total_size = data.get('total_size')
+    
+    if not filename:
+        return jsonify({'error': 'filename is required'}), 400
+    
+    if not allowed_file(filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+    
+    if not isinstance(total_size, int) or total_size < 0 or total_size > MAX_UPLOAD_SIZE:
+        return jsonify({'error': f'total_size must be between 0 and {MAX_UPLOAD_SIZE} bytes'}), 400
+    
+    chunk_size = data.get('chunk_size', DEFAULT_CHUNK_SIZE)
+    if not isinstance(chunk_size, int) or not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+        return jsonify({'error': f'chunk_size must be between {MIN_CHUNK_SIZE} and {MAX_CHUNK_SIZE} bytes'}), 400
+    
+    folder_id = data.get('folder_id')
+    if folder_id and not Folder.query.get(folder_id):
+        return jsonify({'error': 'Folder not found'}), 404
+    
+    expire_upload_sessions_periodically()
+    
+    upload = UploadSession(
+        id=uuid.uuid4().hex,
+        original_filename=filename,
+        mime_type=data.get('mime_type') or 'application/octet-stream',
+        description=data.get('description', ''),
+        folder_id=folder_id,
+        uploaded_by=session['user_id'],
+        total_size=total_size,
+        chunk_size=chunk_size
+    )
+    
+    # Contents that are already stored need no chunks at all
+    content_hash = (data.get('sha256') or '').lower()
+    if content_hash and blob_exists(content_hash) and Blob.query.filter_by(sha256=content_hash, size=total_size).first():
+        upload.content_hash = content_hash
+        upload.received_size = total_size
+        upload.next_chunk = upload.chunk_count
+    
+    db.session.add(upload)
+    db.session.commit()
+    
+    return jsonify(upload.to_dict()), 201
+
+def get_own_upload(upload_id):
+    upload = UploadSession.query.get_or_404(upload_id)
+    if upload.uploaded_by != session['user_id']:
+        return None
+    return upload
+
+def lease_upload(upload_id, *conditions):
+    """Take the write lease on an upload session with a conditional UPDATE.
+
+    Serializes requests for the session across processes. Returns the
+    lease token, or None while another request holds an unexpired lease or
+    conditions do not hold.
+    """
+    now = datetime.utcnow()
+    token = uuid.uuid4().hex
+    leased = db.session.execute(
+        update(UploadSession)
+        .where(
+            UploadSession.id == upload_id,
+            or_(UploadSession.writing_until.is_(None), UploadSession.writing_until < now),
+            *conditions
+        )
+        .values(writer_token=token, writing_until=now + timedelta(seconds=UPLOAD_LEASE_SECONDS))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return token if leased else None
+
+def release_upload(upload_id, token, **values):
+    """Give up a lease, applying values only if it was still ours"""
+    released = db.session.execute(
+        update(UploadSession)
+        .where(UploadSession.id == upload_id, UploadSession.writer_token == token)
+        .values(writer_token=None, writing_until=None, **values)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return bool(released)
+
+def expire_upload_sessions():
+    """Remove sessions idle for UPLOAD_SESSION_TTL with their partial files"""
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=UPLOAD_SESSION_TTL)
+    expired = db.session.execute(
+        select(UploadSession.id).where(
+            UploadSession.updated_at < cutoff,
+            or_(UploadSession.writing_until.is_(None), UploadSession.writing_until < now)
+        )
+    ).scalars().all()
+    for start in range(0, len(expired), IN_CLAUSE_CHUNK):
+        db.session.execute(
+            delete(UploadSession)
+            .where(UploadSession.id.in_(expired[start:start + IN_CLAUSE_CHUNK]), UploadSession.updated_at < cutoff)
+            .execution_options(synchronize_session=False)
+        )
+    db.session.commit()
+    for upload_id in expired:
+        discard_partial(upload_id)
+    # Also what crashed requests and other processes left behind
+    remove_stale_partials(UPLOAD_SESSION_TTL)
+    return len(expired)
+
+_last_upload_sweep = 0.0
+_upload_sweep_lock = threading.Lock()
+
+def expire_upload_sessions_periodically():
+    """Sweep at most once per UPLOAD_SWEEP_INTERVAL in this process"""
+    global _last_upload_sweep
+    with _upload_sweep_lock:
+        if time.monotonic() - _last_upload_sweep < UPLOAD_SWEEP_INTERVAL:
+            return
+        _last_upload_sweep = time.monotonic()
+    expire_upload_sessions()
+
+@documents_bp.route('/documents/uploads/<upload_id>', methods=['GET'])
+@login_required
+def get_upload_session(upload_id):
+    """Report upload progress so a client can resume after a disconnect"""
+    upload = get_own_upload(upload_id)
+    if not upload:
+        return jsonify({'error': 'Permission denied'}), 403
+    return jsonify(upload.to_dict())
+
+@documents_bp.route('/documents/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id, index):
+    """Stream one numbered chunk to disk.
+
+    Chunks are appended in order. Re-sending a chunk that was already stored
+    is a no-op, so clients can blindly retry the last chunk after a dropped
+    connection. While another request writes the chunk the answer is a 409
+    to retry. An X-Chunk-SHA256 header is verified against the body.
+    """
+    upload = get_own_upload(upload_id)
+    if not upload:
+        return jsonify({'error': 'Permission denied'}), 403
+    
+    if index >= upload.chunk_count:
+        return jsonify({'error': 'Chunk index out of range'}), 400
+    
+    # Only the request holding the lease writes, whichever process it is in
+    token = lease_upload(upload_id, UploadSession.next_chunk == index)
+    db.session.refresh(upload)
+    if not token:
+        if index < upload.next_chunk:
+            return jsonify(upload.to_dict())
+        if index > upload.next_chunk:
+            return jsonify({'error': 'Chunks must be sent in order', 'next_chunk': upload.next_chunk}), 409
+        return jsonify({'error': 'Chunk is being written by another request', 'next_chunk': upload.next_chunk}), 409
+    
+    offset = upload.received_size
+    length = upload.chunk_length(index)
+    try:
+        chunk_sha256 = write_chunk(upload_id, offset, length, request.stream, request.headers.get('X-Chunk-SHA256'))
+    except ChunkError as e:
+        release_upload(upload_id, token)
+        return jsonify({'error': str(e), 'next_chunk': index}), 400
+    except Exception:
+        release_upload(upload_id, token)
+        raise
+    
+    if not release_upload(upload_id, token, received_size=offset + length, next_chunk=index + 1):
+        # Aborted or expired meanwhile; nothing will complete this file
+        if not db.session.get(UploadSession, upload_id):
+            discard_partial(upload_id)
+        return jsonify({'error': 'Upload session is no longer active'}), 409
+    
+    db.session.refresh(upload)
+    result = upload.to_dict()
+    result['chunk_sha256'] = chunk_sha256
+    return jsonify(result)
+
+@documents_bp.route('/documents/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def complete_upload_session(upload_id):
+    """Turn a fully received upload into a document"""
+    upload = get_own_upload(upload_id)
+    if not upload:
+        return jsonify({'error': 'Permission denied'}), 403
+    
+    if upload.received_size != upload.total_size:
+        return jsonify({'error': 'Upload is incomplete', 'next_chunk': upload.next_chunk}), 409
+    
+    if upload.folder_id and not Folder.query.get(upload.folder_id):
+        return jsonify({'error': 'Folder not found'}), 404
+    
+    expected = (request.get_json(silent=True) or {}).get('sha256')
+    
+    # One completion at a time across processes; the session row goes
+    # in the same commit as the new document
+    token = lease_upload(upload_id, UploadSession.received_size == UploadSession.total_size)
+    if not token:
+        return jsonify({'error': 'Upload is already being completed'}), 409
+    db.session.refresh(upload)
+    
+    if upload.content_hash:
+        content_hash = upload.content_hash
+        if expected and expected.lower() != content_hash:
+            release_upload(upload_id, token)
+            return jsonify({'error': 'File checksum mismatch', 'sha256': content_hash}), 400
+        if not blob_exists(content_hash):
+            # The shared copy was deleted meanwhile; fall back to sending chunks
+            release_upload(upload_id, token, content_hash=None, received_size=0, next_chunk=0)
+            return jsonify({'error': 'Upload is incomplete', 'next_chunk': 0}), 409
+    else:
+        try:
+            content_hash = finish_partial(upload_id, upload.total_size, expected)
+        except ChunkError as e:
+            db.session.delete(upload)
+            db.session.commit()
+            return jsonify({'error': str(e)}), 400
+        except PartialMissing:
+            # The received bytes were lost; the client starts over
+            release_upload(upload_id, token, received_size=0, next_chunk=0)
+            return jsonify({'error': 'Upload is incomplete', 'next_chunk': 0}), 409
+        except Exception:
+            release_upload(upload_id, token)
+            raise
+        # The partial file is now a blob; a retry after a failure below
+        # completes from the hash instead of the partial file
+        upload.content_hash = content_hash
+        upload.received_size = upload.total_size
+    
+    try:
+        acquire_blob(content_hash, upload.total_size)
+        
+        document = Document(
+            filename=content_hash,
+            original_filename=upload.original_filename,
+            file_path=blob_path(content_hash),
+            file_size=upload.total_size,
+            mime_type=upload.mime_type,
+            uploaded_by=upload.uploaded_by,
+            description=upload.description,
+            folder_id=upload.folder_id,
+            content_hash=content_hash
+        )
+        
+        db.session.add(document)
+        db.session.delete(upload)
+        db.session.flush()
+        index_document(document)
+        enqueue_processing(document)
+        mark_folders_changed([upload.folder_id])
+        record_changes('document', [document.id])
+        record_changes('folder', [upload.folder_id])
+        publish('document.created', {'id': document.id, 'folder_id': upload.folder_id}, [folder_topic(upload.folder_id)])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        release_upload(upload_id, token, content_hash=content_hash)
+        raise
+    
+    notify_new_jobs()
+    
+    return jsonify({'message': 'File uploaded successfully', 'document': document.to_dict()}), 201
+
+@documents_bp.route('/documents/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def abort_upload_session(upload_id):
+    """Abandon an upload and free its partial file"""
+    upload = get_own_upload(upload_id)
+    if not upload:
+        return jsonify({'error': 'Permission denied'}), 403
+    
+    db.session.delete(upload)
+    db.session.commit()
+    # A chunk still being written is dropped by its request or the sweep
+    discard_partial(upload_id)
+    
+    return '', 204
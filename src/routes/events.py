@@ -0,0 +1,39 @@
+from flask import Blueprint, Response, jsonify, request
+from src.routes.user import login_required
+from src.database import no_retry
+from src.events import broker, event_stream, folder_topic, question_topic, QUESTIONS_TOPIC
+
+events_bp = Blueprint('events', __name__)
+
+@events_bp.route('/events', methods=['GET'])
+@login_required
+@no_retry
+def stream_events():
+    """Server-sent events for changes to folders, documents and Q&A.
+
+    Subscribe with any of folder=<id|root> (repeatable) for the contents of
+    a folder, question=<id> (repeatable) for one thread, and questions=true
+    for the question list; without any, every event is delivered. Resumes
+    after the Last-Event-ID header (or last_event_id); a "reset" event
+    means events were missed and the client should reload.
+    """
+    topics = set()
+    for folder in request.args.getlist('folder'):
+        if folder != 'root' and not folder.isdigit():
+            return jsonify({'error': 'folder must be a folder id or root'}), 400
+        topics.add(folder_topic(None if folder == 'root' else int(folder)))
+    for question in request.args.getlist('question'):
+        if not question.isdigit():
+            return jsonify({'error': 'question must be a question id'}), 400
+        topics.add(question_topic(int(question)))
+    if request.args.get('questions', '').lower() == 'true':
+        topics.add(QUESTIONS_TOPIC)
+    
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    after, missed = broker.resume_point(last_event_id)
+    
+    response = Response(event_stream(topics or None, after, missed), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,9 +1,20 @@
-from flask import Blueprint, request, jsonify, session
-from models.user import db, Folder, Document, User
+from flask import Blueprint, Response, request, jsonify, session
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import secure_filename
+from src.models.user import db, Folder, Document, serialize_folders, serialize_documents, subtree_bounds, folder_tree
+from src.archive import stream_zip
+from src.storage import document_key, storage_backend
+from src.cache import cached_listing, mark_folders_changed
+from src.events import publish, folder_topic
+from src.changes import record_changes
+from src.routes.user import can_modify
+from src.pagination import paginated_response
 
 folders_bp = Blueprint('folders', __name__)
 
 @folders_bp.route('/folders', methods=['GET'])
+@cached_listing(lambda: request.args.get('parent_id', type=int))
 def get_folders():
     """Get all folders or folders in a specific parent folder"""
     if 'user_id' not in session:
@@ -12,12 +23,29 @@ def get_folders():
     parent_id = request.args.get('parent_id', type=int)
     
     if parent_id:
-        folders = Folder.query.filter_by(parent_id=parent_id).all()
+        folders = Folder.query.filter_by(parent_id=parent_id)
     else:
         # Get root folders (no parent)
-        folders = Folder.query.filter_by(parent_id=None).all()
+        folders = Folder.query.filter_by(parent_id=None)
     
-    return jsonify([folder.to_dict() for folder in folders])
+    return paginated_response(folders, [(Folder.name, False), (Folder.id, False)], serialize_folders)
+
+@folders_bp.route('/folders/tree', methods=['GET'])
+@cached_listing()
+def get_folder_tree():
+    """Get the whole folder hierarchy, or one subtree, as nested nodes"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    root_id = request.args.get('root_id', type=int)
+    depth = request.args.get('depth', type=int)
+    with_sizes = request.args.get('sizes', 'false').lower() == 'true'
+    
+    if depth is not None and depth < 0:
+        return jsonify({'error': 'depth must be a non-negative integer'}), 400
+    
+    root = Folder.query.get_or_404(root_id) if root_id else None
+    return jsonify(folder_tree(root, depth, with_sizes))
 
 @folders_bp.route('/folders', methods=['POST'])
 def create_folder():
@@ -29,16 +57,19 @@ def create_folder():
     if not data or 'name' not in data:
         return jsonify({'error': 'Folder name is required'}), 400
     
-    # Check if folder with same name exists in the same parent
+    # Names are unique per parent through uq_folder_parent_name. SQLite
+    # treats the NULL parent of top-level folders as distinct, so those are
+    # still checked here.
     parent_id = data.get('parent_id')
-    existing = Folder.query.filter_by(
-        name=data['name'], 
-        parent_id=parent_id
-    ).first()
-    
-    if existing:
+    if not parent_id and Folder.query.filter_by(name=data['name'], parent_id=None).first():
         return jsonify({'error': 'Folder with this name already exists in this location'}), 400
     
+    parent = None
+    if parent_id:
+        parent = Folder.query.get(parent_id)
+        if not parent:
+            return jsonify({'error': 'Parent folder not found'}), 404
+    
     folder = Folder(
         name=data['name'],
         parent_id=parent_id,
@@ -48,13 +79,24 @@ def create_folder():
     
     try:
         db.session.add(folder)
+        # The id is part of the materialized path, so flush before placing
+        db.session.flush()
+        folder.place_under(parent)
+        mark_folders_changed([parent_id])
+        # The parent's subfolder count changed too
+        record_changes('folder', [folder.id, parent_id])
+        publish('folder.created', {'id': folder.id, 'parent_id': parent_id}, [folder_topic(parent_id)])
         db.session.commit()
         return jsonify(folder.to_dict()), 201
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'Folder with this name already exists in this location'}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': 'Failed to create folder'}), 500
 
 @folders_bp.route('/folders/<int:folder_id>', methods=['GET'])
+@cached_listing(lambda folder_id: folder_id)
 def get_folder(folder_id):
     """Get a specific folder with its contents"""
     if 'user_id' not in session:
@@ -69,8 +111,8 @@ def get_folder(folder_id):
     documents = Document.query.filter_by(folder_id=folder_id).all()
     
     folder_data = folder.to_dict()
-    folder_data['subfolders'] = [f.to_dict() for f in subfolders]
-    folder_data['documents'] = [d.to_dict() for d in documents]
+    folder_data['subfolders'] = serialize_folders(subfolders)
+    folder_data['documents'] = serialize_documents(documents)
     
     return jsonify(folder_data)
 
@@ -81,29 +123,16 @@ def update_folder(folder_id):
         return jsonify({'error': 'Not authenticated'}), 401
     
     folder = Folder.query.get_or_404(folder_id)
+    old_parent_id = folder.parent_id
     
     # Check if user is admin or folder creator
-    user = User.query.get(session['user_id'])
-    if not user.is_admin and folder.created_by != session['user_id']:
+    if not can_modify(folder.created_by):
         return jsonify({'error': 'Permission denied'}), 403
     
     data = request.get_json()
     if not data:
         return jsonify({'error': 'No data provided'}), 400
     
-    # Update folder properties
-    if 'name' in data:
-        # Check if new name conflicts with existing folder
-        existing = Folder.query.filter_by(
-            name=data['name'], 
-            parent_id=folder.parent_id
-        ).filter(Folder.id != folder_id).first()
-        
-        if existing:
-            return jsonify({'error': 'Folder with this name already exists in this location'}), 400
-        
-        folder.name = data['name']
-    
     if 'description' in data:
         folder.description = data['description']
     
@@ -114,20 +143,45 @@ def update_folder(folder_id):
             return jsonify({'error': 'Cannot move folder into itself'}), 400
         
         # Check for circular reference
+        parent = None
         if new_parent_id:
             parent = Folder.query.get(new_parent_id)
-            if parent:
-                current = parent
-                while current:
-                    if current.id == folder_id:
-                        return jsonify({'error': 'Cannot move folder into its subfolder'}), 400
-                    current = current.parent
+            if not parent:
+                return jsonify({'error': 'Parent folder not found'}), 404
+            if parent.is_within(folder):
+                return jsonify({'error': 'Cannot move folder into its subfolder'}), 400
         
-        folder.parent_id = new_parent_id
+        if new_parent_id != folder.parent_id:
+            # A name clash with the new siblings is reported on commit below
+            with db.session.no_autoflush:
+                folder.move_to(parent)
+    
+    # Clashes below a parent surface as an IntegrityError from
+    # uq_folder_parent_name; top level is checked as in create_folder
+    name = data.get('name', folder.name)
+    if folder.parent_id is None and (name != folder.name or old_parent_id is not None):
+        with db.session.no_autoflush:
+            clash = Folder.query.filter_by(name=name, parent_id=None).filter(Folder.id != folder_id).first()
+        if clash:
+            db.session.rollback()
+            return jsonify({'error': 'Folder with this name already exists in this location'}), 400
+    folder.name = name
     
     try:
+        # Paths shown anywhere below the folder may have changed
+        subtree_ids = [row.id for row in folder.descendants(include_self=True).with_entities(Folder.id)]
+        mark_folders_changed(subtree_ids + [old_parent_id, folder.parent_id])
+        record_changes('folder', subtree_ids + [old_parent_id, folder.parent_id])
+        publish(
+            'folder.updated',
+            {'id': folder.id, 'parent_id': folder.parent_id, 'previous_parent_id': old_parent_id},
+            {folder_topic(folder.id), folder_topic(old_parent_id), folder_topic(folder.parent_id)}
+        )
         db.session.commit()
         return jsonify(folder.to_dict())
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'Folder with this name already exists in this location'}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': 'Failed to update folder'}), 500
@@ -141,8 +195,7 @@ def delete_folder(folder_id):
     folder = Folder.query.get_or_404(folder_id)
     
     # Check if user is admin or folder creator
-    user = User.query.get(session['user_id'])
-    if not user.is_admin and folder.created_by != session['user_id']:
+    if not can_modify(folder.created_by):
         return jsonify({'error': 'Permission denied'}), 403
     
     # Check if folder has contents
@@ -160,28 +213,33 @@ def delete_folder(folder_id):
         }), 400
     
     try:
-        if force_delete:
-            # Delete all documents in folder (move to root or delete files)
-            documents = Document.query.filter_by(folder_id=folder_id).all()
-            for doc in documents:
-                doc.folder_id = None  # Move to root instead of deleting
-            
-            # Recursively delete subfolders
-            def delete_subfolder(parent_id):
-                subfolders = Folder.query.filter_by(parent_id=parent_id).all()
-                for subfolder in subfolders:
-                    delete_subfolder(subfolder.id)
-                    # Move documents to root
-                    docs = Document.query.filter_by(folder_id=subfolder.id).all()
-                    for doc in docs:
-                        doc.folder_id = None
-                    db.session.delete(subfolder)
-            
-            delete_subfolder(folder_id)
-        
-        db.session.delete(folder)
+        # Move every document in the subtree to root, then drop the whole
+        # subtree; both are single set-based statements on the tree_path index
+        subtree_ids = folder.descendants(include_self=True).with_entities(Folder.id)
+        deleted_ids = [row.id for row in subtree_ids]
+        mark_folders_changed(deleted_ids + [None])
+        moved_ids = db.session.execute(
+            select(Document.id).where(Document.folder_id.in_(subtree_ids.scalar_subquery()))
+        ).scalars().all()
+        record_changes('folder', deleted_ids, deleted=True)
+        record_changes('folder', [folder.parent_id])
+        record_changes('document', moved_ids)
+        # Documents of the subtree move to the top level
+        publish(
+            'folder.deleted',
+            {'id': folder.id, 'parent_id': folder.parent_id, 'folder_ids': deleted_ids},
+            {folder_topic(folder.parent_id), folder_topic(None)} | {folder_topic(folder_id) for folder_id in deleted_ids}
+        )
+        documents_moved = Document.query.filter(
+            Document.folder_id.in_(subtree_ids.scalar_subquery())
+        ).update({Document.folder_id: None}, synchronize_session=False)
+        folders_deleted = folder.descendants(include_self=True).delete(synchronize_session=False)
         db.session.commit()
-        return jsonify({'message': 'Folder deleted successfully'})
+        return jsonify({
+            'message': 'Folder deleted successfully',
+            'folders_deleted': folders_deleted,
+            'documents_moved': documents_moved
+        })
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': 'Failed to delete folder'}), 500
@@ -194,15 +252,76 @@ def get_folder_breadcrumb(folder_id):
     
     folder = Folder.query.get_or_404(folder_id)
     
-    breadcrumb = []
-    current = folder
-    
-    while current:
-        breadcrumb.insert(0, {
-            'id': current.id,
-            'name': current.name
-        })
-        current = current.parent
+    breadcrumb = [
+        {'id': current.id, 'name': current.name}
+        for current in folder.ancestors(include_self=True)
+    ]
     
     return jsonify(breadcrumb)
 
+
+def _archive_name(name):
+    """Make a folder or file name safe to use as one ZIP path component"""
+    cleaned = name.replace('/', '_').replace('\\', '_').strip()
+    return cleaned if cleaned not in ('', '.', '..') else '_'
+
+def archive_manifest(folder):
+    """List the entries of a folder's archive with two queries.
+
+    Paths are relative to the folder and built from the loaded subtree, so
+    the cost does not grow with the number of subfolders. Documents are
+    listed by storage key; stream_zip leaves out any whose file is missing.
+    """
+    folders = folder.descendants(include_self=True).order_by(Folder.depth, Folder.id).all()
+    lower, upper = subtree_bounds(folder.tree_path)
+    documents = (
+        Document.query.join(Folder, Folder.id == Document.folder_id)
+        .filter(Folder.tree_path >= lower, Folder.tree_path < upper)
+        .order_by(Document.folder_id, Document.original_filename, Document.id)
+        .all()
+    )
+    
+    # Parents come before children in depth order
+    paths = {}
+    taken = set()
+    entries = []
+    for current in folders:
+        if current.id == folder.id:
+            path = _archive_name(folder.name)
+        else:
+            path = f"{paths[current.parent_id]}/{_archive_name(current.name)}"
+        paths[current.id] = path
+        taken.add(path)
+        entries.append((path, None, 0, current.created_at))
+    
+    for document in documents:
+        name = f"{paths[document.folder_id]}/{_archive_name(document.original_filename)}"
+        # Same-named files in one folder get a counter, as desktop unzippers would
+        stem, dot, extension = name.rpartition('.')
+        if not dot or '/' in extension:
+            stem, dot, extension = name, '', ''
+        counter = 1
+        while name in taken:
+            counter += 1
+            name = f"{stem} ({counter}){dot}{extension}"
+        taken.add(name)
+        entries.append((name, document_key(document), document.file_size, document.uploaded_at))
+    return entries
+
+@folders_bp.route('/folders/<int:folder_id>/archive', methods=['GET'])
+def download_folder_archive(folder_id):
+    """Stream a folder and everything below it as a ZIP file"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    folder = Folder.query.get_or_404(folder_id)
+    entries = archive_manifest(folder)
+    
+    # The manifest is complete, so the stream itself needs no database access
+    response = Response(stream_zip(entries, storage_backend().open_blocks), mimetype='application/zip', direct_passthrough=True)
+    filename = secure_filename(folder.name) or f'folder-{folder.id}'
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}.zip"'
+    response.headers['Cache-Control'] = 'private, no-store'
+    # Tell nginx not to buffer the whole archive before relaying it
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,17 +1,66 @@
+from datetime import datetime
 from flask import Blueprint, jsonify, request, session
-from src.models.user import Question, Answer, User, db
-from src.routes.user import login_required
+from src.models.user import (
+    Question, Answer, db, serialize_questions, serialize_answers,
+    record_answer_added, record_answer_removed, touch_question
+)
+from src.routes.user import login_required, can_modify
+from src.database import retry_transient
+from src.pagination import paginated_response, project
+from src.search import index_question, index_answer, remove_from_index
+from src.events import publish, question_topic, QUESTIONS_TOPIC
+from src.changes import record_changes
 
 qa_bp = Blueprint('qa', __name__)
 
+# Keys of the summary listing; it never reads the answer table
+SUMMARY_FIELDS = {
+    'id', 'title', 'asked_by', 'asker_name', 'asked_at',
+    'is_answered', 'answer_count', 'last_activity_at'
+}
+
+QUESTION_ORDERINGS = {
+    'asked': [(Question.asked_at, True), (Question.id, True)],
+    'activity': [(Question.last_activity_at, True), (Question.id, True)],
+    'unanswered': [(Question.is_answered, False), (Question.last_activity_at, True), (Question.id, True)]
+}
+
 @qa_bp.route('/questions', methods=['GET'])
 @login_required
 def get_questions():
-    questions = Question.query.order_by(Question.asked_at.desc()).all()
-    return jsonify([question.to_dict() for question in questions])
+    """List questions.
+
+    The default summary view leaves answers out and never reads the answer
+    table. view=full embeds every question's answers and is always
+    paginated. Either can be sorted by sort=asked|activity|unanswered and
+    filtered with answered=true|false; single threads are loaded from
+    GET /questions/<id>.
+    """
+    sort = request.args.get('sort', 'asked')
+    if sort not in QUESTION_ORDERINGS:
+        return jsonify({'error': f"sort must be one of {', '.join(QUESTION_ORDERINGS)}"}), 400
+    
+    view = request.args.get('view', 'summary')
+    if view not in ('summary', 'full'):
+        return jsonify({'error': 'view must be summary or full'}), 400
+    
+    questions = Question.query
+    answered = request.args.get('answered')
+    if answered is not None:
+        questions = questions.filter(Question.is_answered == (answered.lower() == 'true'))
+    
+    if view == 'full':
+        return paginated_response(questions, QUESTION_ORDERINGS[sort], serialize_questions, always_paginate=True)
+    
+    def serialize(rows, fields):
+        fields = fields & SUMMARY_FIELDS if fields else SUMMARY_FIELDS
+        return project(serialize_questions(rows, fields), fields)
+    
+    return paginated_response(questions, QUESTION_ORDERINGS[sort], serialize)
 
 @qa_bp.route('/questions', methods=['POST'])
 @login_required
+@retry_transient
 def create_question():
     data = request.json
     
@@ -25,6 +74,10 @@ def create_question():
     )
     
     db.session.add(question)
+    db.session.flush()
+    index_question(question)
+    record_changes('question', [question.id])
+    publish('question.created', {'id': question.id}, [QUESTIONS_TOPIC, question_topic(question.id)])
     db.session.commit()
     
     return jsonify({'message': 'Question created successfully', 'question': question.to_dict()}), 201
@@ -37,32 +90,42 @@ def get_question(question_id):
 
 @qa_bp.route('/questions/<int:question_id>', methods=['PUT'])
 @login_required
+@retry_transient
 def update_question(question_id):
     question = Question.query.get_or_404(question_id)
     
     # Only allow the asker or admin to update
-    user = User.query.get(session['user_id'])
-    if question.asked_by != session['user_id'] and not user.is_admin:
+    if not can_modify(question.asked_by):
         return jsonify({'error': 'Permission denied'}), 403
     
     data = request.json
     question.title = data.get('title', question.title)
     question.content = data.get('content', question.content)
+    question.last_activity_at = datetime.utcnow()
+    index_question(question)
+    record_changes('question', [question.id])
+    publish('question.updated', {'id': question.id}, [QUESTIONS_TOPIC, question_topic(question.id)])
     
     db.session.commit()
     return jsonify(question.to_dict())
 
 @qa_bp.route('/questions/<int:question_id>', methods=['DELETE'])
 @login_required
+@retry_transient
 def delete_question(question_id):
     question = Question.query.get_or_404(question_id)
     
     # Only allow the asker or admin to delete
-    user = User.query.get(session['user_id'])
-    if question.asked_by != session['user_id'] and not user.is_admin:
+    if not can_modify(question.asked_by):
         return jsonify({'error': 'Permission denied'}), 403
     
+    answer_ids = [answer.id for answer in question.answers]
+    remove_from_index('answer', answer_ids)
+    remove_from_index('question', [question.id])
+    record_changes('answer', answer_ids, deleted=True)
+    record_changes('question', [question.id], deleted=True)
     db.session.delete(question)
+    publish('question.deleted', {'id': question_id}, [QUESTIONS_TOPIC, question_topic(question_id)])
     db.session.commit()
     
     return jsonify({'message': 'Question deleted successfully'}), 200
@@ -72,10 +135,11 @@ def delete_question(question_id):
 def get_answers(question_id):
     question = Question.query.get_or_404(question_id)
     answers = Answer.query.filter_by(question_id=question_id).order_by(Answer.answered_at.asc()).all()
-    return jsonify([answer.to_dict() for answer in answers])
+    return jsonify(serialize_answers(answers))
 
 @qa_bp.route('/questions/<int:question_id>/answers', methods=['POST'])
 @login_required
+@retry_transient
 def create_answer(question_id):
     question = Question.query.get_or_404(question_id)
     data = request.json
@@ -91,8 +155,15 @@ def create_answer(question_id):
     
     db.session.add(answer)
     
-    # Mark question as answered
-    question.is_answered = True
+    # Mark question as answered and bump its counters
+    record_answer_added(question_id)
+    db.session.flush()
+    index_answer(answer)
+    # The question's answer count and activity changed with it
+    record_changes('answer', [answer.id])
+    record_changes('question', [question_id])
+    # Listings show answer counts, so the question list hears about answers too
+    publish('answer.created', {'id': answer.id, 'question_id': question_id}, [QUESTIONS_TOPIC, question_topic(question_id)])
     
     db.session.commit()
     
@@ -106,39 +177,43 @@ def get_answer(answer_id):
 
 @qa_bp.route('/answers/<int:answer_id>', methods=['PUT'])
 @login_required
+@retry_transient
 def update_answer(answer_id):
     answer = Answer.query.get_or_404(answer_id)
     
     # Only allow the answerer or admin to update
-    user = User.query.get(session['user_id'])
-    if answer.answered_by != session['user_id'] and not user.is_admin:
+    if not can_modify(answer.answered_by):
         return jsonify({'error': 'Permission denied'}), 403
     
     data = request.json
     answer.content = data.get('content', answer.content)
+    touch_question(answer.question_id)
+    index_answer(answer)
+    record_changes('answer', [answer.id])
+    record_changes('question', [answer.question_id])
+    publish('answer.updated', {'id': answer.id, 'question_id': answer.question_id}, [QUESTIONS_TOPIC, question_topic(answer.question_id)])
     
     db.session.commit()
     return jsonify(answer.to_dict())
 
 @qa_bp.route('/answers/<int:answer_id>', methods=['DELETE'])
 @login_required
+@retry_transient
 def delete_answer(answer_id):
     answer = Answer.query.get_or_404(answer_id)
     
     # Only allow the answerer or admin to delete
-    user = User.query.get(session['user_id'])
-    if answer.answered_by != session['user_id'] and not user.is_admin:
+    if not can_modify(answer.answered_by):
         return jsonify({'error': 'Permission denied'}), 403
     
-    question_id = answer.question_id
     db.session.delete(answer)
+    remove_from_index('answer', [answer.id])
     
-    # Check if question still has answers
-    remaining_answers = Answer.query.filter_by(question_id=question_id).count()
-    if remaining_answers == 0:
-        question = Question.query.get(question_id)
-        if question:
-            question.is_answered = False
+    # Question stays answered while other answers remain
+    record_answer_removed(answer.question_id)
+    record_changes('answer', [answer_id], deleted=True)
+    record_changes('question', [answer.question_id])
+    publish('answer.deleted', {'id': answer_id, 'question_id': answer.question_id}, [QUESTIONS_TOPIC, question_topic(answer.question_id)])
     
     db.session.commit()
     
@@ -0,0 +1,45 @@
+from flask import Blueprint, jsonify, request
+from src.models.user import Folder
+from src.routes.user import login_required
+from src.database import use_replica
+from src.pagination import PaginationError, parse_count, parse_limit
+from src.search import search
+
+search_bp = Blueprint('search', __name__)
+
+SEARCHABLE_KINDS = {'document', 'question', 'answer'}
+MAX_SEARCH_RESULTS = 100
+
+@search_bp.route('/search', methods=['GET'])
+@login_required
+@use_replica
+def search_content():
+    """Ranked full-text search with highlighted snippets.
+
+    Query parameters: q (required), kinds=document,question,answer,
+    folder_id to search only documents in that folder's subtree, and
+    limit/offset for paging.
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'q is required'}), 400
+    
+    kinds = None
+    if request.args.get('kinds'):
+        kinds = {kind.strip() for kind in request.args['kinds'].split(',') if kind.strip()}
+        if not kinds <= SEARCHABLE_KINDS:
+            return jsonify({'error': f"kinds must be a subset of {', '.join(sorted(SEARCHABLE_KINDS))}"}), 400
+    
+    folder = None
+    folder_id = request.args.get('folder_id', type=int)
+    if folder_id:
+        folder = Folder.query.get_or_404(folder_id)
+    
+    try:
+        limit = parse_limit(request.args.get('limit'), 20, MAX_SEARCH_RESULTS)
+        offset = parse_count('offset', request.args.get('offset'), 0)
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    results = search(query, kinds=kinds, folder=folder, limit=limit, offset=offset)
+    return jsonify({'query': query, 'results': results, 'limit': limit, 'offset': offset})
@@ -1,13 +1,74 @@
-from flask import Blueprint, jsonify, request, session
+import os
+import threading
+import time
+from collections import namedtuple
+from flask import Blueprint, jsonify, request, session, g
 from src.models.user import User, db
+from src.pagination import paginated_response
+from src.cache import invalidate_all
+from src.passwords import (
+    HashingOverloaded, needs_rehash, login_retry_after, record_login_failure, clear_login_failures
+)
 from functools import wraps
 
 user_bp = Blueprint('user', __name__)
 
+# The signed-in user as seen by authorization checks. Plain values rather
+# than a User row so it can outlive the session that loaded it.
+Principal = namedtuple('Principal', ['id', 'username', 'is_admin', 'profile'])
+
+# Principals are kept in process for a short while so consecutive requests
+# from the same user skip the lookup. update_user/delete_user invalidate
+# explicitly; the TTL bounds staleness across worker processes.
+PRINCIPAL_CACHE_TTL = float(os.environ.get('PRINCIPAL_CACHE_TTL', 30))
+_principals = {}
+_principals_lock = threading.Lock()
+
+def load_principal(user_id):
+    """Resolve a user id to a Principal, from the cache when still fresh"""
+    now = time.monotonic()
+    with _principals_lock:
+        cached = _principals.get(user_id)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    user = db.session.get(User, user_id)
+    if user is None:
+        invalidate_principal(user_id)
+        return None
+    principal = Principal(user.id, user.username, bool(user.is_admin), user.to_dict())
+    if PRINCIPAL_CACHE_TTL > 0:
+        with _principals_lock:
+            _principals[user_id] = (now + PRINCIPAL_CACHE_TTL, principal)
+    return principal
+
+def invalidate_principal(user_id):
+    with _principals_lock:
+        _principals.pop(user_id, None)
+    g.pop('principal', None)
+
+def current_principal():
+    """The signed-in Principal, resolved at most once per request"""
+    user_id = session.get('user_id')
+    if user_id is None:
+        return None
+    # Keyed by user id so a login or logout within the context is noticed
+    cached = g.get('principal')
+    if cached is None or cached[0] != user_id:
+        cached = g.principal = (user_id, load_principal(user_id))
+    return cached[1]
+
+def can_modify(owner_id):
+    """Whether the signed-in user may change something owned by owner_id"""
+    principal = current_principal()
+    return principal is not None and (principal.is_admin or principal.id == owner_id)
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        if current_principal() is None:
+            # Also catches sessions of users deleted since they signed in
+            session.clear()
             return jsonify({'error': 'Authentication required'}), 401
         return f(*args, **kwargs)
     return decorated_function
@@ -15,14 +76,21 @@ def login_required(f):
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        principal = current_principal()
+        if principal is None:
+            session.clear()
             return jsonify({'error': 'Authentication required'}), 401
-        user = User.query.get(session['user_id'])
-        if not user or not user.is_admin:
+        if not principal.is_admin:
             return jsonify({'error': 'Admin access required'}), 403
         return f(*args, **kwargs)
     return decorated_function
 
+@user_bp.errorhandler(HashingOverloaded)
+def hashing_overloaded(error):
+    response = jsonify({'error': 'Server busy, please retry shortly'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
 @user_bp.route('/register', methods=['POST'])
 def register():
     data = request.json
@@ -55,33 +123,53 @@ def login():
     if not data.get('username') or not data.get('password'):
         return jsonify({'error': 'Username and password are required'}), 400
     
+    # Shed repeated failures before spending a hash on them
+    retry_after = login_retry_after(data['username'])
+    if retry_after:
+        response = jsonify({'error': 'Too many failed login attempts'})
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 429
+    
     user = User.query.filter_by(username=data['username']).first()
     
     if user and user.check_password(data['password']):
+        clear_login_failures(data['username'])
+        # Upgrade hashes made with older cost parameters while the password is at hand
+        try:
+            if needs_rehash(user.password_hash):
+                user.set_password(data['password'])
+                db.session.commit()
+        except HashingOverloaded:
+            # Not worth failing the login over; the next one will rehash
+            pass
         session['user_id'] = user.id
         session['username'] = user.username
         session['is_admin'] = user.is_admin
         return jsonify({'message': 'Login successful', 'user': user.to_dict()}), 200
     
+    record_login_failure(data['username'])
     return jsonify({'error': 'Invalid username or password'}), 401
 
 @user_bp.route('/logout', methods=['POST'])
 @login_required
 def logout():
+    invalidate_principal(session['user_id'])
     session.clear()
     return jsonify({'message': 'Logout successful'}), 200
 
 @user_bp.route('/me', methods=['GET'])
 @login_required
 def get_current_user():
-    user = User.query.get(session['user_id'])
-    return jsonify(user.to_dict())
+    return jsonify(current_principal().profile)
 
 @user_bp.route('/users', methods=['GET'])
 @admin_required
 def get_users():
-    users = User.query.all()
-    return jsonify([user.to_dict() for user in users])
+    return paginated_response(
+        User.query,
+        [(User.id, False)],
+        lambda users, fields: [user.to_dict() for user in users]
+    )
 
 @user_bp.route('/users', methods=['POST'])
 @admin_required
@@ -115,7 +203,10 @@ def update_user(user_id):
     if data.get('password'):
         user.set_password(data['password'])
     user.is_admin = data.get('is_admin', user.is_admin)
+    # Usernames appear in folder and document listings
+    invalidate_all()
     db.session.commit()
+    invalidate_principal(user_id)
     return jsonify(user.to_dict())
 
 @user_bp.route('/users/<int:user_id>', methods=['DELETE'])
@@ -123,5 +214,7 @@ def update_user(user_id):
 def delete_user(user_id):
     user = User.query.get_or_404(user_id)
     db.session.delete(user)
+    invalidate_all()
     db.session.commit()
+    invalidate_principal(user_id)
     return '', 204
@@ -0,0 +1,241 @@
+import html
+import math
+import re
+from sqlalchemy import select, delete, insert, func, case, text, and_
+from sqlalchemy.exc import OperationalError
+from src.models.user import db, SearchEntry, SearchTerm, Document, Folder, Question, Answer, subtree_bounds
+
+# Entries are indexed with SQLite FTS5 when the database supports it and
+# with the search_term inverted index everywhere else (SQL Server). Both
+# are written in the same transaction as the row being indexed.
+
+# Relative weight of matches in the title, body and extracted text
+FIELD_WEIGHTS = (10.0, 2.0, 1.0)
+# Upper bound on indexed text per field; keeps huge spreadsheets in check
+MAX_INDEXED_CHARS = 200000
+MAX_QUERY_TERMS = 8
+SNIPPET_CHARS = 160
+
+# Marker characters wrapped around matches before HTML escaping
+MARK_START, MARK_END = '\x02', '\x03'
+
+_backend = {}
+
+FTS5_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+        title, body, extracted,
+        content='search_entry', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS search_entry_ai AFTER INSERT ON search_entry BEGIN
+        INSERT INTO search_fts(rowid, title, body, extracted) VALUES (new.id, new.title, new.body, new.extracted);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS search_entry_ad AFTER DELETE ON search_entry BEGIN
+        INSERT INTO search_fts(search_fts, rowid, title, body, extracted) VALUES ('delete', old.id, old.title, old.body, old.extracted);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS search_entry_au AFTER UPDATE ON search_entry BEGIN
+        INSERT INTO search_fts(search_fts, rowid, title, body, extracted) VALUES ('delete', old.id, old.title, old.body, old.extracted);
+        INSERT INTO search_fts(rowid, title, body, extracted) VALUES (new.id, new.title, new.body, new.extracted);
+    END""",
+]
+
+def tokenize(value):
+    """Split text into lowercase index terms"""
+    return [token[:64] for token in re.findall(r'[^\W_]+', (value or '').lower()) if len(token) > 1]
+
+def search_backend():
+    """'fts5' on SQLite builds with FTS5, 'terms' otherwise"""
+    engine = db.engine
+    if engine not in _backend:
+        backend = 'terms'
+        if db.engine.dialect.name == 'sqlite':
+            try:
+                with db.engine.begin() as connection:
+                    for statement in FTS5_SCHEMA:
+                        connection.execute(text(statement))
+                backend = 'fts5'
+            except OperationalError:
+                pass
+        _backend[engine] = backend
+    return _backend[engine]
+
+def ensure_search_index():
+    """Create the FTS5 table if needed and index rows that have no entry yet"""
+    search_backend()
+    indexed = select(SearchEntry.ref_id).where(SearchEntry.kind == 'document')
+    for document in Document.query.filter(Document.id.not_in(indexed)):
+        index_document(document)
+    indexed = select(SearchEntry.ref_id).where(SearchEntry.kind == 'question')
+    for question in Question.query.filter(Question.id.not_in(indexed)):
+        index_question(question)
+    indexed = select(SearchEntry.ref_id).where(SearchEntry.kind == 'answer')
+    for answer in Answer.query.filter(Answer.id.not_in(indexed)):
+        index_answer(answer)
+    db.session.commit()
+
+def _write_entry(kind, ref_id, title, body, extracted=None):
+    entry = SearchEntry.query.filter_by(kind=kind, ref_id=ref_id).first()
+    if entry is None:
+        entry = SearchEntry(kind=kind, ref_id=ref_id, extracted='')
+        db.session.add(entry)
+    entry.title = (title or '')[:255]
+    entry.body = (body or '')[:MAX_INDEXED_CHARS]
+    if extracted is not None:
+        entry.extracted = extracted[:MAX_INDEXED_CHARS]
+
+    if search_backend() == 'terms':
+        db.session.flush()
+        db.session.execute(delete(SearchTerm).where(SearchTerm.entry_id == entry.id))
+        weights = {}
+        for value, field_weight in zip((entry.title, entry.body, entry.extracted), FIELD_WEIGHTS):
+            for term in tokenize(value):
+                weights[term] = weights.get(term, 0.0) + field_weight
+        if weights:
+            db.session.execute(insert(SearchTerm), [
+                {'term': term, 'entry_id': entry.id, 'weight': weight}
+                for term, weight in weights.items()
+            ])
+    return entry
+
+def index_document(document, extracted=None):
+    """Index a document; extracted=None keeps previously extracted text"""
+    return _write_entry('document', document.id, document.original_filename, document.description, extracted)
+
+def index_question(question):
+    return _write_entry('question', question.id, question.title, question.content)
+
+def index_answer(answer):
+    return _write_entry('answer', answer.id, '', answer.content)
+
+def remove_from_index(kind, ref_ids):
+    """Drop the entries of the given rows; ref_ids may be a list or a subquery"""
+    if isinstance(ref_ids, (list, tuple, set)) and not ref_ids:
+        return
+    entries = select(SearchEntry.id).where(SearchEntry.kind == kind, SearchEntry.ref_id.in_(ref_ids))
+    if search_backend() == 'terms':
+        db.session.execute(delete(SearchTerm).where(SearchTerm.entry_id.in_(entries)))
+    db.session.execute(
+        delete(SearchEntry).where(SearchEntry.kind == kind, SearchEntry.ref_id.in_(ref_ids))
+        .execution_options(synchronize_session=False)
+    )
+
+def _scope_filter(kinds, folder):
+    """Restrict to the requested kinds, and to documents below folder if given"""
+    conditions = []
+    if kinds:
+        conditions.append(SearchEntry.kind.in_(kinds))
+    if folder is not None:
+        lower, upper = subtree_bounds(folder.tree_path)
+        in_subtree = select(Document.id).join(Folder, Folder.id == Document.folder_id).where(
+            Folder.tree_path >= lower, Folder.tree_path < upper
+        )
+        conditions.append(and_(SearchEntry.kind == 'document', SearchEntry.ref_id.in_(in_subtree)))
+    return conditions
+
+def _render(marked):
+    """HTML-escape text and turn match markers into <mark> tags"""
+    return html.escape(marked).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+def _mark_terms(value, terms):
+    pattern = re.compile(r'\b(' + '|'.join(re.escape(term) for term in terms) + r')', re.IGNORECASE)
+    return pattern.sub(lambda match: f"{MARK_START}{match.group(0)}{MARK_END}", value)
+
+def _snippet(entry, terms):
+    """Window of body or extracted text around the first match"""
+    pattern = re.compile(r'\b(' + '|'.join(re.escape(term) for term in terms) + r')', re.IGNORECASE)
+    for value in (entry.body, entry.extracted):
+        match = pattern.search(value or '')
+        if match:
+            start = max(match.start() - SNIPPET_CHARS // 2, 0)
+            window = value[start:start + SNIPPET_CHARS]
+            prefix = '…' if start else ''
+            suffix = '…' if start + SNIPPET_CHARS < len(value) else ''
+            return prefix + _mark_terms(window, terms) + suffix
+    return (entry.body or entry.extracted or '')[:SNIPPET_CHARS]
+
+def _search_fts5(terms, conditions, limit, offset):
+    # Quote every term so user input cannot inject FTS5 syntax; the last
+    # term is matched as a prefix for search-as-you-type
+    match = ' '.join(f'"{term}"' for term in terms[:-1]) + f' "{terms[-1]}"*'
+    weights = ', '.join(str(weight) for weight in FIELD_WEIGHTS)
+    fts = text(f"""
+        SELECT rowid AS entry_id,
+               bm25(search_fts, {weights}) AS rank,
+               highlight(search_fts, 0, :start, :end) AS title,
+               snippet(search_fts, -1, :start, :end, '…', 24) AS snippet
+        FROM search_fts WHERE search_fts MATCH :match
+    """).columns(entry_id=db.Integer, rank=db.Float, title=db.String, snippet=db.String).subquery('fts')
+    query = (
+        select(SearchEntry.kind, SearchEntry.ref_id, fts.c.rank, fts.c.title, fts.c.snippet)
+        .join(fts, fts.c.entry_id == SearchEntry.id)
+        .where(*conditions)
+        .order_by(fts.c.rank, SearchEntry.id)
+        .limit(limit).offset(offset)
+    )
+    rows = db.session.execute(query, {'match': match, 'start': MARK_START, 'end': MARK_END})
+    return [{
+        'kind': row.kind,
+        'id': row.ref_id,
+        'score': round(-row.rank, 4),
+        'title': _render(row.title),
+        'snippet': _render(row.snippet)
+    } for row in rows]
+
+def _search_terms(terms, conditions, limit, offset):
+    frequencies = dict(db.session.execute(
+        select(SearchTerm.term, func.count()).where(SearchTerm.term.in_(terms)).group_by(SearchTerm.term)
+    ).all())
+    if len(frequencies) < len(terms):
+        # Every term must match
+        return []
+    total = db.session.execute(select(func.count(SearchEntry.id))).scalar()
+    idf = {
+        term: math.log(1 + (total - frequency + 0.5) / (frequency + 0.5))
+        for term, frequency in frequencies.items()
+    }
+    score = func.sum(SearchTerm.weight * case(idf, value=SearchTerm.term, else_=0.0)).label('score')
+    ranked = (
+        select(SearchTerm.entry_id, score)
+        .join(SearchEntry, SearchEntry.id == SearchTerm.entry_id)
+        .where(SearchTerm.term.in_(terms), *conditions)
+        .group_by(SearchTerm.entry_id)
+        .having(func.count(SearchTerm.term) == len(terms))
+        .order_by(score.desc(), SearchTerm.entry_id)
+        .limit(limit).offset(offset)
+    )
+    scores = db.session.execute(ranked).all()
+    entries = {entry.id: entry for entry in SearchEntry.query.filter(SearchEntry.id.in_([row.entry_id for row in scores]))}
+    return [{
+        'kind': entries[row.entry_id].kind,
+        'id': entries[row.entry_id].ref_id,
+        'score': round(row.score, 4),
+        'title': _render(_mark_terms(entries[row.entry_id].title, terms)),
+        'snippet': _render(_snippet(entries[row.entry_id], terms))
+    } for row in scores]
+
+def search(query, kinds=None, folder=None, limit=20, offset=0):
+    """Ranked search over documents, questions and answers.
+
+    Results carry the row kind and id, a score, and the title and snippet
+    as HTML with matches wrapped in <mark>. Answers also carry their
+    question_id. A folder restricts results to documents in its subtree.
+    """
+    terms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return []
+
+    conditions = _scope_filter(kinds, folder)
+    if search_backend() == 'fts5':
+        results = _search_fts5(terms, conditions, limit, offset)
+    else:
+        results = _search_terms(terms, conditions, limit, offset)
+
+    answer_ids = [result['id'] for result in results if result['kind'] == 'answer']
+    if answer_ids:
+        questions = dict(db.session.execute(
+            select(Answer.id, Answer.question_id).where(Answer.id.in_(answer_ids))
+        ).all())
+        for result in results:
+            if result['kind'] == 'answer':
+                result['question_id'] = questions.get(result['id'])
+    return results
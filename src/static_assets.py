@@ -0,0 +1,182 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import sys
+from collections import namedtuple
+from flask import Response, request, send_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Serving of the built frontend in src/static.
+#
+# Every file is indexed once at startup together with gzip and, when the
+# optional brotli package is installed, brotli variants. Variants are kept
+# next to the file as <name>.gz / <name>.br so later starts reuse them; run
+#   python -m src.static_assets
+# at build time to create them ahead of the first start. Small files and
+# their variants are held in memory, larger ones are sent from disk.
+#
+# Vite puts a content hash in every file name under assets/, so those are
+# cached for a year as immutable. index.html names the current hashes and
+# is revalidated on every load.
+
+SMALL_ASSET_BYTES = int(os.environ.get('STATIC_MEMORY_LIMIT', 512 * 1024))
+# Compressed variants must save at least this share to be worth serving
+MIN_SAVING = 0.1
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE = 'no-cache'
+DEFAULT_CACHE = 'public, max-age=3600'
+COMPRESSIBLE_TYPES = {'application/javascript', 'application/json', 'image/svg+xml', 'image/vnd.microsoft.icon', 'image/x-icon'}
+# name-<hash>.ext as emitted by Vite and Rollup
+HASHED_NAME = re.compile(r'[-.][A-Za-z0-9_-]{8,}\.[a-z0-9]+$')
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+
+# body is the bytes when held in memory, else None and path is sent
+Variant = namedtuple('Variant', ['encoding', 'body', 'path', 'size', 'etag'])
+
+class StaticAsset:
+    """One file of the frontend with its precompressed variants"""
+
+    def __init__(self, relative_path, path, mimetype, cache_control, modified, variants):
+        self.relative_path = relative_path
+        self.path = path
+        self.mimetype = mimetype
+        self.cache_control = cache_control
+        self.modified = modified
+        # Preferred encodings first, identity last
+        self.variants = variants
+
+    def choose(self, accept_encodings):
+        for variant in self.variants:
+            if variant.encoding is None or accept_encodings[variant.encoding]:
+                return variant
+        return self.variants[-1]
+
+def compressible(mimetype):
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES
+
+def cache_control_for(relative_path):
+    if relative_path.startswith('assets/') and HASHED_NAME.search(relative_path):
+        return IMMUTABLE_CACHE
+    if relative_path.endswith('.html'):
+        return REVALIDATE_CACHE
+    return DEFAULT_CACHE
+
+def _compress(encoding, data):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11)
+    # mtime=0 keeps the output identical between builds
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+def _write_atomically(path, data):
+    temp_path = f'{path}.tmp{os.getpid()}'
+    with open(temp_path, 'wb') as output:
+        output.write(data)
+    os.replace(temp_path, path)
+
+def _variant(path, data, encoding, digest, keep_in_memory):
+    """The precompressed variant of a file, created when missing or outdated"""
+    variant_path = path + ENCODINGS[encoding]
+    fresh = os.path.exists(variant_path) and os.path.getmtime(variant_path) >= os.path.getmtime(path)
+    if fresh:
+        with open(variant_path, 'rb') as source:
+            compressed = source.read() if keep_in_memory else None
+        size = os.path.getsize(variant_path)
+    else:
+        compressed = _compress(encoding, data)
+        size = len(compressed)
+        try:
+            _write_atomically(variant_path, compressed)
+        except OSError:
+            # Read-only deploy: keep the variant in memory whatever its size
+            variant_path = None
+            keep_in_memory = True
+    if size > len(data) * (1 - MIN_SAVING):
+        return None
+    return Variant(encoding, compressed if keep_in_memory else None, variant_path, size, f'{digest}-{encoding}')
+
+def load_asset(static_folder, relative_path):
+    path = os.path.join(static_folder, relative_path)
+    with open(path, 'rb') as source:
+        data = source.read()
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    keep_in_memory = len(data) <= SMALL_ASSET_BYTES
+
+    variants = []
+    if compressible(mimetype):
+        for encoding in ENCODINGS:
+            if encoding == 'br' and brotli is None:
+                continue
+            variant = _variant(path, data, encoding, digest, keep_in_memory)
+            if variant is not None:
+                variants.append(variant)
+    variants.append(Variant(None, data if keep_in_memory else None, path, len(data), digest))
+    return StaticAsset(relative_path, path, mimetype, cache_control_for(relative_path), os.path.getmtime(path), variants)
+
+def load_assets(static_folder):
+    """Index every file below static_folder by its path relative to it"""
+    assets = {}
+    for directory, _, filenames in os.walk(static_folder):
+        for filename in filenames:
+            if filename.endswith(tuple(ENCODINGS.values())) or '.tmp' in filename:
+                continue
+            relative_path = os.path.relpath(os.path.join(directory, filename), static_folder).replace(os.sep, '/')
+            assets[relative_path] = load_asset(static_folder, relative_path)
+    in_memory = sum(variant.size for asset in assets.values() for variant in asset.variants if variant.body is not None)
+    logger.info('Indexed %d static files, %d bytes held in memory', len(assets), in_memory)
+    return assets
+
+_assets = {}
+
+def init_static_assets(static_folder):
+    global _assets
+    _assets = load_assets(static_folder) if static_folder and os.path.isdir(static_folder) else {}
+
+def has_asset(relative_path):
+    return relative_path in _assets
+
+def asset_response(relative_path):
+    """Serve an indexed file in the best encoding the client accepts"""
+    asset = _assets[relative_path]
+    variant = asset.choose(request.accept_encodings)
+    if variant.body is not None:
+        response = Response(variant.body, mimetype=asset.mimetype)
+        response.last_modified = asset.modified
+        response.set_etag(variant.etag)
+        response = response.make_conditional(request, accept_ranges=True, complete_length=variant.size)
+    else:
+        response = send_file(
+            variant.path,
+            mimetype=asset.mimetype,
+            conditional=True,
+            etag=variant.etag,
+            last_modified=asset.modified
+        )
+    if variant.encoding:
+        response.headers['Content-Encoding'] = variant.encoding
+    if len(asset.variants) > 1:
+        response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = asset.cache_control
+    return response
+
+def main(argv=None):
+    """Write the compressed variants of the frontend ahead of deployment"""
+    static_folder = (argv or sys.argv[1:] or [os.path.join(os.path.dirname(__file__), 'static')])[0]
+    for relative_path, asset in sorted(load_assets(static_folder).items()):
+        sizes = ', '.join(f'{variant.encoding or "identity"} {variant.size}' for variant in asset.variants)
+        print(f'{relative_path}: {sizes}')
+    if brotli is None:
+        print('brotli is not installed; only gzip variants were written')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,623 @@
+import hashlib
+import io
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+UPLOAD_FOLDER = os.environ.get('UPLOADS_DIR', '/tmp/vdr_uploads')
+PARTIAL_FOLDER = os.path.join(UPLOAD_FOLDER, 'partial')
+# Content-addressed store: every distinct file is kept once, named by its SHA-256
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'blobs')
+
+# Bytes read from the request stream per write; bounds memory per upload
+STREAM_BLOCK_SIZE = 64 * 1024
+
+# Where stored files live: 'local' keeps them in UPLOAD_FOLDER, 's3' in an
+# S3-compatible bucket (AWS, MinIO, R2, B2, ...) behind a local disk cache,
+# and 'memory' in an in-process stand-in for the bucket, for tests. Partial
+# uploads and previews always stay on local disk.
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local').lower()
+S3_BUCKET = os.environ.get('S3_BUCKET')
+S3_PREFIX = os.environ.get('S3_PREFIX', '')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+S3_REGION = os.environ.get('S3_REGION')
+STORAGE_CACHE_DIR = os.environ.get('STORAGE_CACHE_DIR', os.path.join(UPLOAD_FOLDER, 'cache'))
+STORAGE_CACHE_SIZE = int(os.environ.get('STORAGE_CACHE_SIZE', 1024 ** 3))
+
+class ChunkError(Exception):
+    """Raised when a chunk body does not match what the session expects"""
+
+class PartialMissing(Exception):
+    """Raised when the partial file of a session no longer holds all its bytes"""
+
+# Running SHA-256 state of open upload sessions, keyed by session id and
+# stored with the byte offset and partial file modification time it covers.
+# Kept in memory so the final hash is known when the last chunk lands;
+# rebuilt from the partial file when another process wrote the chunks
+# since, or this one restarted mid-upload.
+_hashers = {}
+
+def ensure_folder(path):
+    os.makedirs(path, exist_ok=True)
+
+def partial_path(session_id):
+    return os.path.join(PARTIAL_FOLDER, f"{session_id}.part")
+
+def blob_key(content_hash):
+    return f"blobs/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}"
+
+def blob_path(content_hash):
+    """Where a blob lives on the local backend; kept in Document.file_path"""
+    return os.path.join(UPLOAD_FOLDER, *blob_key(content_hash).split('/'))
+
+def document_key(document):
+    """Storage key of a document's contents"""
+    if document.content_hash:
+        return blob_key(document.content_hash)
+    # Files from before content addressing sit wherever file_path says
+    return os.path.relpath(document.file_path, UPLOAD_FOLDER).replace(os.sep, '/')
+
+def blob_exists(content_hash):
+    return storage_backend().exists(blob_key(content_hash))
+
+def place_blob(temp_path, content_hash):
+    """Move a hashed temp file into the blob store and return the blob path.
+
+    If identical contents are already stored the temp file is dropped, so a
+    duplicate upload never becomes a second copy.
+    """
+    storage_backend().put(blob_key(content_hash), temp_path)
+    return blob_path(content_hash)
+
+def remove_blob(content_hash):
+    storage_backend().delete(blob_key(content_hash))
+
+def iter_file(path, start=0, stop=None):
+    """Yield the bytes of path between start and stop in bounded blocks"""
+    with open(path, 'rb') as source:
+        source.seek(start)
+        remaining = (stop if stop is not None else os.path.getsize(path)) - start
+        while remaining > 0:
+            block = source.read(min(STREAM_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+def spool_stream(stream):
+    """Copy a stream to a temp file while hashing it; returns (path, sha256, size)"""
+    ensure_folder(PARTIAL_FOLDER)
+    path = os.path.join(PARTIAL_FOLDER, f"{uuid.uuid4().hex}.tmp")
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, 'wb') as temp:
+            for block in iter(lambda: stream.read(STREAM_BLOCK_SIZE), b''):
+                temp.write(block)
+                hasher.update(block)
+                size += len(block)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, hasher.hexdigest(), size
+
+class HashingSpool:
+    """Temp file in the partial folder that hashes whatever is written to it.
+
+    Used as the stream of uploaded form files, so the upload lands on disk
+    once, already hashed, and storing it is a rename. Closing it removes
+    the file unless it was moved into the store.
+    """
+
+    def __init__(self):
+        ensure_folder(PARTIAL_FOLDER)
+        self.path = os.path.join(PARTIAL_FOLDER, f"{uuid.uuid4().hex}.tmp")
+        self.file = open(self.path, 'w+b')
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+def spool_upload(file):
+    """(path, sha256, size) of an uploaded form file in the partial folder"""
+    if isinstance(file.stream, HashingSpool):
+        file.stream.flush()
+        return file.stream.path, file.stream.hasher.hexdigest(), file.stream.size
+    # Streams from elsewhere are copied once
+    return spool_stream(file.stream)
+
+def _modified(path):
+    return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+def session_hasher(session_id, received_size):
+    """Return the running hash for a session covering exactly received_size bytes"""
+    path = partial_path(session_id)
+    cached = _hashers.get(session_id)
+    if cached and cached[:2] == (received_size, _modified(path)):
+        return cached[2]
+
+    hasher = hashlib.sha256()
+    if received_size and os.path.exists(path):
+        with open(path, 'rb') as partial:
+            remaining = received_size
+            while remaining:
+                block = partial.read(min(STREAM_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                hasher.update(block)
+                remaining -= len(block)
+    _hashers[session_id] = (received_size, _modified(path), hasher, time.monotonic())
+    return hasher
+
+def write_chunk(session_id, offset, length, stream, expected_sha256=None):
+    """Stream one chunk from the request body into the partial file.
+
+    The chunk is hashed while it is written, both on its own (to verify
+    expected_sha256) and as part of the running whole-file hash. On any
+    mismatch the partial file is cut back to offset so the chunk can be
+    retried.
+    """
+    ensure_folder(PARTIAL_FOLDER)
+    path = partial_path(session_id)
+    file_hasher = session_hasher(session_id, offset).copy()
+    chunk_hasher = hashlib.sha256()
+    written = 0
+
+    with open(path, 'r+b' if os.path.exists(path) else 'w+b') as partial:
+        partial.seek(offset)
+        partial.truncate()
+        try:
+            while True:
+                block = stream.read(min(STREAM_BLOCK_SIZE, length + 1 - written))
+                if not block:
+                    break
+                written += len(block)
+                if written > length:
+                    raise ChunkError(f'Chunk is larger than the expected {length} bytes')
+                partial.write(block)
+                chunk_hasher.update(block)
+                file_hasher.update(block)
+
+            if written != length:
+                raise ChunkError(f'Expected {length} bytes, received {written}')
+            if expected_sha256 and chunk_hasher.hexdigest() != expected_sha256.lower():
+                raise ChunkError('Chunk checksum mismatch')
+        except Exception:
+            partial.truncate(offset)
+            raise
+
+    _hashers[session_id] = (offset + length, _modified(path), file_hasher, time.monotonic())
+    return chunk_hasher.hexdigest()
+
+def finish_partial(session_id, total_size, expected_sha256=None):
+    """Store a completed partial file as a blob and return its SHA-256.
+
+    Raises PartialMissing when the file is gone or short, e.g. after a
+    crash or the partial sweep, so the chunks must be sent again.
+    """
+    path = partial_path(session_id)
+    if not os.path.exists(path) and total_size == 0:
+        # Zero-byte uploads never receive a chunk
+        ensure_folder(PARTIAL_FOLDER)
+        open(path, 'wb').close()
+    if not os.path.exists(path) or os.path.getsize(path) != total_size:
+        discard_partial(session_id)
+        raise PartialMissing(f'Partial upload {session_id} does not hold {total_size} bytes')
+    digest = session_hasher(session_id, os.path.getsize(path)).hexdigest()
+    if expected_sha256 and expected_sha256.lower() != digest:
+        discard_partial(session_id)
+        raise ChunkError('File checksum mismatch')
+    place_blob(path, digest)
+    discard_partial(session_id)
+    return digest
+
+def discard_partial(session_id):
+    """Drop the partial file and in-memory state of an upload session"""
+    _hashers.pop(session_id, None)
+    path = partial_path(session_id)
+    if os.path.exists(path):
+        os.remove(path)
+
+def remove_stale_partials(max_age):
+    """Remove partial and temp files untouched for max_age seconds.
+
+    Also forgets running hashes this process has not used for as long,
+    which covers sessions finished or abandoned in another process.
+    """
+    for session_id, cached in list(_hashers.items()):
+        if time.monotonic() - cached[3] > max_age:
+            _hashers.pop(session_id, None)
+    if not os.path.isdir(PARTIAL_FOLDER):
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for entry in os.scandir(PARTIAL_FOLDER):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+class LocalBackend:
+    """Stored files as plain files below root"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def local_path(self, key):
+        """A file on this machine holding the contents, or None"""
+        path = self.path(key)
+        return path if os.path.exists(path) else None
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def put(self, key, temp_path):
+        """Store temp_path under key; the temp file is moved or removed"""
+        target = self.path(key)
+        if os.path.exists(target):
+            os.remove(temp_path)
+        else:
+            ensure_folder(os.path.dirname(target))
+            os.replace(temp_path, target)
+
+    def open_blocks(self, key, start=0, stop=None):
+        """Iterate the bytes between start and stop; FileNotFoundError if missing"""
+        return iter_file(self.path(key), start, stop)
+
+    def delete(self, key):
+        path = self.path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def fetch(self, key):
+        """Path of a local copy for tools that need a real file, or None"""
+        return self.local_path(key)
+
+    def pin(self, key):
+        pass
+
+    def unpin(self, key):
+        pass
+
+class MissingObject(Exception):
+    """Raised by MemoryObjectStore where boto3 raises a ClientError for a 404"""
+
+    def __init__(self, key):
+        super().__init__(f'No such key: {key}')
+        self.response = {'Error': {'Code': 'NoSuchKey'}}
+
+def _is_missing(error):
+    return getattr(error, 'response', {}).get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+class MemoryObjectStore:
+    """In-process stand-in for the part of the boto3 S3 client S3Backend uses"""
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, 'rb') as source:
+            data = source.read()
+        with self.lock:
+            self.objects[(Bucket, Key)] = data
+
+    def _get(self, Bucket, Key):
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise MissingObject(Key)
+            return self.objects[(Bucket, Key)]
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self._get(Bucket, Key))}
+
+    def get_object(self, Bucket, Key, Range=None):
+        data = self._get(Bucket, Key)
+        if Range:
+            start, stop = re.match(r'bytes=(\d+)-(\d*)$', Range).groups()
+            data = data[int(start):int(stop) + 1 if stop else None]
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    def delete_object(self, Bucket, Key):
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+class S3Backend:
+    """Stored files as objects in an S3-compatible bucket"""
+
+    def __init__(self, bucket, prefix='', client=None):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise RuntimeError('STORAGE_BACKEND=s3 needs the boto3 package')
+            client = boto3.client('s3', endpoint_url=S3_ENDPOINT_URL, region_name=S3_REGION)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def object_key(self, key):
+        return self.prefix + key
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except Exception as e:
+            if _is_missing(e):
+                return False
+            raise
+        return True
+
+    def upload(self, key, path):
+        # boto3 switches to a multipart upload for large files by itself
+        self.client.upload_file(Filename=path, Bucket=self.bucket, Key=self.object_key(key))
+
+    def put(self, key, temp_path):
+        if not self.exists(key):
+            self.upload(key, temp_path)
+        os.remove(temp_path)
+
+    def open_blocks(self, key, start=0, stop=None):
+        arguments = {'Bucket': self.bucket, 'Key': self.object_key(key)}
+        if start or stop is not None:
+            if stop is not None and stop <= start:
+                return
+            arguments['Range'] = f"bytes={start}-{stop - 1 if stop is not None else ''}"
+        try:
+            body = self.client.get_object(**arguments)['Body']
+        except Exception as e:
+            if _is_missing(e):
+                raise FileNotFoundError(key)
+            raise
+        try:
+            yield from iter(lambda: body.read(STREAM_BLOCK_SIZE), b'')
+        finally:
+            body.close()
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+class CachedBackend:
+    """Read-through cache on local disk in front of a remote backend.
+
+    Whole files read from the remote are written to the cache while they
+    are streamed to the client, never buffered in memory. Hits are served
+    from disk. When the cache grows past max_bytes the least recently used
+    files are dropped, except those pinned while processing reads them.
+    Processes sharing cache_dir each track and evict on their own, so a
+    file can vanish under another process; that is treated as a miss.
+    """
+
+    def __init__(self, remote, cache_dir, max_bytes):
+        self.remote = remote
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # key -> size, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.pinned = {}
+        self.lock = threading.Lock()
+        self._load()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, *key.split('/'))
+
+    def _load(self):
+        """Index what an earlier run left in the cache, oldest first"""
+        found = []
+        for directory, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                if '.tmp' in filename:
+                    os.remove(path)
+                    continue
+                key = os.path.relpath(path, self.cache_dir).replace(os.sep, '/')
+                stat = os.stat(path)
+                found.append((stat.st_mtime, key, stat.st_size))
+        with self.lock:
+            for _, key, size in sorted(found):
+                self.entries[key] = size
+                self.size += size
+            self._evict()
+
+    def _forget(self, key):
+        with self.lock:
+            self.size -= self.entries.pop(key, 0)
+
+    def _evict(self):
+        # Called with the lock held
+        for key in list(self.entries):
+            if self.size <= self.max_bytes:
+                break
+            if key in self.pinned:
+                continue
+            self.size -= self.entries.pop(key)
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def _admit(self, key, temp_path, size):
+        os.replace(temp_path, self.path(key))
+        with self.lock:
+            self.size += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            self._evict()
+
+    def local_path(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        path = self.path(key)
+        if os.path.exists(path):
+            return path
+        self._forget(key)
+        return None
+
+    def exists(self, key):
+        return self.local_path(key) is not None or self.remote.exists(key)
+
+    def put(self, key, temp_path):
+        if self.local_path(key) is not None:
+            os.remove(temp_path)
+            return
+        if not self.remote.exists(key):
+            self.remote.upload(key, temp_path)
+        # New uploads are read again right away by processing
+        ensure_folder(os.path.dirname(self.path(key)))
+        try:
+            self._admit(key, temp_path, os.path.getsize(temp_path))
+        except OSError:
+            # The cache is on another filesystem than the temp file
+            os.remove(temp_path)
+
+    def _fill(self, key):
+        """Stream a file from the remote while writing it to the cache"""
+        path = self.path(key)
+        ensure_folder(os.path.dirname(path))
+        temp_path = f'{path}.tmp{uuid.uuid4().hex}'
+        size = 0
+        complete = False
+        try:
+            with open(temp_path, 'wb') as cached:
+                for block in self.remote.open_blocks(key):
+                    cached.write(block)
+                    size += len(block)
+                    yield block
+            complete = True
+        finally:
+            # A client that disconnects leaves nothing half written behind
+            if complete:
+                self._admit(key, temp_path, size)
+            elif os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def open_blocks(self, key, start=0, stop=None):
+        path = self.local_path(key)
+        if path is not None:
+            return iter_file(path, start, stop)
+        if start or stop is not None:
+            # Ranges of cold files go straight to the remote
+            return self.remote.open_blocks(key, start, stop)
+        return self._fill(key)
+
+    def delete(self, key):
+        self.remote.delete(key)
+        self._forget(key)
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def fetch(self, key):
+        path = self.local_path(key)
+        if path is not None:
+            return path
+        try:
+            for _ in self._fill(key):
+                pass
+        except FileNotFoundError:
+            return None
+        return self.local_path(key)
+
+    def pin(self, key):
+        with self.lock:
+            self.pinned[key] = self.pinned.get(key, 0) + 1
+
+    def unpin(self, key):
+        with self.lock:
+            self.pinned[key] -= 1
+            if not self.pinned[key]:
+                del self.pinned[key]
+                self._evict()
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def create_backend(name=STORAGE_BACKEND):
+    if name == 'local':
+        return LocalBackend(UPLOAD_FOLDER)
+    if name == 's3':
+        if not S3_BUCKET:
+            raise RuntimeError('STORAGE_BACKEND=s3 needs S3_BUCKET')
+        remote = S3Backend(S3_BUCKET, S3_PREFIX)
+    elif name == 'memory':
+        remote = S3Backend('vdr', client=MemoryObjectStore())
+    else:
+        raise RuntimeError(f'Unknown STORAGE_BACKEND {name!r}; use local, s3 or memory')
+    return CachedBackend(remote, STORAGE_CACHE_DIR, STORAGE_CACHE_SIZE)
+
+def storage_backend():
+    """The configured backend, created on first use"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = create_backend()
+        return _backend
+
+def main(argv=None):
+    """Copy the local blob store into the configured remote backend"""
+    logging.basicConfig(level=logging.INFO)
+    backend = storage_backend()
+    if not isinstance(backend, CachedBackend):
+        print('STORAGE_BACKEND is local; nothing to copy')
+        return 0
+    copied = 0
+    for directory, _, filenames in os.walk(BLOB_FOLDER):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            key = os.path.relpath(path, UPLOAD_FOLDER).replace(os.sep, '/')
+            if not backend.remote.exists(key):
+                backend.remote.upload(key, path)
+                copied += 1
+    print(f'Copied {copied} files to {STORAGE_BACKEND}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())